@@ -0,0 +1,272 @@
+"""An asyncio runner for the pipeline.
+
+pipeline in app.etl runs the steps of the DAG one after another and only
+overlaps the chunks inside a step.  run_pipeline drives the same steps from an
+event loop instead, so that everything the DAG allows runs at the same time
+in one process:
+
+* the independent steps add_measurement_columns, extend_sample_lineage and
+  add_samples_and_experiments always run concurrently.
+* the chunks of every step, i.e. its partitions of sample ids (see
+  app.batching), are scheduled on the loop.  Chunks and reads of every
+  running step share one bound of concurrency connections.
+* with verify the samples are read and their top parents computed while the
+  steps are still writing, only the comparison waits for the writes (see
+  app.verify).
+* with verify and an export_directory the export is staged while the rows
+  are verified and only published once they passed (see app.export).
+
+SQLAlchemy 1.3 has no asyncio engine and the drivers block, so every
+blocking call runs on a thread of an executor the loop awaits.  The steps,
+their options and what an incremental run records are the same as for
+app.etl.pipeline, so either runner picks up where the other one left off.
+
+    python -m app.async_runner
+"""
+import asyncio
+import shutil
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextvars import copy_context
+from functools import partial
+
+from app.batching import CHUNK_SIZE, chunk_scheduler
+from app.closure import extend_sample_lineage
+from app.etl import (
+    SQL,
+    add_measurement_columns,
+    add_samples_and_experiments,
+    add_values,
+    check_options,
+    export_tag,
+    fail_verification,
+    plan_pipeline,
+    run_planned,
+    run_step,
+    set_top_parents_adjacent,
+    set_top_parents_of_root_nodes,
+)
+from app.etl_app_side import STREAMING, load_streaming
+from app.export import (
+    export_experiment_measurements,
+    publish,
+    staging_directory,
+)
+from app.incremental import finish_run, pending_sample_ids
+from app.indexes import MODE_TABLES, deferred_indexes
+from app.instrumentation import RunMetrics
+from app.lineage_index import update_lineage_index
+from app.partitions import prepare_partitions
+from app.rollups import update_rollups
+from app.schema import get_engine, inject_session, session_scope
+from app.storage import DYNAMIC
+from app.vectorized import VECTORIZED, transform_vectorized
+from app.verify import read_lineage, verify_experiment_measurements
+
+# Number of chunks and reads running at the same time.  Each of them holds a
+#  pooled connection, see app.config.
+CONCURRENCY = 4
+
+# Threads running the steps themselves.  A step mostly waits for its chunks,
+#  so these do not count against the concurrency.
+STEP_THREADS = 8
+
+
+@inject_session
+def read_verification_lineage(session, sample_ids=None):
+    """Runs app.verify.read_lineage in a session of its own."""
+    return read_lineage(session, sample_ids=sample_ids)
+
+
+class AsyncRunner:
+    """Runs the blocking calls of the pipeline on behalf of an event loop.
+
+    It is the chunk_scheduler of the steps it runs, so their chunks are
+    scheduled on the loop as well.  Chunks and calls made with slot wait for
+    one of concurrency slots and hold it while they run."""
+
+    def __init__(self, loop, concurrency=CONCURRENCY):
+        self.loop = loop
+        self.slots = asyncio.Semaphore(concurrency)
+        self.step_pool = ThreadPoolExecutor(STEP_THREADS)
+        self.chunk_pool = ThreadPoolExecutor(concurrency)
+
+    async def call(self, function, *args, slot=False, **kwargs):
+        """Calls function in a thread, in a copy of the current context."""
+        context = copy_context()
+        context.run(chunk_scheduler.set, self)
+        call = partial(context.run, function, *args, **kwargs)
+        if not slot:
+            return await self.loop.run_in_executor(self.step_pool, call)
+        async with self.slots:
+            return await self.loop.run_in_executor(self.step_pool, call)
+
+    async def run_chunk(self, context, function, item):
+        async with self.slots:
+            return await self.loop.run_in_executor(
+                self.chunk_pool, context.run, function, item)
+
+    def map(self, function, items):
+        """Called by app.batching.run_chunked from the thread of a step.
+        Schedules function on every item and waits for all of them."""
+        futures = [
+            asyncio.run_coroutine_threadsafe(
+                self.run_chunk(copy_context(), function, item), self.loop)
+            for item in items
+        ]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.step_pool.shutdown()
+        self.chunk_pool.shutdown()
+
+
+async def gather(*awaitables):
+    """Waits for all awaitables, then raises the first error if any
+    failed."""
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def run_transform(runner, metrics, plan, transform, sample_ids,
+                        options):
+    """Runs the steps of the DAG described in app.etl, skipping the ones the
+    plan found no work for."""
+    independent_steps = [
+        runner.call(
+            run_planned, plan, metrics, add_measurement_columns,
+            mode=options["mode"], slot=True),
+        runner.call(
+            run_planned, plan, metrics, extend_sample_lineage,
+            sample_ids=sample_ids, chunk_size=options["chunk_size"],
+            workers=options["workers"]),
+    ]
+    if transform == SQL:
+        independent_steps.append(runner.call(
+            run_planned, plan, metrics, add_samples_and_experiments,
+            sample_ids=sample_ids, **options))
+    await gather(*independent_steps)
+    if transform == VECTORIZED:
+        await runner.call(
+            run_planned, plan, metrics, transform_vectorized, **options)
+        await runner.call(
+            run_planned, plan, metrics, update_rollups, **options)
+        return
+    if transform == STREAMING:
+        await runner.call(
+            run_planned, plan, metrics, load_streaming,
+            sample_ids=sample_ids, **options)
+    else:
+        await runner.call(
+            run_planned, plan, metrics, add_values, sample_ids=sample_ids,
+            **options)
+    await runner.call(
+        run_planned, plan, metrics, set_top_parents_of_root_nodes, **options)
+    await runner.call(
+        run_planned, plan, metrics, set_top_parents_adjacent, **options)
+    await runner.call(run_planned, plan, metrics, update_rollups, **options)
+
+
+async def run_pipeline(incremental=True, chunk_size=CHUNK_SIZE,
+                       concurrency=CONCURRENCY, mode=DYNAMIC,
+                       export_directory=None, transform=SQL,
+                       report_path=None, explain=False, verify=False,
+                       defer_indexes=False, lineage_index=None):
+    """Runs the pipeline like app.etl.pipeline, which documents the options.
+    concurrency takes the place of its workers."""
+    check_options(mode, transform, incremental)
+    runner = AsyncRunner(asyncio.get_running_loop(), concurrency)
+    try:
+        plan, run_id, sample_ids = await runner.call(
+            plan_pipeline, incremental, mode, transform)
+        if run_id is None and not plan.has_work:
+            # NOTE:  In production code this would be changed to a logger
+            print("Nothing to do")
+            return
+        await runner.call(prepare_partitions, MODE_TABLES[mode])
+        options = {
+            "chunk_size": chunk_size, "workers": concurrency, "mode": mode}
+        if incremental:
+            options["run_id"] = run_id
+
+        metrics = RunMetrics(explain=explain)
+        with metrics.installed(get_engine()):
+            report = await run_steps(
+                runner, metrics, plan, transform, sample_ids, options,
+                export_directory, export_tag(run_id), verify, defer_indexes)
+            if lineage_index is not None:
+                await runner.call(
+                    run_step, metrics, update_lineage_index,
+                    path=lineage_index, sample_ids=sample_ids)
+        if report_path is not None:
+            metrics.write(report_path)
+        if report is not None and not report.ok:
+            fail_verification(report, run_id if incremental else None)
+
+        if incremental:
+            with session_scope() as session:
+                finish_run(session, run_id)
+    finally:
+        runner.close()
+
+
+async def run_steps(runner, metrics, plan, transform, sample_ids, options,
+                    export_directory, tag, verify, defer_indexes):
+    """Runs the transform, verification and export, overlapping them where
+    they do not depend on each other.  Returns the VerificationReport, or
+    None without verify."""
+    mode = options["mode"]
+    tables = [MODE_TABLES[mode]] if defer_indexes else []
+    with deferred_indexes(get_engine(), tables):
+        lineage = None
+        if verify:
+            # Reads only the samples, which the steps do not write.
+            lineage = asyncio.ensure_future(runner.call(
+                run_step, metrics, read_verification_lineage,
+                sample_ids=sample_ids, slot=True))
+        try:
+            await run_transform(
+                runner, metrics, plan, transform, sample_ids, options)
+        except BaseException:
+            if lineage is not None:
+                await asyncio.gather(lineage, return_exceptions=True)
+            raise
+
+    reads = []
+    if verify:
+        reads.append(runner.call(
+            run_step, metrics, verify_experiment_measurements,
+            sample_ids=sample_ids, mode=mode,
+            chunk_size=options["chunk_size"], lineage=await lineage,
+            pending=pending_sample_ids() if "run_id" in options else None,
+            slot=True))
+    staging = None
+    if export_directory is not None:
+        directory = export_directory
+        if verify:
+            # Rows that fail the verification are not exported.
+            staging = directory = staging_directory(export_directory, tag)
+        reads.append(runner.call(
+            run_step, metrics, export_experiment_measurements,
+            directory=directory, sample_ids=sample_ids, tag=tag, mode=mode,
+            slot=True))
+    try:
+        results = await gather(*reads)
+    except BaseException:
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+        raise
+    report = results[0] if verify else None
+    if staging is not None:
+        if report.ok:
+            publish(staging, export_directory, full=sample_ids is None)
+        else:
+            shutil.rmtree(staging, ignore_errors=True)
+    return report
+
+
+if __name__ == "__main__":
+    asyncio.run(run_pipeline())
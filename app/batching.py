@@ -0,0 +1,199 @@
+"""Chunked execution of pipeline steps.
+
+Running a step as one statement over the whole table holds row locks for the
+duration of the statement and builds up one huge transaction.  run_chunked
+splits a step into sample_id key ranges of chunk_size ids instead and commits
+after every chunk, so locks and undo are bounded by the size of a chunk.
+
+Chunk boundaries are aligned to multiples of chunk_size, i.e. a chunk always
+covers k * chunk_size < sample_id <= (k + 1) * chunk_size.  When a run_id is
+given every finished chunk is recorded in the etl_chunks table.  A crashed run
+that is resumed (see app.incremental) skips the chunks it already finished,
+provided it is resumed with the same chunk_size.
+
+Every chunk reports its timing so that chunk_size can be tuned.
+
+Chunks cover disjoint key ranges, so they can be run concurrently by a pool of
+workers.  Chunks that are rolled back by a deadlock or a lock wait timeout are
+retried.
+
+A runner that schedules the work of several steps itself, like the event loop
+of app.async_runner, sets chunk_scheduler.  The chunks of every step running
+in its context are then handed to it instead of a thread pool of their own.
+A runner that splits a step into partitions, like the tasks of app.tasks,
+sets partition_bounds to the (start, end) of sample ids the step may touch.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+
+from sqlalchemy import func
+from sqlalchemy.exc import DBAPIError
+
+from app.schema import EtlChunk, session_scope
+
+# Number of sample ids each chunk of a step covers.
+CHUNK_SIZE = 50000
+
+# How often a chunk that lost a deadlock is retried and the delay in seconds
+#  before the first retry.  The delay doubles with every retry.
+DEADLOCK_RETRIES = 3
+RETRY_BACKOFF = .5
+
+# ER_LOCK_WAIT_TIMEOUT and ER_LOCK_DEADLOCK
+RETRYABLE_MYSQL_ERRORS = {1205, 1213}
+# serialization_failure and deadlock_detected
+RETRYABLE_POSTGRESQL_ERRORS = {"40001", "40P01"}
+
+# An object with a map(function, items) method running function on every
+#  item in a copy of the calling context and returning the results in order.
+chunk_scheduler = ContextVar("chunk_scheduler", default=None)
+
+# The (start, end) bounds every step running in the context is limited to.
+#  Both must be aligned to the chunk_size, see chunk_ranges.
+partition_bounds = ContextVar("partition_bounds", default=None)
+
+
+def key_range(session, column, *criteria):
+    """Returns the (low, high) values of column among the rows matching
+    criteria, or (None, None) if there are none.  On an indexed column this
+    costs two index probes."""
+    return session.query(
+        func.min(column),
+        func.max(column),
+    ).filter(*criteria).one()
+
+
+def chunk_ranges(low, high, chunk_size=CHUNK_SIZE):
+    """Yields the aligned (start, end) ranges covering low through high."""
+    start = (low - 1) // chunk_size * chunk_size + 1
+    while start <= high:
+        yield start, start + chunk_size - 1
+        start += chunk_size
+
+
+def finished_chunks(session, run_id, step):
+    """Returns the start of every chunk of step the run has finished."""
+    return set(
+        chunk_start for (chunk_start,) in session.query(
+            EtlChunk.chunk_start
+        ).filter(
+            EtlChunk.run_id == run_id,
+            EtlChunk.step == step,
+        )
+    )
+
+
+def forget_chunks(session, run_id, steps):
+    """Deletes the records of the finished chunks of steps in the run, so a
+    resumed run runs them again."""
+    session.query(EtlChunk).filter(
+        EtlChunk.run_id == run_id,
+        EtlChunk.step.in_(steps),
+    ).delete(synchronize_session=False)
+
+
+def is_retryable(error):
+    """Tells whether a DBAPIError only rolled back the statement because of
+    lock contention with a concurrent transaction, so that the chunk can
+    simply be retried."""
+    orig = getattr(error, "orig", None)
+    if getattr(orig, "errno", None) in RETRYABLE_MYSQL_ERRORS:
+        return True
+    if getattr(orig, "pgcode", None) in RETRYABLE_POSTGRESQL_ERRORS:
+        return True
+    return "database is locked" in str(orig)
+
+
+def run_chunk(session, step, body, start, end, run_id=None,
+              retries=DEADLOCK_RETRIES):
+    """Runs body for one chunk and commits it.  A chunk that loses a deadlock
+    is rolled back and retried up to retries times with exponential
+    backoff."""
+    for attempt in range(retries + 1):
+        began = time.perf_counter()
+        try:
+            rows = body(session, start, end)
+            # DBAPIs report -1 when they cannot tell how many rows were
+            #  written.
+            if rows is not None and rows < 0:
+                rows = None
+            if run_id is not None:
+                session.add(EtlChunk(
+                    run_id=run_id,
+                    step=step,
+                    chunk_start=start,
+                    chunk_end=end,
+                    rows_written=rows,
+                    seconds=time.perf_counter() - began,
+                ))
+            session.commit()
+        except DBAPIError as e:
+            session.rollback()
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+            print(f"{step}: chunk {start}-{end} hit {e.orig!r},"
+                  f" retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        elapsed = time.perf_counter() - began
+        # NOTE:  In production code this would be changed to a logger
+        print(f"{step}: chunk {start}-{end} wrote {rows} rows"
+              f" in {elapsed:.3f}s")
+        return rows
+
+
+def run_chunked(session, step, body, low, high, chunk_size=CHUNK_SIZE,
+                run_id=None, workers=1, retries=DEADLOCK_RETRIES):
+    """Calls body(session, start, end) for every chunk between low and high
+    and commits after each one.  body returns the number of rows it wrote,
+    or None if that is unknown.  Returns the number of rows written by the
+    chunks it ran.
+
+    With more than one worker the chunks are fanned out to a thread pool, or
+    to the chunk_scheduler when one is set.  Every worker runs its chunks in
+    a session of its own, i.e. on its own pooled connection, so body must
+    not rely on state of session."""
+    bounds = partition_bounds.get()
+    if low is not None and bounds is not None:
+        low, high = max(low, bounds[0]), min(high, bounds[1])
+        if low > high:
+            low = high = None
+    if low is None:
+        print(f"{step}: nothing to do")
+        return 0
+    done = set() if run_id is None else finished_chunks(session, run_id, step)
+    chunks = []
+    for start, end in chunk_ranges(low, high, chunk_size):
+        if start in done:
+            print(f"{step}: chunk {start}-{end} already finished")
+        else:
+            chunks.append((start, end))
+
+    if workers <= 1:
+        return sum(
+            run_chunk(session, step, body, start, end, run_id, retries) or 0
+            for start, end in chunks
+        )
+
+    def run_in_own_session(chunk):
+        start, end = chunk
+        with session_scope() as worker_session:
+            return run_chunk(
+                worker_session, step, body, start, end, run_id, retries)
+
+    # Release anything the calling session holds before the workers start.
+    session.commit()
+    scheduler = chunk_scheduler.get()
+    if scheduler is not None:
+        return sum(
+            rows or 0 for rows in scheduler.map(run_in_own_session, chunks))
+    # Every chunk runs in a copy of the calling context, which carries the
+    #  metrics of the current step (see app.instrumentation).
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(copy_context().run, run_in_own_session, chunk)
+            for chunk in chunks
+        ]
+    return sum(future.result() or 0 for future in futures)
@@ -0,0 +1,221 @@
+"""The sample_lineage closure table of the sample trees.
+
+sample_lineage holds a row (ancestor_id, descendant_id, depth) for every
+sample and each of its ancestors, including the sample itself at depth 0.
+Questions about the trees become lookups on its primary key (ancestor_id,
+descendant_id) or its index (descendant_id, depth) instead of recursive
+queries over samples.parent_id:
+
+* ancestors returns the ancestors of a sample, nearest first, and
+  top_parent the farthest one, its root.
+* descendants returns the subtree below a sample and subtree_ids a query of
+  it, which can be joined to experiment_measurements to aggregate over it.
+
+Samples never change their parent, so the table only grows.
+extend_sample_lineage adds the rows of new samples in passes.  A pass gives
+every new sample whose parent already has its rows a copy of them one level
+deeper, plus the row of the sample itself.  A new sample therefore costs as
+many rows as it is deep, and a run takes as many passes as the new part of a
+tree is deep, usually one.  Samples caught in a parent cycle or below a missing
+parent have no root and never get rows.
+"""
+from sqlalchemy import (
+    and_,
+    case,
+    exists,
+    insert,
+    literal,
+    or_,
+    select,
+    true,
+)
+
+from app.batching import CHUNK_SIZE, key_range, run_chunked
+from app.lineage import CTE, MAX_TREE_DEPTH, choose_strategy
+from app.schema import inject_session, Sample, SampleLineage
+
+LINEAGE_COLUMNS = ["ancestor_id", "descendant_id", "depth"]
+
+
+def has_row(ancestor_id, descendant_id):
+    lineage = SampleLineage.__table__
+    return exists().where(and_(
+        lineage.c.ancestor_id == ancestor_id,
+        lineage.c.descendant_id == descendant_id,
+    ))
+
+
+def walk_cte(is_new):
+    """Builds a recursive CTE of the rows of the new samples in the subtrees
+    of the new samples matching is_new whose parent already has its rows, or
+    which have no parent.
+
+    Such a sample inherits the rows of its parent one level deeper and gets
+    its own row.  The recursion then descends into the new children, every
+    row of a sample giving its children a row one level deeper and its own
+    row at depth 0 also giving them their own rows.
+    """
+    lineage = SampleLineage.__table__
+    samples = Sample.__table__
+    parent = lineage.alias("parent")
+    inherited = select([
+        parent.c.ancestor_id,
+        samples.c.id.label("descendant_id"),
+        (parent.c.depth + 1).label("depth"),
+    ]).select_from(samples.join(
+        parent, parent.c.descendant_id == samples.c.parent_id
+    )).where(is_new)
+    own = select([
+        samples.c.id.label("ancestor_id"),
+        samples.c.id.label("descendant_id"),
+        literal(0).label("depth"),
+    ]).where(and_(
+        is_new,
+        or_(
+            samples.c.parent_id.is_(None),
+            has_row(samples.c.parent_id, samples.c.parent_id),
+        ),
+    ))
+    walk = select([
+        inherited.union_all(own).alias("anchor")
+    ]).cte("walk", recursive=True)
+
+    child = samples.alias("child")
+    # Joining a row to both of these makes it yield the row of the child
+    #  itself next to the one it passes down.
+    flags = select([literal(0).label("is_own")]).union_all(
+        select([literal(1).label("is_own")])).alias("flags")
+    return walk.union_all(select([
+        case([(flags.c.is_own == 1, child.c.id)],
+             else_=walk.c.ancestor_id),
+        child.c.id,
+        case([(flags.c.is_own == 1, 0)], else_=walk.c.depth + 1),
+    ]).select_from(walk.join(
+        child, child.c.parent_id == walk.c.descendant_id
+    ).join(
+        flags, or_(flags.c.is_own == 0, walk.c.depth == 0)
+    )).where(~has_row(child.c.id, child.c.id)))
+
+
+def extend_with_cte(session, is_new):
+    """Adds the rows of the subtrees walked by walk_cte with a single
+    INSERT.  Returns the number of rows added."""
+    lineage = SampleLineage.__table__
+    dialect = session.get_bind().dialect
+    if dialect.name == "mysql" and not getattr(dialect, "_is_mariadb", False):
+        session.execute(
+            f"SET SESSION cte_max_recursion_depth = {MAX_TREE_DEPTH}")
+    walk = walk_cte(is_new)
+    return session.execute(insert(lineage).from_select(
+        LINEAGE_COLUMNS, select([walk]))).rowcount
+
+
+def extend_in_passes(session, is_new):
+    """Adds one level of the new subtrees, the samples matching is_new whose
+    parent already has its rows or which have no parent.  Returns the number
+    of rows added."""
+    lineage = SampleLineage.__table__
+    samples = Sample.__table__
+    parent = lineage.alias("parent")
+    inherited = session.execute(insert(lineage).from_select(
+        LINEAGE_COLUMNS,
+        select([
+            parent.c.ancestor_id, samples.c.id, parent.c.depth + 1
+        ]).select_from(samples.join(
+            parent, parent.c.descendant_id == samples.c.parent_id
+        )).where(is_new)
+    )).rowcount
+    # The row of the sample itself is added once it has the rows of its
+    #  parent, which the statement above may not have found yet.
+    return inherited + session.execute(insert(lineage).from_select(
+        LINEAGE_COLUMNS,
+        select([
+            samples.c.id.label("ancestor_id"),
+            samples.c.id.label("descendant_id"),
+            literal(0),
+        ]).where(and_(
+            is_new,
+            or_(
+                samples.c.parent_id.is_(None),
+                has_row(samples.c.parent_id, samples.c.id),
+            ),
+        ))
+    )).rowcount
+
+
+@inject_session
+def extend_sample_lineage(session, sample_ids=None, chunk_size=CHUNK_SIZE,
+                          workers=1):
+    """Adds the rows of the samples in sample_ids, or of all samples when it
+    is None, that are missing from sample_lineage.  It only adds missing
+    rows, so a crashed run simply repeats it.  Returns the number of rows
+    added."""
+    samples = Sample.__table__
+    if sample_ids is None:
+        window = true()
+    else:
+        window = samples.c.id.in_(sample_ids)
+    use_cte = choose_strategy(session.connection()) == CTE
+    print(f"Extending sample_lineage"
+          f" {'with a recursive CTE' if use_cte else 'in passes'}")
+
+    def extend_chunk(session, start, end):
+        is_new = and_(
+            samples.c.id.between(start, end),
+            window,
+            ~has_row(samples.c.id, samples.c.id),
+        )
+        if use_cte:
+            return extend_with_cte(session, is_new)
+        return extend_in_passes(session, is_new)
+
+    low, high = key_range(session, Sample.id, window)
+    added = 0
+    while True:
+        rows = run_chunked(session, "extend_sample_lineage", extend_chunk,
+                           low, high, chunk_size, workers=workers)
+        added += rows
+        # A walk covers whole subtrees, passes only one level of them.
+        if use_cte or not rows:
+            break
+    # NOTE:  In production code this would be changed to a logger
+    print(f"Added {added} rows to sample_lineage")
+    return added
+
+
+def ancestors(session, sample_id):
+    """Returns the ids of the ancestors of the sample, nearest first."""
+    return [ancestor_id for (ancestor_id,) in session.query(
+        SampleLineage.ancestor_id
+    ).filter(
+        SampleLineage.descendant_id == sample_id,
+        SampleLineage.depth > 0,
+    ).order_by(SampleLineage.depth)]
+
+
+def top_parent(session, sample_id):
+    """Returns the root of the tree of the sample, or None if the sample has
+    no rows, e.g. because it is part of a cycle."""
+    return session.query(SampleLineage.ancestor_id).filter(
+        SampleLineage.descendant_id == sample_id
+    ).order_by(SampleLineage.depth.desc()).limit(1).scalar()
+
+
+def subtree_ids(sample_id, max_depth=None):
+    """Returns a query of the ids of the sample and the samples below it, at
+    most max_depth levels down."""
+    lineage = SampleLineage.__table__
+    criteria = [lineage.c.ancestor_id == sample_id]
+    if max_depth is not None:
+        criteria.append(lineage.c.depth <= max_depth)
+    return select([lineage.c.descendant_id]).where(and_(*criteria))
+
+
+def descendants(session, sample_id, max_depth=None):
+    """Returns the ids of the samples below the sample, nearest first."""
+    lineage = SampleLineage.__table__
+    return [descendant_id for (descendant_id,) in session.execute(
+        subtree_ids(sample_id, max_depth).where(
+            lineage.c.depth > 0
+        ).order_by(lineage.c.depth, lineage.c.descendant_id)
+    )]
@@ -0,0 +1,42 @@
+"""Creation of empty databases for the tests and the benchmarks.
+
+A SQLite file is deleted and recreated from the models of app.schema and the
+indexes of app.indexes.  Any other database is recreated with
+./scripts/recreate_database.sh, which runs the migrations, so only point
+reset_database at a scratch database inside the etl_app container.
+"""
+import os
+import subprocess
+
+from sqlalchemy import Column, ForeignKey, Integer, Table
+from sqlalchemy.engine.url import make_url
+
+from app.indexes import ensure_indexes
+from app.schema import configure_engine, DBase
+
+
+def reset_database(url):
+    """Recreates an empty database and returns its engine."""
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite":
+        subprocess.check_call(["./scripts/recreate_database.sh"])
+        return configure_engine(str(url))
+    if url.database and os.path.exists(url.database):
+        os.remove(url.database)
+    engine = configure_engine(str(url))
+    metadata = DBase.metadata
+    metadata.create_all(engine)
+    # experiment_measurements is created by a migration rather than a model,
+    #  see versions/31cb73361b6f_added_experiment_measurements_table.py.
+    Table(
+        "experiment_measurements",
+        metadata,
+        Column("experiment_id", Integer),
+        Column("top_parent_id", Integer, ForeignKey("samples.id")),
+        Column("sample_id", Integer, ForeignKey("samples.id"),
+               primary_key=True),
+        extend_existing=True,
+    ).create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        ensure_indexes(connection)
+    return engine
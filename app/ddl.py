@@ -0,0 +1,116 @@
+"""Adding columns and indexes to tables in as few table rebuilds as
+possible.
+
+Every ALTER TABLE may copy or rebuild the whole table on MySQL, so all new
+columns, or all new indexes, are added by a single statement.  MySQL is asked
+for the cheapest algorithm it offers, falling back to more expensive ones
+when the server or the table does not support it:
+
+* INSTANT only changes the data dictionary (MySQL 8.0.12+, MariaDB 10.3.2+).
+* INPLACE rebuilds the table without blocking concurrent DML.
+* the default, which may copy the table.
+
+SQLite only accepts one ADD COLUMN per ALTER TABLE, but adding a column there
+only rewrites the schema and never touches the rows.  The statements are
+issued one after another instead, as are the CREATE INDEX statements of
+backends other than MySQL.
+"""
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateColumn
+
+# ER_ALTER_OPERATION_NOT_SUPPORTED and ER_ALTER_OPERATION_NOT_SUPPORTED_REASON
+UNSUPPORTED_ALGORITHM_ERRORS = {1845, 1846}
+
+# Secondary indexes cannot be added instantly, but are built in place.
+INDEX_ALGORITHMS = ["INPLACE", None]
+
+
+def mysql_algorithms(dialect):
+    """Returns the ALTER TABLE algorithms to try, cheapest first."""
+    version = dialect.server_version_info or ()
+    if getattr(dialect, "_is_mariadb", False):
+        instant = version >= (10, 3, 2)
+    else:
+        instant = version >= (8, 0, 12)
+    return (["INSTANT"] if instant else []) + ["INPLACE", None]
+
+
+def alter_table(connection, table_name, clauses, algorithms):
+    """Applies all clauses to the table with a single ALTER TABLE, trying
+    the MySQL algorithms in order."""
+    dialect = connection.dialect
+    table = dialect.identifier_preparer.quote(table_name)
+    statement = f"ALTER TABLE {table} {', '.join(clauses)}"
+    for algorithm in algorithms:
+        try:
+            if algorithm is None:
+                connection.execute(statement)
+            else:
+                connection.execute(f"{statement}, ALGORITHM={algorithm}")
+            return
+        except DBAPIError as e:
+            errno = getattr(e.orig, "errno", None)
+            if errno not in UNSUPPORTED_ALGORITHM_ERRORS:
+                raise
+            print(f"ALGORITHM={algorithm} is not supported, falling back")
+
+
+def add_columns(connection, table_name, columns):
+    """Adds columns, a list of Column objects, to the table."""
+    if not columns:
+        return
+    dialect = connection.dialect
+    table = dialect.identifier_preparer.quote(table_name)
+    clauses = [
+        f"ADD COLUMN {CreateColumn(column).compile(dialect=dialect)}"
+        for column in columns
+    ]
+    if dialect.name == "sqlite":
+        for clause in clauses:
+            connection.execute(f"ALTER TABLE {table} {clause}")
+        return
+
+    if dialect.name != "mysql":
+        connection.execute(f"ALTER TABLE {table} {', '.join(clauses)}")
+        return
+    alter_table(connection, table_name, clauses, mysql_algorithms(dialect))
+
+
+def add_indexes(connection, table_name, indexes):
+    """Creates indexes, a list of (name, columns) pairs, on the table.  On
+    MySQL they are built by a single ALTER TABLE, so the table is only
+    scanned once, without blocking concurrent DML."""
+    if not indexes:
+        return
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    if dialect.name != "mysql":
+        for name, columns in indexes:
+            connection.execute(
+                f"CREATE INDEX {quote(name)} ON {quote(table_name)}"
+                f" ({', '.join(quote(column) for column in columns)})")
+        return
+    alter_table(connection, table_name, [
+        f"ADD INDEX {quote(name)}"
+        f" ({', '.join(quote(column) for column in columns)})"
+        for name, columns in indexes
+    ], INDEX_ALGORITHMS)
+
+
+def drop_indexes(connection, table_name, names):
+    """Drops the indexes called names from the table."""
+    if not names:
+        return
+    dialect = connection.dialect
+    quote = dialect.identifier_preparer.quote
+    if dialect.name != "mysql":
+        for name in names:
+            if dialect.name == "sqlite":
+                connection.execute(f"DROP INDEX {quote(name)}")
+            else:
+                connection.execute(
+                    f"DROP INDEX {quote(name)} ON {quote(table_name)}")
+        return
+    alter_table(connection, table_name, [
+        f"DROP INDEX {quote(name)}" for name in names
+    ], INDEX_ALGORITHMS)
@@ -2,194 +2,519 @@
 This pipeline moves data from the samples and sample_measurements table
 into the experiment_measurement table.
 
-This requires 5 steps:
+This requires 6 steps:
 * add_measurement_columns
 * add_samples_and_experiments
 * add_values
 * set_top_parents_of_root_nodes
 * set_top_parents_adjacent
+* update_rollups
 
-Future work involves assigning each of these functions to Airflow Operators.
+app.tasks exposes each of these functions as a task for Airflow Operators.
 
-The DAG for such airflow operators should look like this:
+The DAG for such airflow operators looks like this:
     [add_measurement_columns, add_samples_and_experiments]
     >> add_values
     >> set_top_parents_of_root_nodes
     >> set_top_parents_adjacent
+    >> update_rollups
+
+extend_sample_lineage, which maintains the sample_lineage closure table (see
+app.closure), only reads the samples and runs alongside the first steps.
+update_rollups maintains the rollup tables per experiment and per sample tree
+(see app.rollups).
+
+app.async_runner runs the same steps from an asyncio event loop.
 """
-from alembic.runtime.migration import MigrationContext
-from alembic.operations import Operations
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import partial
+
+from sqlalchemy import (
+    update,
+    select,
+    and_,
+    case,
+    func,
+    join,
+)
 
-from sqlalchemy import insert, Column, DECIMAL, update, join, select
+from app.batching import CHUNK_SIZE, forget_chunks, key_range, run_chunked
+from app.closure import extend_sample_lineage
+from app.etl_app_side import STREAMING, load_streaming
+from app.export import export_experiment_measurements
+from app.instrumentation import RunMetrics
+from app.incremental import (
+    begin_run,
+    changed_sample_ids,
+    finish_run,
+    in_window,
+    next_run,
+    pending_sample_ids,
+)
+from app.indexes import MODE_TABLES, deferred_indexes
+from app.lineage import top_parent_resolver
+from app.lineage_index import update_lineage_index
+from app.partitions import partition_lookup, prepare_partitions
+from app.planner import plan_run, print_plan
+from app.rollups import update_rollups
+from app.storage import (
+    DYNAMIC,
+    SLOTS,
+    add_dynamic_columns,
+    assign_slots,
+    check_mode,
+    existing_measurement_columns,
+    get_model,
+)
+from app.upsert import Upsert
+from app.vectorized import VECTORIZED, transform_vectorized
+from app.verify import VerificationError, verify_experiment_measurements
 
 from app.schema import (
     inject_session,
+    get_engine,
+    session_scope,
+    MeasurementType,
     Sample,
     SampleMeasurement,
-    get_ExperimentMeasurement,
 )
 
 
+# The transforms pipeline can run with, see pipeline.
+SQL = "sql"
+
+# The steps writing the rows app.verify checks.  A run whose verification
+#  failed runs their chunks again when it is resumed.
+VERIFIED_STEPS = [
+    "add_samples_and_experiments",
+    "add_values",
+    "load_streaming",
+    "set_top_parents_of_root_nodes",
+    "set_top_parents_adjacent",
+]
+
+
 @inject_session
-def add_measurement_columns(session):
-    """Inspects all SampleMeasurements finding distinct values for
-    measurement_types, then creates new columns in the ExperimentMeasurement
-    table using an Alembic migration context."""
-    # TODO: Consider index on SampleMeasurement.measurement_types.
-    ExperimentMeasurement = get_ExperimentMeasurement()
-    measurement_types = session.query(
-        SampleMeasurement.measurement_type
-    ).distinct().all()
-    measurement_types = sorted([_ for (_, ) in measurement_types])
-
-    cols = set([f"measurement_{mt}" for mt in measurement_types])
-    new_cols = cols - set(ExperimentMeasurement.__table__.columns.keys())
-    if new_cols:
-        ctx = MigrationContext.configure(session.connection())
-        op = Operations(ctx)
-        for new_col in new_cols:
-            print(f"creating new_col: {new_col}")
-            op.add_column(
-                "experiment_measurements",
-                Column(new_col, DECIMAL(16, 6))
-            )
+def add_measurement_columns(session, mode=DYNAMIC):
+    """Looks up all known measurement_types in the measurement_types registry,
+    then makes room for the new ones in the table of the storage mode (see
+    app.storage).  In the dynamic mode the missing columns are created in the
+    ExperimentMeasurement table with a single ALTER TABLE (see app.ddl).  In
+    the slots mode the new types are assigned free slots."""
+    if mode == SLOTS:
+        assign_slots(session)
+        return
+    measurement_types = sorted([
+        _ for (_, ) in session.query(MeasurementType.measurement_type)
+    ])
+    add_dynamic_columns(session, measurement_types)
 
 
 @inject_session
-def add_samples_and_experiments(session):
-    """Finds all samples that do not have ExperimentMeasurement entries
-    associated with them and then creates the relevant entries.  It only
-    populates the sample_id and the experiment_id."""
-    ExperimentMeasurement = get_ExperimentMeasurement()
-    sample_subquery = (
-        session.query(
+def add_samples_and_experiments(session, sample_ids=None,
+                                chunk_size=CHUNK_SIZE, run_id=None,
+                                workers=1, mode=DYNAMIC):
+    """Upserts an ExperimentMeasurement entry for every sample, or for the
+    samples in sample_ids.  It only populates the sample_id and the
+    experiment_id, and only writes the entries that are missing or whose
+    experiment_id changed, so a rerun writes nothing (see app.upsert).
+    Returns the rowcount of the upserts, which on MySQL also counts the
+    rows that matched without changing."""
+    ExperimentMeasurement = get_model(mode)
+    columns = ["sample_id", "experiment_id"]
+    partition_of = partition_lookup(
+        session.connection(), ExperimentMeasurement.__table__.name)
+
+    def upsert_chunk(session, start, end):
+        samples = select([
             Sample.id,
             Sample.experiment
-        ).filter(
-            ~Sample.id.in_(
-                session.query(
-                    ExperimentMeasurement.sample_id
-                )
-            )
-        )
-    )
-    fields = [
-        ExperimentMeasurement.sample_id,
-        ExperimentMeasurement.experiment_id
-    ]
-    insert_stmt = insert(
-        ExperimentMeasurement
-    ).from_select(fields, sample_subquery)
+        ]).where(and_(
+            Sample.id.between(start, end),
+            in_window(Sample.id, sample_ids),
+        ))
+        return session.execute(Upsert(
+            ExperimentMeasurement.__table__,
+            columns,
+            samples,
+            index_elements=["sample_id"],
+            update_columns=["experiment_id"],
+            only_changed=True,
+            partition=partition_of(start, end),
+        )).rowcount
 
-    session.execute(insert_stmt)
-    session.commit()
+    low, high = key_range(session, Sample.id, in_window(Sample.id, sample_ids))
+    return run_chunked(session, "add_samples_and_experiments", upsert_chunk,
+                       low, high, chunk_size, run_id, workers)
 
 
 @inject_session
-def add_values(session):
-    """Gets values form the SampleMeasurement table for all new
-    ExperimentMeasurements.  This new values are assumed to be ones that
-    do not yet have their top_parent set."""
-    ExperimentMeasurement = get_ExperimentMeasurement()
-    new_measurements = session.query(
-        ExperimentMeasurement.sample_id
-    ).filter(ExperimentMeasurement.top_parent_id.is_(None))
-
-    # NOTE:  In production code this would be changed to a logger
-    print(f"Populating {new_measurements.count()} new measurements")
-
-    # This is the only query that should incur network traffic in this step
-    measurement_types = session.query(
-        SampleMeasurement.measurement_type
-    ).filter(
-        SampleMeasurement.sample_id.in_(new_measurements)
-    ).distinct()
-
-    # By populating the values by measurement type, it is possible to do
-    #  all the value copying in the database without incurring any network
-    #  with data in it.  This should be acceptable assuming that the number
-    #  of measurement_types is proportional to the log of the number of
-    #  measurements or lower.
-    for (mt,) in measurement_types:
-        print(f"Populating values for {mt} measurement_type")
-        measurement_values = select([
+def add_values(session, sample_ids=None, chunk_size=CHUNK_SIZE, run_id=None,
+               workers=1, mode=DYNAMIC):
+    """Gets values form the SampleMeasurement table for the
+    ExperimentMeasurements of the samples in sample_ids, or of all samples
+    with measurements when it is None.
+
+    The values are pivoted with conditional aggregation, one
+    MAX(CASE WHEN measurement_type = ... THEN value END) column per
+    measurement_type grouped by sample_id, and written with one upsert per
+    chunk of sample ids.  Each chunk reads sample_measurements once no matter
+    how many measurement_types there are.  Only the rows whose values changed
+    are written, so a rerun, e.g. after a partial failure, writes nothing
+    for the chunks that already finished.  Returns the rowcount of the
+    upserts, which on MySQL also counts the rows that matched without
+    changing (see app.upsert)."""
+    ExperimentMeasurement = get_model(mode)
+    window = in_window(SampleMeasurement.sample_id, sample_ids)
+
+    low, high = key_range(session, SampleMeasurement.sample_id, window)
+    if low is None:
+        # NOTE:  In production code this would be changed to a logger
+        print("Populating 0 new measurements")
+        return 0
+    print(f"Populating new measurements for sample ids {low} to {high}")
+
+    # Types registered after add_measurement_columns ran have no column yet,
+    #  they are left to the next run.
+    existing = existing_measurement_columns(
+        session, ExperimentMeasurement.__table__, mode)
+    measurement_types = sorted([
+        mt for (mt,) in session.query(
+            SampleMeasurement.measurement_type
+        ).filter(window).distinct()
+        if mt in existing
+    ])
+    print(f"Populating values for {len(measurement_types)} measurement_types")
+
+    column_names = {mt: existing[mt] for mt in measurement_types}
+    pivot_columns = [
+        func.max(case(
+            [(SampleMeasurement.measurement_type == mt,
+              SampleMeasurement.value)]
+        )).label(column_names[mt])
+        for mt in measurement_types
+    ]
+    columns = ["sample_id", "experiment_id"] + [
+        column_names[mt] for mt in measurement_types]
+    partition_of = partition_lookup(
+        session.connection(), ExperimentMeasurement.__table__.name)
+
+    def upsert_chunk(session, start, end):
+        pivot = select([
             SampleMeasurement.sample_id,
-            SampleMeasurement.value
-        ]).where(
-            SampleMeasurement.measurement_type == mt
-        ).alias()
+            Sample.experiment,
+            *pivot_columns
+        ]).select_from(
+            join(SampleMeasurement, Sample,
+                 SampleMeasurement.sample_id == Sample.id)
+        ).where(and_(
+            SampleMeasurement.sample_id.between(start, end),
+            window,
+        )).group_by(SampleMeasurement.sample_id, Sample.experiment)
 
-        update_stmt = update(
-            ExperimentMeasurement
-        ).where(
-            ExperimentMeasurement.sample_id
-            ==
-            measurement_values.columns.sample_id
-        ).values(**{f"measurement_{mt}": measurement_values.columns.value})
+        return session.execute(Upsert(
+            ExperimentMeasurement.__table__,
+            columns,
+            pivot,
+            index_elements=["sample_id"],
+            update_columns=columns[2:],
+            only_changed=True,
+            partition=partition_of(start, end),
+        )).rowcount
 
-        session.execute(update_stmt)
-        session.commit()
+    return run_chunked(session, "add_values", upsert_chunk,
+                       low, high, chunk_size, run_id, workers)
 
 
 @inject_session
-def set_top_parents_of_root_nodes(session):
+def set_top_parents_of_root_nodes(session, chunk_size=CHUNK_SIZE,
+                                  run_id=None, workers=1, mode=DYNAMIC):
     """Sets top parent values over experiment_measurements whose sample has no
     parent.  These are experiment_measurements whose top parent is also its
-    sample."""
-    ExperimentMeasurement = get_ExperimentMeasurement()
-    root_samples = session.query(ExperimentMeasurement.sample_id).filter(
-        ExperimentMeasurement.sample_id == Sample.id,
-        ExperimentMeasurement.top_parent_id.is_(None),
-        Sample.parent_id.is_(None)
-    )
-    update_stmt = update(ExperimentMeasurement).where(
-        ExperimentMeasurement.sample_id.in_(root_samples)
-    ).values(
-        top_parent_id=ExperimentMeasurement.sample_id
-    )
-    session.execute(update_stmt)
-    session.commit()
+    sample.  Returns the number of rows written."""
+    ExperimentMeasurement = get_model(mode)
+    is_unresolved = ExperimentMeasurement.top_parent_id.is_(None)
+
+    def update_chunk(session, start, end):
+        root_samples = session.query(Sample.id).filter(
+            Sample.id.between(start, end),
+            Sample.parent_id.is_(None)
+        )
+        update_stmt = update(ExperimentMeasurement).where(and_(
+            ExperimentMeasurement.sample_id.between(start, end),
+            is_unresolved,
+            ExperimentMeasurement.sample_id.in_(root_samples),
+        )).values(
+            top_parent_id=ExperimentMeasurement.sample_id
+        )
+        return session.execute(update_stmt).rowcount
+
+    low, high = key_range(
+        session, ExperimentMeasurement.sample_id, is_unresolved)
+    return run_chunked(session, "set_top_parents_of_root_nodes",
+                       update_chunk, low, high, chunk_size, run_id, workers)
 
 
 @inject_session
-def set_top_parents_adjacent(session):
-    """Iteratively sets the top parents of experiment_measurements whose
-    samples have parents with top parents.  This should be able to handle
-    deeper trees than the specification requires."""
-    ExperimentMeasurement = get_ExperimentMeasurement()
-    subquery = select([
-        Sample.id,
-        ExperimentMeasurement.top_parent_id
-    ]).select_from(
-        join(
-            Sample,
-            ExperimentMeasurement,
-            Sample.parent_id == ExperimentMeasurement.sample_id
-        )
-    ).where(ExperimentMeasurement.top_parent_id.isnot(None)).alias()
+def set_top_parents_adjacent(session, strategy=None, chunk_size=CHUNK_SIZE,
+                             run_id=None, workers=1, mode=DYNAMIC):
+    """Sets the top parents of all remaining experiment_measurements in a
+    single pass over the sample trees.  The work done grows with the number
+    of samples rather than with the depth of the trees, so arbitrarily deep
+    lineages are handled.  See app.lineage for the available strategies.
+
+    The chunks only cover the sample ids of the rows without a top parent,
+    which after an incremental run are the samples of its window.  Returns
+    the number of rows written."""
+    ExperimentMeasurement = get_model(mode)
+    low, high = key_range(
+        session, ExperimentMeasurement.sample_id,
+        ExperimentMeasurement.top_parent_id.is_(None))
+    resolve = None
+    if low is not None:
+        resolve = top_parent_resolver(
+            session, ExperimentMeasurement, strategy)
+    return run_chunked(session, "set_top_parents_adjacent", resolve,
+                       low, high, chunk_size, run_id, workers)
+
+
+def run_step(metrics, step, **kwargs):
+    """Runs step, recording its metrics under its name."""
+    with metrics.step(step.__name__):
+        return step(**kwargs)
+
+
+def run_planned(plan, metrics, step, **kwargs):
+    """Runs step like run_step unless the plan found no work for it."""
+    if plan.skips(step.__name__):
+        # NOTE:  In production code this would be changed to a logger
+        print(f"Skipping {step.__name__}, it has no work")
+        return None
+    return run_step(metrics, step, **kwargs)
 
-    update_stmt = update(ExperimentMeasurement).where(
-        ExperimentMeasurement.sample_id == subquery.columns.id
-    ).values(top_parent_id=subquery.columns.top_parent_id)
 
-    ems_with_no_top_parent = (
-        session
-        .query(ExperimentMeasurement)
-        .filter(ExperimentMeasurement.top_parent_id.is_(None))
-    )
-    while ems_with_no_top_parent.count():
-        session.execute(update_stmt)
-        session.commit()
+def run_concurrently(*steps):
+    """Runs independent steps, each a callable without arguments, at the same
+    time and waits for all of them."""
+    with ThreadPoolExecutor(max_workers=len(steps)) as pool:
+        futures = [
+            pool.submit(copy_context().run, step) for step in steps
+        ]
+    for future in futures:
+        future.result()
+
+
+def check_options(mode, transform, incremental):
+    """Rejects pipeline options that cannot be combined."""
+    check_mode(mode)
+    if transform not in (SQL, VECTORIZED, STREAMING):
+        raise ValueError(f"unknown transform {transform!r}")
+    if transform == VECTORIZED and incremental:
+        raise ValueError("the vectorized transform only supports full runs")
+
+
+def start_incremental_run():
+    """Begins an incremental run, returning its id and the query of the
+    sample ids in its window."""
+    with session_scope() as session:
+        run = begin_run(session)
+        return run.id, changed_sample_ids(run)
+
+
+def plan_pipeline(incremental, mode, transform):
+    """Plans the next run (see app.planner) and begins it when it is an
+    incremental run with work or an unfinished run, which is always resumed
+    so it gets finished.  Returns the plan, the id of the run and the query
+    of the sample ids in its window, the latter two None for a full run or a
+    new run without work."""
+    with session_scope() as session:
+        run = next_run(session) if incremental else None
+        plan = plan_run(session, run, mode, transform)
+        if run is None or (run.id is None and not plan.has_work):
+            return plan, None, None
+        run = begin_run(session, run)
+        return plan, run.id, changed_sample_ids(run)
+
+
+@inject_session
+def dry_run(session, incremental=True, mode=DYNAMIC, transform=SQL):
+    """Prints the plan of the run pipeline would start with these options,
+    without starting it.  Returns the plan."""
+    check_options(mode, transform, incremental)
+    run = next_run(session) if incremental else None
+    plan = plan_run(session, run, mode, transform)
+    print_plan(session.connection(), plan)
+    return plan
+
+
+def fail_verification(report, run_id=None):
+    """Raises the VerificationError of report.  The run, if any, is left
+    unfinished, and its verified steps run all their chunks again when it is
+    resumed."""
+    if run_id is not None:
+        with session_scope() as session:
+            forget_chunks(session, run_id, VERIFIED_STEPS)
+    raise VerificationError(report)
+
+
+def export_tag(run_id):
+    """Tags the files exported by a run, see app.export."""
+    return "full" if run_id is None else f"run-{run_id}"
+
+
+def pipeline(incremental=True, chunk_size=CHUNK_SIZE, workers=1,
+             mode=DYNAMIC, export_directory=None, transform=SQL,
+             report_path=None, explain=False, verify=False,
+             defer_indexes=False, lineage_index=None):
+    """This runs the entire etl pipeline following the DAG described above.
+    Every step except add_measurement_columns, which only issues DDL, runs in
+    chunks of chunk_size sample ids (see app.batching).
+
+    With more than one worker the independent steps add_measurement_columns,
+    extend_sample_lineage and add_samples_and_experiments run at the same
+    time, and every step fans its chunks out to up to workers connections.
+
+    mode picks the table the measurements are flattened into, see
+    app.storage.  The watermark is shared by both modes, so switching the
+    mode of an existing deployment requires a full run.
+
+    transform picks how the data is transformed.  SQL runs the steps above
+    inside the database.  VECTORIZED replaces the steps after
+    add_measurement_columns by the in-memory transform of app.vectorized,
+    which rebuilds the whole table and therefore only supports full runs.
+    STREAMING replaces add_samples_and_experiments and add_values by the
+    streaming load of app.etl_app_side, which pivots the measurements in
+    the application with constant memory.
+
+    With defer_indexes the deferrable indexes of the table of the storage
+    mode are dropped while the steps load it and rebuilt before it is
+    verified or exported (see app.indexes).  This pays off for full runs,
+    which rewrite most of the table.
+
+    When export_directory is given the rows written by the run are exported
+    to Parquet files in it as a last step (see app.export).
+
+    When lineage_index is given the lineage index file at that path gets the
+    samples added since it was written (see app.lineage_index).
+
+    Every step prints its metrics as a line of JSON (see
+    app.instrumentation).  They are also written to report_path when it is
+    given.  explain adds the EXPLAIN plan of every statement.
+
+    With verify the rows written by the run are checked against the source
+    tables before they are exported and the run is finished (see
+    app.verify).  Mismatches raise a VerificationError, which leaves an
+    incremental run unfinished, to be rewritten when it is resumed.  Samples
+    that changed after the run began are left to the next run.
+
+    Incremental runs only touch the samples that are new or received
+    measurements since the last finished run (see app.incremental).  Their
+    finished chunks are recorded so a crashed run resumes where it stopped.
+    A full run rescans both source tables.
+
+    A partitioned table gets the partitions of the new samples before any
+    step writes to it (see app.partitions).
+
+    The run is planned first (see app.planner).  Steps without work are
+    skipped, and a new run where no step has any returns right away,
+    without starting an incremental run, verifying, exporting or writing a
+    report."""
+    check_options(mode, transform, incremental)
+    plan, run_id, sample_ids = plan_pipeline(incremental, mode, transform)
+    if run_id is None and not plan.has_work:
+        # NOTE:  In production code this would be changed to a logger
+        print("Nothing to do")
+        return
+    prepare_partitions(MODE_TABLES[mode])
+    options = {"chunk_size": chunk_size, "workers": workers, "mode": mode}
+    if incremental:
+        options["run_id"] = run_id
+
+    metrics = RunMetrics(explain=explain)
+    run = partial(run_planned, plan, metrics)
+    report = None
+    with metrics.installed(get_engine()):
+        tables = [MODE_TABLES[mode]] if defer_indexes else []
+        with deferred_indexes(get_engine(), tables):
+            independent_steps = [
+                partial(run, add_measurement_columns, mode=mode),
+                partial(run, extend_sample_lineage, sample_ids=sample_ids,
+                        chunk_size=chunk_size, workers=workers),
+            ]
+            if transform == SQL:
+                independent_steps.append(
+                    partial(run, add_samples_and_experiments,
+                            sample_ids=sample_ids, **options))
+            if workers > 1:
+                run_concurrently(*independent_steps)
+            else:
+                for step in independent_steps:
+                    step()
+            if transform == VECTORIZED:
+                run(transform_vectorized, **options)
+            elif transform == STREAMING:
+                run(load_streaming, sample_ids=sample_ids, **options)
+            else:
+                run(add_values, sample_ids=sample_ids, **options)
+            if transform != VECTORIZED:
+                run(set_top_parents_of_root_nodes, **options)
+                run(set_top_parents_adjacent, **options)
+            run(update_rollups, **options)
+        if verify:
+            report = run_step(
+                metrics,
+                verify_experiment_measurements,
+                sample_ids=sample_ids,
+                mode=mode,
+                chunk_size=chunk_size,
+                pending=pending_sample_ids() if incremental else None,
+            )
+        # Rows that failed the verification are not exported.
+        if export_directory is not None and (report is None or report.ok):
+            run_step(
+                metrics,
+                export_experiment_measurements,
+                directory=export_directory,
+                sample_ids=sample_ids,
+                tag=export_tag(run_id),
+                mode=mode,
+            )
+        if lineage_index is not None:
+            run_step(metrics, update_lineage_index, path=lineage_index,
+                     sample_ids=sample_ids)
+    if report_path is not None:
+        metrics.write(report_path)
+    if report is not None and not report.ok:
+        fail_verification(report, run_id if incremental else None)
+
+    if incremental:
+        with session_scope() as session:
+            finish_run(session, run_id)
 
 
-def pipeline():
-    """This runs the entire etl pipeline as one series of function calls."""
-    add_measurement_columns()
-    add_samples_and_experiments()
-    add_values()
-    set_top_parents_of_root_nodes()
-    set_top_parents_adjacent()
+def main():
+    parser = argparse.ArgumentParser(description="Runs the etl pipeline.")
+    parser.add_argument(
+        "--dry-run", action="store_true",
+        help="print the planned steps instead of running them")
+    parser.add_argument(
+        "--full", action="store_true", help="rescan all samples")
+    parser.add_argument("--mode", default=DYNAMIC, choices=[DYNAMIC, SLOTS])
+    parser.add_argument(
+        "--transform", default=SQL, choices=[SQL, VECTORIZED, STREAMING])
+    args = parser.parse_args()
+    options = {
+        "incremental": not args.full,
+        "mode": args.mode,
+        "transform": args.transform,
+    }
+    if args.dry_run:
+        dry_run(**options)
+    else:
+        pipeline(**options)
 
 
 if __name__ == "__main__":
-    pipeline()
+    main()
@@ -1,134 +1,185 @@
 """
-This file represents my first approach.  I ended up rejecting this approach
- because I decided that it would be desirable to push more of the logic
- into the sql scripts themselves.  This would reduce network traffic to and
- from the mysql server.
+The app side transform streams the measurements through the application
+instead of moving them inside the database.  It replaces the
+add_samples_and_experiments and add_values steps of app.etl when the
+pipeline runs with transform=STREAMING, which keeps the statements the
+database runs simple and short if the SQL steps lock too much.
+
+This was my first approach, which materialized a whole range of
+measurements and the mappings built from them in memory.  Now the memory
+used stays constant no matter how many rows are processed:
+
+* every chunk of sample ids (see app.batching) is read through a streaming
+  cursor, fetch_size rows at a time, ordered by sample_id.  The rows of a
+  sample are adjacent, so the pivot only holds the sample it is building.
+* the pivoted samples are written flush_size at a time, with one
+  executemany INSERT for the new rows and one executemany UPDATE for the
+  existing ones.  The MySQL drivers send the INSERT as multi-row
+  statements, see app.config.  Like the upserts of the SQL steps the UPDATE
+  skips the rows whose values did not change.
+
+The rows written are the same as those of the SQL steps: every sample gets a
+row with its experiment_id, and the values of its measurements, the largest
+one when a sample has several of a type.
 """
+from itertools import islice
+
+from sqlalchemy import (
+    and_,
+    bindparam,
+    insert,
+    or_,
+    outerjoin,
+    select,
+    true,
+)
 
-from collections import defaultdict
-
-from alembic.runtime.migration import MigrationContext
-from alembic.operations import Operations
-from sqlalchemy import Column, DECIMAL
-from sqlalchemy.sql.expression import update
-
+from app.batching import CHUNK_SIZE, key_range, run_chunked
 from app.schema import (
+    inject_session,
     Sample,
     SampleMeasurement,
-    get_ExperimentMeasurement,
-    session_scope
 )
-
-
-def add_measurement_columns(start: int, end: int, session):
-    assert start <= end
-
-    ExperimentMeasurement = get_ExperimentMeasurement()
-    # Get all the distinct measurement types in the batch that this function
-    #  call is responsible for extracting
-    measurement_types = sorted([
-        _ for (_,) in session.query(
-            SampleMeasurement.measurement_type
-        ).filter(
-            SampleMeasurement.sample_id >= start,
-            SampleMeasurement.sample_id <= end
-        ).distinct().all()  # Don't transmit any more than you have to.
-    ])
-    cols = set([f"measurement_{mt}" for mt in measurement_types])
-    new_cols = cols - set(ExperimentMeasurement.__table__.columns.keys())
-    if new_cols:
-        ctx = MigrationContext.configure(session.connection())
-        op = Operations(ctx)
-        for new_col in new_cols:
-            print(f"creating new_col: {new_col}")
-            op.add_column(
-                "experiment_measurements",
-                Column(new_col, DECIMAL(16, 6))
-            )
-
-
-def add_update_measurement(start, end, session):
-    ExperimentMeasurement = get_ExperimentMeasurement()
-
-    # Get all the sample measurements for the sample id range
-    sample_measurements = (
-        session.query(
-            SampleMeasurement.sample_id,
+from app.storage import DYNAMIC, existing_measurement_columns, get_model
+
+# The transform of app.etl.pipeline that runs load_streaming.
+STREAMING = "streaming"
+
+# Number of rows fetched from the cursor at a time.
+FETCH_SIZE = 10000
+
+# Number of samples written per executemany.
+FLUSH_SIZE = 5000
+
+
+def stream_rows(result, fetch_size=FETCH_SIZE):
+    """Yields the rows of result, fetching fetch_size at a time."""
+    try:
+        while True:
+            rows = result.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        result.close()
+
+
+def pivot_rows(rows, column_names):
+    """Turns (sample_id, experiment_id, measurement_type, value) rows sorted
+    by sample_id into one mapping per sample.  Samples without measurements
+    come with a NULL measurement_type."""
+    mapping = None
+    for sample_id, experiment_id, measurement_type, value in rows:
+        if mapping is None or mapping["sample_id"] != sample_id:
+            if mapping is not None:
+                yield mapping
+            mapping = {"sample_id": sample_id, "experiment_id": experiment_id}
+        if measurement_type is None or value is None:
+            continue
+        column = column_names[measurement_type]
+        # Like MAX in the pivot of app.etl.add_values.
+        if mapping.get(column) is None or value > mapping[column]:
+            mapping[column] = value
+    if mapping is not None:
+        yield mapping
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def write_mappings(session, table, mappings):
+    """Inserts the mappings of new samples and updates the existing ones.
+    Returns the number of rows written."""
+    columns = set()
+    for mapping in mappings:
+        columns.update(mapping)
+    # executemany needs the same keys in every mapping.  The missing values
+    #  are NULL, as in the pivot of app.etl.add_values.
+    columns = sorted(columns - {"sample_id"})
+    for mapping in mappings:
+        for column in columns:
+            mapping.setdefault(column, None)
+
+    existing = set(sample_id for (sample_id,) in session.execute(
+        select([table.c.sample_id]).where(table.c.sample_id.between(
+            mappings[0]["sample_id"], mappings[-1]["sample_id"]))))
+    updates = [
+        dict(mapping, b_sample_id=mapping["sample_id"])
+        for mapping in mappings if mapping["sample_id"] in existing
+    ]
+    inserts = [
+        mapping for mapping in mappings
+        if mapping["sample_id"] not in existing
+    ]
+    if inserts:
+        session.execute(insert(table), inserts)
+    if updates:
+        session.execute(table.update().where(and_(
+            table.c.sample_id == bindparam("b_sample_id"),
+            or_(*[
+                table.c[column].is_distinct_from(bindparam(column))
+                for column in columns
+            ]),
+        )).values({column: bindparam(column) for column in columns}), updates)
+    return len(mappings)
+
+
+@inject_session
+def load_streaming(session, sample_ids=None, chunk_size=CHUNK_SIZE,
+                   run_id=None, workers=1, mode=DYNAMIC,
+                   fetch_size=FETCH_SIZE, flush_size=FLUSH_SIZE):
+    """Writes the rows of the samples in sample_ids, or of all samples when
+    it is None, to the table of the storage mode.  The measurement columns
+    must exist already, see app.etl.add_measurement_columns."""
+    ExperimentMeasurement = get_model(mode)
+    table = ExperimentMeasurement.__table__
+    column_names = existing_measurement_columns(session, table, mode)
+    if sample_ids is None:
+        window = true()
+    else:
+        window = Sample.id.in_(sample_ids)
+
+    def load_chunk(session, start, end):
+        query = select([
+            Sample.id,
+            Sample.experiment,
             SampleMeasurement.measurement_type,
             SampleMeasurement.value,
-        )
-        .filter(SampleMeasurement.sample_id >= start)
-        .filter(SampleMeasurement.sample_id <= end)
-    )
-
-    # Flatten the measurement types (i.e. pivot the data)
-    experiment_measurement_dicts = defaultdict(dict)
-    for sample_id, measurement_type, value in sample_measurements:
-        experiment_measurement_dicts[sample_id][
-            f"measurement_{measurement_type}"
-        ] = value
-
-    # Get the experiment measurements that are already in the database
-    # for this range. These will be updated rather than inserted.
-    existing_sample_ids = [
-        sample_id
-        for (sample_id,) in session.query(ExperimentMeasurement.sample_id)
-        .filter(ExperimentMeasurement.sample_id >= start)
-        .filter(ExperimentMeasurement.sample_id <= end)
-        .all()
-    ]
-
-    # Bulk update ExperimentMeasurement
-    mappings = []
-    for sample_id in existing_sample_ids:
-        mapping = {"sample_id": sample_id}
-        for measurement_col, measurement_val in experiment_measurement_dicts[
-            sample_id
-        ].items():
-            mapping[measurement_col] = measurement_val
-        mappings.append(mapping)
-    session.bulk_update_mappings(ExperimentMeasurement, mappings)
-
-    # Bulk add remaining values to ExperimentMeasurements
-    mappings = []
-    for sample_id in set(experiment_measurement_dicts.keys()) - set(
-        existing_sample_ids
-    ):
-        mapping = {"sample_id": sample_id}
-        for measurement_col, measurement_val in experiment_measurement_dicts[
-            sample_id
-        ].items():
-            mapping[measurement_col] = measurement_val
-        mappings.append(mapping)
-    session.bulk_insert_mappings(ExperimentMeasurement, mappings)
-
-
-def update_experiment(start, end, session):
-    ExperimentMeasurement = get_ExperimentMeasurement()
-    _sample_id = ExperimentMeasurement.sample_id
-    session.execute(
-        update(
-            ExperimentMeasurement
-        ).where(
-            _sample_id == Sample.id
-            and start <= _sample_id <= end
-        ).values(experiment_id=Sample.experiment)
-    )
-
-
-def pipeline(start, end):
-    with session_scope() as session:
-        add_measurement_columns(start, end, session)
-    with session_scope() as session:
-        add_update_measurement(start, end, session)
-    with session_scope() as session:
-        update_experiment(start, end, session)
-
-
-raise DeprecationWarning(
-    "etl_app_side is deprecated.  It remains as demonstration of an initial "
-    "approach to using the more python focused etl steps.  If it's determined "
-    "that the SQL approach locks the database too much or creates too much "
-    "risk or requires too much locking, then this approach can be revisited "
-    "as a potential solution."
-)
+        ]).select_from(
+            outerjoin(Sample, SampleMeasurement, and_(
+                SampleMeasurement.sample_id == Sample.id,
+                SampleMeasurement.measurement_type.in_(list(column_names)),
+            ))
+        ).where(and_(
+            Sample.id.between(start, end),
+            window,
+        )).order_by(Sample.id)
+
+        # MySQL cannot run the writes on the connection of an open
+        #  streaming cursor, so it is read on a connection of its own.
+        separate = session.get_bind().dialect.name == "mysql"
+        reader = (
+            session.get_bind().connect() if separate
+            else session.connection())
+        try:
+            result = reader.execution_options(
+                stream_results=True).execute(query)
+            written = 0
+            for mappings in batches(pivot_rows(
+                    stream_rows(result, fetch_size), column_names),
+                    flush_size):
+                written += write_mappings(session, table, mappings)
+        finally:
+            if separate:
+                reader.close()
+        return written
+
+    low, high = key_range(session, Sample.id, window)
+    return run_chunked(session, "load_streaming", load_chunk,
+                       low, high, chunk_size, run_id, workers)
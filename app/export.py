@@ -0,0 +1,222 @@
+"""Export of the flattened measurements to Parquet for columnar analytics.
+
+The table is read through a streaming cursor in batches of batch_size rows,
+so the memory used stays bounded no matter how big the table is.  Each batch
+becomes an Arrow record batch that is appended to a Parquet file of the
+experiment it belongs to:
+
+    <directory>/experiment_id=<experiment_id>/part-<tag>.parquet
+
+Like any hive partitioned dataset the files leave out the experiment_id
+column, which readers take from the directory name.  Rows without an
+experiment go to the __HIVE_DEFAULT_PARTITION__ directory, which readers
+take as NULL.  Rows are read ordered by experiment_id, so only one file is
+open at a time.
+Files are written under a temporary name and renamed once complete, so a
+rerun of the same export replaces them instead of adding duplicates.
+
+When run by the pipeline the export is incremental: it only writes the rows
+of the samples inside the window of the run, tagged with the id of the run.
+A sample that changes in a later run is written again by that run, so readers
+should keep the row of the highest run per sample_id.  A full export, tagged
+full, replaces the whole dataset once it is complete, removing the files of
+earlier exports.  Its rows are therefore older than those of every run
+beside it and rank below them.
+
+An export can also be written to a staging directory first and published
+into its directory afterwards, e.g. once the rows passed their verification.
+Readers skip directories starting with a dot, so STAGING_PREFIX keeps staged
+files out of the dataset.
+
+pyarrow is only needed for this stage and is imported lazily.
+"""
+import os
+import shutil
+
+from sqlalchemy import Integer, Numeric, select
+
+from app.schema import inject_session
+from app.storage import DYNAMIC, get_model
+
+# Number of rows fetched from the cursor and written per record batch.
+EXPORT_BATCH_SIZE = 50000
+
+STAGING_PREFIX = ".staging-"
+
+PARTITION_PREFIX = "experiment_id="
+
+# The partition of the rows without an experiment_id.
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "Exporting to Parquet requires pyarrow, install it with"
+            " `pip install pyarrow`")
+    return pyarrow, pyarrow.parquet
+
+
+def arrow_schema(pa, columns):
+    """Returns the Arrow schema matching the table columns."""
+    fields = []
+    for column in columns:
+        if isinstance(column.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column.type, Numeric) and column.type.scale:
+            arrow_type = pa.decimal128(
+                column.type.precision, column.type.scale)
+        else:
+            arrow_type = pa.float64()
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+def record_batch(pa, schema, rows):
+    """Builds a record batch from rows, which are tuples starting with the
+    columns of schema."""
+    arrays = []
+    for position, field in enumerate(schema):
+        values = [row[position] for row in rows]
+        # Drivers return Decimals or floats depending on the backend, so
+        #  the values are converted after Arrow picked its own type.
+        arrays.append(pa.array(values).cast(field.type, safe=False))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class PartitionWriter:
+    """Writes record batches to one Parquet file per experiment_id."""
+
+    def __init__(self, pa, pq, directory, schema, tag):
+        self.pa = pa
+        self.pq = pq
+        self.directory = directory
+        self.schema = schema
+        self.tag = tag
+        self.experiment_id = None
+        self.writer = None
+        self.path = None
+        self.paths = set()
+
+    def switch(self, experiment_id):
+        if self.writer is not None and experiment_id == self.experiment_id:
+            return
+        self.close()
+        if experiment_id is None:
+            experiment_id = DEFAULT_PARTITION
+        partition = os.path.join(
+            self.directory, f"{PARTITION_PREFIX}{experiment_id}")
+        os.makedirs(partition, exist_ok=True)
+        self.experiment_id = experiment_id
+        self.path = os.path.join(partition, f"part-{self.tag}.parquet")
+        self.writer = self.pq.ParquetWriter(f"{self.path}.tmp", self.schema)
+
+    def write(self, batch):
+        self.writer.write_table(
+            self.pa.Table.from_batches([batch], schema=self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(f"{self.path}.tmp", self.path)
+            self.paths.add(self.path)
+        self.writer = None
+
+    def abort(self):
+        """Discards the file being written."""
+        if self.writer is not None:
+            self.writer.close()
+            os.remove(f"{self.path}.tmp")
+        self.writer = None
+
+
+@inject_session
+def export_experiment_measurements(session, directory, sample_ids=None,
+                                   tag="full", mode=DYNAMIC,
+                                   batch_size=EXPORT_BATCH_SIZE):
+    """Streams the table of the storage mode into Parquet files under
+    directory, partitioned by experiment_id.  When sample_ids is given only
+    the rows of those samples are exported, otherwise the files of earlier
+    exports are removed once the export is complete.  Returns the number of
+    rows written."""
+    pa, pq = import_pyarrow()
+    table = get_model(mode).__table__
+    columns = [c for c in table.columns if c.name != "experiment_id"]
+    schema = arrow_schema(pa, columns)
+    # The experiment_id is selected last, after the columns of the schema.
+    experiment_position = len(columns)
+
+    query = select(columns + [table.c.experiment_id]).order_by(
+        table.c.experiment_id, table.c.sample_id)
+    if sample_ids is not None:
+        query = query.where(table.c.sample_id.in_(sample_ids))
+    result = session.connection().execution_options(
+        stream_results=True
+    ).execute(query)
+
+    writer = PartitionWriter(pa, pq, directory, schema, tag)
+    written = 0
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            # Split the batch wherever the experiment_id changes.
+            start = 0
+            for end in range(1, len(rows) + 1):
+                if (end == len(rows)
+                        or rows[end][experiment_position]
+                        != rows[start][experiment_position]):
+                    writer.switch(rows[start][experiment_position])
+                    writer.write(record_batch(pa, schema, rows[start:end]))
+                    start = end
+            written += len(rows)
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        result.close()
+    writer.close()
+    if sample_ids is None:
+        remove_other_files(directory, writer.paths)
+    # NOTE:  In production code this would be changed to a logger
+    print(f"Exported {written} rows to {directory}")
+    return written
+
+
+def remove_other_files(directory, keep):
+    """Removes the files of the partitions under directory that are not in
+    keep, and the partitions left empty."""
+    for name in os.listdir(directory):
+        partition = os.path.join(directory, name)
+        if not name.startswith(PARTITION_PREFIX):
+            continue
+        for file_name in os.listdir(partition):
+            path = os.path.join(partition, file_name)
+            if path not in keep:
+                os.remove(path)
+        if not os.listdir(partition):
+            os.rmdir(partition)
+
+
+def staging_directory(directory, tag):
+    return os.path.join(directory, f"{STAGING_PREFIX}{tag}")
+
+
+def publish(staging, directory, full=False):
+    """Moves the files of an export staged in staging into directory,
+    replacing the ones of an earlier export with the same tag, and removes
+    staging.  A full export replaces all the files of directory."""
+    published = set()
+    for root, _, files in os.walk(staging):
+        target = os.path.join(directory, os.path.relpath(root, staging))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            os.replace(os.path.join(root, name), os.path.join(target, name))
+            published.add(os.path.join(target, name))
+    shutil.rmtree(staging)
+    if full:
+        remove_other_files(directory, published)
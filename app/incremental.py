@@ -0,0 +1,178 @@
+"""Watermark tracking for incremental pipeline runs.
+
+Every run is recorded in the etl_runs table together with the window of data
+it is responsible for:
+
+* samples with sample_id_low < id <= sample_id_high, i.e. new samples.
+* samples logged in sample_measurement_changes that the run claimed, i.e.
+  samples that were inserted or received new or updated measurements,
+  including late arrivals for old samples.
+
+The high marks are captured when the run begins so rows arriving while the
+run is in progress are left for the next run.  When a run finishes, its high
+marks become the watermark of the next run.  If a run crashes, the next call
+to begin_run resumes it with the same window.
+
+Auto-increment ids are assigned when a row is inserted, not when it is
+committed.  A row of a transaction that was still open when a run began can
+therefore commit later with an id below the watermark.  The log is not read
+by id for this reason.  A run claims every log row present when it begins by
+setting its run_id, and finish_run deletes the rows it claimed and no
+others.  A late row stays unclaimed until the next run.  Samples are logged
+by a trigger as well, so a late sample is picked up by the next run like a
+late measurement.  The ids of the change log only serve as estimates, see
+app.planner.
+
+next_run computes the window without starting the run, so app.planner can
+check it for work first and idle runs leave no trace in etl_runs.
+
+A rebuild of the table in a shadow table (see app.shadow) replaces the live
+table, and the rows a run writes to it meanwhile would be lost.  It is
+recorded as a run with the status REBUILDING, which begins like any other
+run.  begin_rebuild refuses to start while a run is unfinished, and
+begin_run refuses to start while a rebuild is.  Finishing the rebuild
+advances the watermark, as it rewrote everything.
+"""
+from sqlalchemy import and_, func, select, true, union
+
+from app.schema import (
+    EtlRun,
+    Sample,
+    SampleMeasurementChange,
+)
+
+
+def next_run(session):
+    """Returns the unfinished run if there is one, otherwise a new run, not
+    yet added to the session, covering everything that arrived since the
+    last finished run."""
+    unfinished = session.query(EtlRun).filter(
+        EtlRun.status == EtlRun.RUNNING
+    ).order_by(EtlRun.id.desc()).first()
+    if unfinished:
+        return unfinished
+
+    last = session.query(EtlRun).filter(
+        EtlRun.status == EtlRun.FINISHED
+    ).order_by(EtlRun.id.desc()).first()
+    sample_id_low = last.sample_id_high if last else 0
+    change_id_low = last.change_id_high if last else 0
+    return EtlRun(
+        status=EtlRun.RUNNING,
+        sample_id_low=sample_id_low,
+        sample_id_high=high_mark(session, Sample.id, sample_id_low),
+        change_id_low=change_id_low,
+        change_id_high=high_mark(
+            session, SampleMeasurementChange.id, change_id_low),
+    )
+
+
+def high_mark(session, column, low):
+    """Returns the maximum of the primary key column, which costs a single
+    index probe, but never less than the low mark.  finish_run prunes the
+    change log, so its maximum drops below the watermark whenever nothing
+    arrived since, and the watermark must never move backwards."""
+    return max(
+        session.query(func.coalesce(func.max(column), low)).scalar(), low)
+
+
+def claimed_changes(run):
+    """Returns the criteria of the change log rows of the run.  For a run
+    that has not begun yet these are the rows it would claim."""
+    if run.id is not None:
+        return SampleMeasurementChange.run_id == run.id
+    # Samples above the window are new samples of the next run.
+    return and_(
+        SampleMeasurementChange.run_id.is_(None),
+        SampleMeasurementChange.sample_id <= run.sample_id_high,
+    )
+
+
+class RunConflict(RuntimeError):
+    """Raised when a run and a rebuild of the table would overlap."""
+
+
+def begin_run(session, run=None):
+    """Starts run, by default the next_run, claiming the change log rows of
+    its window, unless it is an unfinished run, which is resumed with the
+    rows it claimed before.  Returns the run.  Raises a RunConflict while a
+    rebuild is in progress."""
+    rebuild = session.query(EtlRun).filter(
+        EtlRun.status == EtlRun.REBUILDING).first()
+    if rebuild is not None:
+        raise RunConflict(
+            f"run {rebuild.id} is rebuilding the table, the pipeline must"
+            " not run before it has finished (see app.shadow)")
+    if run is None:
+        run = next_run(session)
+    if run.id is not None:
+        print(f"Resuming unfinished run {run.id}")
+        return run
+    criteria = claimed_changes(run)
+    session.add(run)
+    session.flush()
+    session.query(SampleMeasurementChange).filter(criteria).update(
+        {SampleMeasurementChange.run_id: run.id}, synchronize_session=False)
+    session.commit()
+    print(f"Started run {run!r}")
+    return run
+
+
+def begin_rebuild(session):
+    """Starts a rebuild of the table, resuming the unfinished rebuild if
+    there is one.  Returns its run.  Raises a RunConflict while a run of the
+    pipeline is unfinished."""
+    rebuild = session.query(EtlRun).filter(
+        EtlRun.status == EtlRun.REBUILDING).first()
+    if rebuild is not None:
+        print(f"Resuming unfinished rebuild {rebuild.id}")
+        return rebuild
+    run = next_run(session)
+    if run.id is not None:
+        raise RunConflict(
+            f"run {run.id} is unfinished, resume it with the pipeline before"
+            " rebuilding the table")
+    run.status = EtlRun.REBUILDING
+    return begin_run(session, run)
+
+
+def changed_sample_ids(run):
+    """Returns a selectable of the sample ids inside the window of the run.
+    It only depends on the bounds and the id of the run, so it can be used in
+    any session."""
+    return union(
+        select([Sample.id]).where(and_(
+            Sample.id > run.sample_id_low,
+            Sample.id <= run.sample_id_high,
+        )),
+        select([SampleMeasurementChange.sample_id]).where(
+            claimed_changes(run)),
+    )
+
+
+def pending_sample_ids():
+    """Returns a selectable of the ids of the samples with change log rows no
+    run has claimed yet, i.e. samples that changed after the current run
+    began.  They are left to the next run."""
+    return select([SampleMeasurementChange.sample_id]).where(
+        SampleMeasurementChange.run_id.is_(None))
+
+
+def in_window(column, sample_ids=None):
+    """Restricts a step to the samples of an incremental run.  When
+    sample_ids is None the step considers the whole table."""
+    if sample_ids is None:
+        return true()
+    return column.in_(sample_ids)
+
+
+def finish_run(session, run_id):
+    """Marks the run as finished, advancing the watermark, and prunes the
+    change log rows it claimed."""
+    run = session.query(EtlRun).get(run_id)
+    run.status = EtlRun.FINISHED
+    run.finished_at = func.now()
+    session.query(SampleMeasurementChange).filter(
+        claimed_changes(run)
+    ).delete(synchronize_session=False)
+    session.commit()
@@ -0,0 +1,139 @@
+"""Secondary indexes on the columns the pipeline filters and joins on.
+
+* samples (parent_id) lets the lineage walk find the children of a sample.
+* sample_measurements (sample_id, measurement_type, value) covers the pivot
+  of add_values, which reads the measurements of a range of samples without
+  touching the table.  It is only created on SQLite and PostgreSQL.  InnoDB
+  stores the rows in the order of the primary key (sample_id,
+  measurement_type), so on MySQL the table itself already is that index.
+* experiment_measurements (top_parent_id) turns the top_parent_id IS NULL
+  probes of the steps into index range scans.
+* experiment_measurements (experiment_id, sample_id) serves queries per
+  experiment and the ordered reads of the Parquet export.
+* sample_measurements (measurement_type, sample_id, value) serves queries
+  per measurement_type.
+* sample_lineage (descendant_id, depth) finds the ancestors and the root of
+  a sample, see app.closure.
+
+The indexes are created by migrations e3a5c7f9b142 and a6d2f4b8c913, and
+7b3f9d2e6a18 drops the covering index again on MySQL.  ensure_indexes
+creates the ones missing from a database, e.g. one created from the
+models.
+
+Deferrable indexes are not read by the pipeline itself, so they can be
+dropped during a bulk load and rebuilt once it is done, which is cheaper
+than maintaining them row by row.  Indexes backing a foreign key cannot be
+dropped on MySQL and are never deferrable.
+"""
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import inspect
+
+from app.ddl import add_indexes, drop_indexes
+from app.storage import DYNAMIC, SLOTS
+
+# dialects names the backends the index is created on, None all of them.
+IndexSpec = namedtuple(
+    "IndexSpec", ["name", "table", "columns", "deferrable", "dialects"],
+    defaults=[None])
+
+# Must match the migrations e3a5c7f9b142, a6d2f4b8c913 and 7b3f9d2e6a18.
+INDEXES = [
+    IndexSpec("ix_samples_parent_id", "samples", ["parent_id"], False),
+    IndexSpec(
+        "ix_sample_measurements_sample_type_value", "sample_measurements",
+        ["sample_id", "measurement_type", "value"], False,
+        ("postgresql", "sqlite")),
+    IndexSpec(
+        "ix_sample_measurements_type_sample_value", "sample_measurements",
+        ["measurement_type", "sample_id", "value"], True),
+    IndexSpec(
+        "ix_experiment_measurements_top_parent_id",
+        "experiment_measurements", ["top_parent_id"], False),
+    IndexSpec(
+        "ix_experiment_measurements_experiment_sample",
+        "experiment_measurements", ["experiment_id", "sample_id"], True),
+    IndexSpec(
+        "ix_experiment_measurement_slots_top_parent_id",
+        "experiment_measurement_slots", ["top_parent_id"], False),
+    IndexSpec(
+        "ix_experiment_measurement_slots_experiment_sample",
+        "experiment_measurement_slots", ["experiment_id", "sample_id"], True),
+    IndexSpec(
+        "ix_sample_lineage_descendant_depth", "sample_lineage",
+        ["descendant_id", "depth"], False),
+]
+
+# The table each storage mode writes to, see app.storage.
+MODE_TABLES = {
+    DYNAMIC: "experiment_measurements",
+    SLOTS: "experiment_measurement_slots",
+}
+
+
+def existing_indexes(connection, table_name):
+    """Returns the names of the indexes of the table."""
+    return set(
+        index["name"] for index in inspect(connection).get_indexes(table_name)
+    )
+
+
+def table_indexes(table_name, deferrable_only=False, dialect=None):
+    """Returns the IndexSpecs of the table, only the ones created on the
+    backend named dialect unless it is None."""
+    return [
+        spec for spec in INDEXES
+        if spec.table == table_name
+        and (spec.deferrable or not deferrable_only)
+        and (dialect is None or spec.dialects is None
+             or dialect in spec.dialects)
+    ]
+
+
+def ensure_indexes(connection, table_names=None):
+    """Creates the missing indexes of table_names, or of every table that
+    exists when it is None.  Returns the names of the created indexes."""
+    if table_names is None:
+        existing_tables = set(inspect(connection).get_table_names())
+        table_names = sorted(set(
+            spec.table for spec in INDEXES if spec.table in existing_tables))
+    created = []
+    for table_name in table_names:
+        existing = existing_indexes(connection, table_name)
+        missing = [
+            spec for spec in table_indexes(
+                table_name, dialect=connection.dialect.name)
+            if spec.name not in existing
+        ]
+        if missing:
+            # NOTE:  In production code this would be changed to a logger
+            print(f"Creating indexes {', '.join(s.name for s in missing)}")
+            add_indexes(connection, table_name, [
+                (spec.name, spec.columns) for spec in missing])
+            created.extend(spec.name for spec in missing)
+    return created
+
+
+@contextmanager
+def deferred_indexes(engine, table_names):
+    """Drops the deferrable indexes of table_names for the duration of the
+    block and rebuilds them afterwards, also when the block failed."""
+    dropped = {}
+    with engine.connect() as connection:
+        for table_name in table_names:
+            existing = existing_indexes(connection, table_name)
+            names = [
+                spec.name
+                for spec in table_indexes(table_name, deferrable_only=True)
+                if spec.name in existing
+            ]
+            if names:
+                print(f"Deferring indexes {', '.join(names)}")
+                drop_indexes(connection, table_name, names)
+                dropped[table_name] = names
+    try:
+        yield
+    finally:
+        with engine.connect() as connection:
+            ensure_indexes(connection, list(dropped))
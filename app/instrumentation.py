@@ -0,0 +1,185 @@
+"""Per-step metrics of pipeline runs.
+
+RunMetrics hooks into the events of the engine while it is installed and
+attributes every statement to the step running it:
+
+* wall time of the step
+* number of statements, the time spent executing them and the slowest ones
+* rows written by INSERT, UPDATE and DELETE statements
+* number of commits
+* optionally the EXPLAIN plan of every distinct statement
+
+Steps are entered with RunMetrics.step.  The current step is kept in a context
+variable, so work fanned out to other threads is attributed correctly as
+long as it runs in a copy of the context of the step (see app.batching).
+
+Every finished step is printed as one line of JSON and report returns the
+metrics of the whole run, which pipeline can also write to a file.
+"""
+import json
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+
+from sqlalchemy import event
+
+current_step = ContextVar("current_step", default=None)
+
+# Number of slowest statements kept per step.
+SLOWEST_STATEMENTS = 5
+
+WRITE_KEYWORDS = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+EXPLAINABLE_KEYWORDS = ("SELECT", "WITH") + WRITE_KEYWORDS
+
+EXPLAIN_PREFIXES = {
+    "sqlite": "EXPLAIN QUERY PLAN",
+}
+
+
+def first_keyword(statement):
+    return statement.lstrip().split(None, 1)[0].upper() if statement else ""
+
+
+class StepMetrics:
+    """Counters of a single step.  They are updated from every thread
+    working for the step, hence the lock."""
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = None
+        self.statements = 0
+        self.sql_seconds = 0.
+        self.rows = 0
+        self.commits = 0
+        self.slowest = []
+        self.plans = {}
+        self.lock = Lock()
+
+    def add_statement(self, statement, seconds, rows):
+        with self.lock:
+            self.statements += 1
+            self.sql_seconds += seconds
+            if rows is not None and rows > 0:
+                self.rows += rows
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(reverse=True)
+            del self.slowest[SLOWEST_STATEMENTS:]
+
+    def add_commit(self):
+        with self.lock:
+            self.commits += 1
+
+    def add_plan(self, statement, plan):
+        with self.lock:
+            self.plans.setdefault(statement, plan)
+
+    def as_dict(self):
+        return {
+            "step": self.name,
+            "seconds": self.seconds,
+            "statements": self.statements,
+            "sql_seconds": round(self.sql_seconds, 6),
+            "rows": self.rows,
+            "commits": self.commits,
+            "slowest": [
+                {"seconds": round(seconds, 6), "statement": statement}
+                for seconds, statement in self.slowest
+            ],
+            "plans": self.plans,
+        }
+
+
+class RunMetrics:
+    """Collects the StepMetrics of one pipeline run."""
+
+    def __init__(self, explain=False):
+        self.explain = explain
+        self.steps = []
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def installed(self, engine):
+        """Listens to the events of engine for the duration of the block."""
+        listeners = [
+            ("before_cursor_execute", self.before_cursor_execute),
+            ("after_cursor_execute", self.after_cursor_execute),
+            ("commit", self.commit),
+        ]
+        for name, listener in listeners:
+            event.listen(engine, name, listener)
+        try:
+            yield self
+        finally:
+            for name, listener in listeners:
+                event.remove(engine, name, listener)
+
+    @contextmanager
+    def step(self, name):
+        """Attributes everything executed inside the block to step name."""
+        step = StepMetrics(name)
+        self.steps.append(step)
+        token = current_step.set(step)
+        began = time.perf_counter()
+        try:
+            yield step
+        finally:
+            step.seconds = round(time.perf_counter() - began, 6)
+            current_step.reset(token)
+            # NOTE:  In production code this would be changed to a logger
+            print(json.dumps(step.as_dict(), default=str))
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        step = current_step.get()
+        if step is None:
+            return
+        if self.explain and statement not in step.plans:
+            if first_keyword(statement) in EXPLAINABLE_KEYWORDS:
+                params = parameters[0] if executemany else parameters
+                step.add_plan(statement, explain(conn, statement, params))
+        conn.info.setdefault("statement_began", []).append(
+            time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        step = current_step.get()
+        if step is None:
+            return
+        seconds = time.perf_counter() - conn.info["statement_began"].pop()
+        rows = None
+        if first_keyword(statement) in WRITE_KEYWORDS or (
+                context is not None and (
+                    context.isinsert or context.isupdate
+                    or context.isdelete)):
+            rows = cursor.rowcount
+        step.add_statement(statement, seconds, rows)
+
+    def commit(self, conn):
+        step = current_step.get()
+        if step is not None:
+            step.add_commit()
+
+    def report(self):
+        return {
+            "seconds": round(time.perf_counter() - self.started, 6),
+            "steps": [step.as_dict() for step in self.steps],
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, default=str)
+
+
+def explain(conn, statement, parameters):
+    """Returns the plan of statement as a list of rows.  It runs on a cursor
+    of its own so the result of the statement itself is left alone."""
+    prefix = EXPLAIN_PREFIXES.get(conn.dialect.name, "EXPLAIN")
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(f"{prefix} {statement}", parameters)
+        return [list(row) for row in cursor.fetchall()]
+    except Exception as e:
+        return [f"EXPLAIN failed: {e}"]
+    finally:
+        cursor.close()
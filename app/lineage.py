@@ -0,0 +1,280 @@
+"""Resolution of the top parent (root sample) of every sample tree.
+
+The original approach to this problem repeatedly joined experiment_measurements
+against itself, resolving one generation of the tree per UPDATE.  That costs a
+table scan and a commit per level of the deepest tree.  The resolvers here
+compute every unresolved root in a single pass instead:
+
+* "cte" uses a recursive common table expression so the database walks the
+  trees itself and writes the result with one UPDATE.
+* "memory" streams (id, parent_id) pairs out of the samples table once,
+  resolves the roots in python with path compression and writes them back with
+  batched executemany UPDATEs.
+
+* "closure" looks every root up in the sample_lineage closure table, which
+  the pipeline keeps up to date (see app.closure).
+
+All strategies do work proportional to the number of rows, not to the depth
+of the trees.  The strategy is picked per backend by choose_strategy unless
+one is asked for.
+
+top_parent_resolver returns the chosen strategy as a body for
+app.batching.run_chunked.  The cte strategy chunks by the id of the sample the
+walk starts from, so every tree is walked by exactly one chunk.  The memory
+strategy reads the samples table once up front and chunks its writes.
+"""
+import sqlite3
+
+from sqlalchemy import and_, bindparam, exists, func, or_, select, update
+
+from app.schema import Sample, SampleLineage
+
+CTE = "cte"
+MEMORY = "memory"
+CLOSURE = "closure"
+
+# MySQL refuses to recurse deeper than cte_max_recursion_depth (1000 by
+#  default).  Lineage trees can be deeper than that.
+MAX_TREE_DEPTH = 1000000
+
+# Number of rows sent per executemany by the memory strategy.
+WRITE_BATCH_SIZE = 10000
+
+
+def choose_strategy(connection):
+    """Returns the strategy best suited for the connected backend.  Backends
+    without recursive CTE support fall back to the in-memory resolver."""
+    dialect = connection.dialect
+    version = dialect.server_version_info or ()
+    if dialect.name == "mysql":
+        if getattr(dialect, "_is_mariadb", False):
+            return CTE if version >= (10, 2, 2) else MEMORY
+        return CTE if version >= (8, 0, 1) else MEMORY
+    if dialect.name == "sqlite":
+        return CTE if sqlite3.sqlite_version_info >= (3, 8, 3) else MEMORY
+    if dialect.name == "postgresql":
+        return CTE
+    return MEMORY
+
+
+def find_roots(parents):
+    """Given a mapping of node -> parent (None for roots) returns a mapping of
+    node -> root.  Nodes in a cycle or below a parent missing from the mapping
+    have no root and map to None, like in the cte strategy.  Every node is
+    visited a constant number of times because the resolved root is written
+    back along the whole walked path."""
+    roots = {}
+    for node in parents:
+        path = []
+        walked = set()
+        while True:
+            if node in roots:
+                root = roots[node]
+                break
+            if node not in parents or node in walked:
+                root = None
+                break
+            parent = parents[node]
+            if parent is None:
+                root = node
+                break
+            path.append(node)
+            walked.add(node)
+            node = parent
+        if node in parents:
+            roots[node] = root
+        for visited in path:
+            roots[visited] = root
+    return roots
+
+
+def in_range(column, start=None, end=None):
+    """Restricts column to start through end.  None leaves that side open."""
+    criteria = []
+    if start is not None:
+        criteria.append(column >= start)
+    if end is not None:
+        criteria.append(column <= end)
+    return and_(*criteria)
+
+
+def _lineage_cte(ExperimentMeasurement, start=None, end=None):
+    """Builds a recursive CTE of (id, top_parent_id) for every sample whose
+    experiment_measurement does not have its top parent set yet.
+
+    The anchor members are the unresolved samples that are either roots or
+    whose parent is already resolved, limited to ids from start to end.  The
+    recursion then only descends into unresolved children so previously
+    processed trees are not walked again.
+    """
+    em_table = ExperimentMeasurement.__table__
+    samples = Sample.__table__
+    own_em = em_table.alias("own_em")
+    parent_em = em_table.alias("parent_em")
+    anchor = select([
+        samples.c.id,
+        func.coalesce(
+            parent_em.c.top_parent_id, samples.c.id
+        ).label("top_parent_id"),
+    ]).select_from(
+        samples.outerjoin(
+            own_em, own_em.c.sample_id == samples.c.id
+        ).outerjoin(
+            parent_em, parent_em.c.sample_id == samples.c.parent_id
+        )
+    ).where(and_(
+        in_range(samples.c.id, start, end),
+        own_em.c.top_parent_id.is_(None),
+        or_(
+            samples.c.parent_id.is_(None),
+            parent_em.c.top_parent_id.isnot(None),
+        ),
+    )).cte("lineage", recursive=True)
+
+    child = samples.alias("child")
+    child_em = em_table.alias("child_em")
+    return anchor.union_all(
+        select([
+            child.c.id,
+            anchor.c.top_parent_id
+        ]).select_from(
+            anchor.join(
+                child, child.c.parent_id == anchor.c.id
+            ).outerjoin(
+                child_em, child_em.c.sample_id == child.c.id
+            )
+        ).where(child_em.c.top_parent_id.is_(None))
+    )
+
+
+def resolve_with_cte(session, ExperimentMeasurement, start=None, end=None):
+    """Resolves the unresolved top parents of all trees walked from samples
+    with ids from start to end with a single recursive UPDATE.  Returns the
+    number of rows updated."""
+    em_table = ExperimentMeasurement.__table__
+    lineage = _lineage_cte(ExperimentMeasurement, start, end)
+    dialect = session.get_bind().dialect
+    if dialect.name == "mysql":
+        if not getattr(dialect, "_is_mariadb", False):
+            session.execute(
+                f"SET SESSION cte_max_recursion_depth = {MAX_TREE_DEPTH}")
+        # MySQL renders this as a multi-table UPDATE joined on the CTE.
+        update_stmt = update(em_table).where(
+            em_table.c.sample_id == lineage.c.id
+        ).values(top_parent_id=lineage.c.top_parent_id)
+    else:
+        # The walk only reaches unresolved rows, so there is no need to
+        #  filter on top_parent_id IS NULL.  Doing so lets SQLite drive the
+        #  UPDATE through the index on top_parent_id, and then it no longer
+        #  indexes the CTE for the lookup below, which becomes quadratic.
+        update_stmt = update(em_table).where(
+            em_table.c.sample_id.in_(select([lineage.c.id])),
+        ).values(top_parent_id=select([
+            lineage.c.top_parent_id
+        ]).where(lineage.c.id == em_table.c.sample_id).as_scalar())
+    return session.execute(update_stmt).rowcount
+
+
+def read_roots(session):
+    """Streams the samples table once and returns a mapping of every sample
+    id to its root."""
+    samples = Sample.__table__
+    parents = {}
+    result = session.connection().execution_options(
+        stream_results=True
+    ).execute(select([samples.c.id, samples.c.parent_id]))
+    for sample_id, parent_id in result:
+        parents[sample_id] = parent_id
+    return find_roots(parents)
+
+
+def write_roots(session, ExperimentMeasurement, roots, start=None, end=None):
+    """Writes the top parents from roots to the unresolved
+    experiment_measurements with sample ids from start to end in batched
+    executemany UPDATEs.  Returns the number of rows updated.
+
+    Samples without a root in roots, because they arrived after it was read
+    or have none, are left unresolved."""
+    em_table = ExperimentMeasurement.__table__
+    result = session.connection().execution_options(
+        stream_results=True
+    ).execute(select([em_table.c.sample_id]).where(and_(
+        in_range(em_table.c.sample_id, start, end),
+        em_table.c.top_parent_id.is_(None),
+    )))
+    resolved = [
+        {"b_sample_id": sample_id, "b_top_parent_id": roots.get(sample_id)}
+        for (sample_id,) in result
+    ]
+    resolved = [
+        values for values in resolved
+        if values["b_top_parent_id"] is not None
+    ]
+
+    update_stmt = update(em_table).where(
+        em_table.c.sample_id == bindparam("b_sample_id")
+    ).values(top_parent_id=bindparam("b_top_parent_id"))
+    for offset in range(0, len(resolved), WRITE_BATCH_SIZE):
+        session.execute(
+            update_stmt, resolved[offset:offset + WRITE_BATCH_SIZE])
+    return len(resolved)
+
+
+def resolve_in_memory(session, ExperimentMeasurement, start=None, end=None):
+    """Resolves the unresolved top parents of the experiment_measurements with
+    sample ids from start to end by streaming the samples table once and
+    computing roots in python.  Returns the number of rows updated."""
+    roots = read_roots(session)
+    return write_roots(session, ExperimentMeasurement, roots, start, end)
+
+
+def resolve_with_closure(session, ExperimentMeasurement, start=None,
+                         end=None):
+    """Sets the unresolved top parents of the experiment_measurements with
+    sample ids from start to end to the farthest ancestor of their sample in
+    sample_lineage.  Returns the number of rows updated."""
+    em_table = ExperimentMeasurement.__table__
+    lineage = SampleLineage.__table__
+    root = select([lineage.c.ancestor_id]).where(
+        lineage.c.descendant_id == em_table.c.sample_id
+    ).order_by(lineage.c.depth.desc()).limit(1).as_scalar()
+    update_stmt = update(em_table).where(and_(
+        in_range(em_table.c.sample_id, start, end),
+        em_table.c.top_parent_id.is_(None),
+        # Samples of a cycle have no rows and keep a NULL top parent.
+        exists().where(lineage.c.descendant_id == em_table.c.sample_id),
+    )).values(top_parent_id=root)
+    return session.execute(update_stmt).rowcount
+
+
+def top_parent_resolver(session, ExperimentMeasurement, strategy=None):
+    """Returns a body(session, start, end) for app.batching.run_chunked that
+    resolves top parents using strategy, which defaults to the best one for
+    the backend."""
+    strategy = strategy or choose_strategy(session.connection())
+    if strategy not in (CTE, MEMORY, CLOSURE):
+        raise ValueError(f"unknown top parent strategy {strategy!r}")
+    print(f"Resolving top parents using the {strategy} strategy")
+    if strategy == CTE:
+        def resolve(session, start=None, end=None):
+            return resolve_with_cte(
+                session, ExperimentMeasurement, start, end)
+    elif strategy == CLOSURE:
+        def resolve(session, start=None, end=None):
+            return resolve_with_closure(
+                session, ExperimentMeasurement, start, end)
+    else:
+        roots = read_roots(session)
+
+        def resolve(session, start=None, end=None):
+            return write_roots(
+                session, ExperimentMeasurement, roots, start, end)
+    return resolve
+
+
+def resolve_top_parents(session, ExperimentMeasurement, strategy=None):
+    """Sets top_parent_id on every experiment_measurement that does not have
+    one yet.  The strategy defaults to the best one for the backend."""
+    resolve = top_parent_resolver(session, ExperimentMeasurement, strategy)
+    resolve(session)
+    session.commit()
@@ -0,0 +1,166 @@
+"""A memory-mapped index of the sample trees.
+
+Services that need the top parent or the ancestors of samples can look them
+up in a file instead of querying the database one sample at a time.  The
+file is a NumPy .npy array of shape (high + 1, 2) holding the parent id and
+the root id of every sample, indexed by samples.id.  Both are NO_PARENT for
+ids without a sample, the parent also for roots and the root also for
+samples caught in a parent cycle or below a missing parent.
+
+LineageIndex maps the file read-only, so opening it copies nothing and every
+process reading it shares the pages of the page cache.  A lookup is an array
+access, a batch of lookups one fancy indexing operation.
+
+update_lineage_index keeps the file up to date after every run.  Samples
+never change their parent, so only the samples above the highest id of the
+file and the samples of the window of the run are read.  The window holds
+the samples that committed late with an id below the file's highest one,
+see app.incremental.  Their roots are resolved among themselves and the
+samples of the file without a root, whose missing parent may just have
+arrived, like in app.vectorized, and completed with the roots of their old
+ancestors from the file.  The new file is written to a temporary file of
+its own next to the old one and renamed over it, so readers keep the
+mapping they opened and pick up the new file when they open it again.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from app.schema import inject_session
+from app.vectorized import NO_PARENT, find_tops_vectorized, read_samples
+
+PARENT = 0
+ROOT = 1
+
+# int32 holds every id of the INTEGER samples.id.
+DTYPE = np.int32
+
+# Permissions of a new index file, which other services read.
+FILE_MODE = 0o644
+
+
+def empty_table(size):
+    return np.full((size, 2), NO_PARENT, dtype=DTYPE)
+
+
+def resolve_new_roots(table, ids, parents):
+    """Returns the roots of the samples ids with parents, given the table of
+    the samples before them."""
+    tops = find_tops_vectorized(ids, parents)
+    top_parents = parents[tops]
+    roots = np.where(top_parents == NO_PARENT, ids[tops], NO_PARENT)
+    # A chain that tops out at an old sample takes over the root of that
+    #  sample.  Chains below a missing parent or in a cycle keep NO_PARENT.
+    is_old = (top_parents != NO_PARENT) & (top_parents < len(table))
+    is_old[is_old] = ~np.isin(top_parents[is_old], ids)
+    roots[is_old] = table[top_parents[is_old], ROOT]
+    return roots
+
+
+def write_table(path, table):
+    """Writes the table to path through a temporary file, so readers never
+    see a partial file and concurrent writers never write the same one."""
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o777
+    else:
+        mode = FILE_MODE
+    temporary = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp",
+        delete=False)
+    try:
+        with temporary:
+            np.save(temporary, table)
+        # Temporary files are only readable by their owner.
+        os.chmod(temporary.name, mode)
+        os.replace(temporary.name, path)
+    except BaseException:
+        os.unlink(temporary.name)
+        raise
+
+
+@inject_session
+def update_lineage_index(session, path, sample_ids=None):
+    """Adds the samples missing from the lineage index at path, creating it
+    if needed.  sample_ids is the window of the run, as made by
+    app.incremental.changed_sample_ids, and None reads every sample.
+    Returns the number of samples added."""
+    if os.path.exists(path):
+        old = np.load(path, mmap_mode="r")
+    else:
+        old = empty_table(0)
+    if sample_ids is None:
+        ids, parents, _ = read_samples(session)
+    else:
+        ids, parents, _ = read_samples(
+            session, after=len(old) - 1, sample_ids=sample_ids)
+    known = ids < len(old)
+    known[known] = (old[ids[known], PARENT] != NO_PARENT) | (
+        old[ids[known], ROOT] != NO_PARENT)
+    added = int((~known).sum())
+    if not added:
+        print("The lineage index is up to date")
+        return 0
+    unresolved = np.flatnonzero(
+        (old[:, PARENT] != NO_PARENT) & (old[:, ROOT] == NO_PARENT))
+    unresolved = unresolved[~np.isin(unresolved, ids)]
+    ids = np.concatenate([ids, unresolved])
+    parents = np.concatenate([parents, old[unresolved, PARENT]])
+    order = np.argsort(ids)
+    ids, parents = ids[order], parents[order]
+    roots = resolve_new_roots(old, ids, parents)
+    table = empty_table(max(len(old), int(ids[-1]) + 1))
+    table[:len(old)] = old
+    table[ids, PARENT] = parents
+    table[ids, ROOT] = roots
+    write_table(path, table)
+    # NOTE:  In production code this would be changed to a logger
+    print(f"Added {added} samples to the lineage index {path}")
+    return added
+
+
+class LineageIndex:
+    """Looks up the trees of samples in the lineage index at path.  Unknown
+    sample ids have no parent and no root."""
+
+    def __init__(self, path):
+        self.table = np.load(path, mmap_mode="r")
+
+    def __len__(self):
+        return len(self.table)
+
+    def _get(self, sample_id, column):
+        if not 0 <= sample_id < len(self.table):
+            return None
+        value = int(self.table[sample_id, column])
+        return None if value == NO_PARENT else value
+
+    def parent(self, sample_id):
+        return self._get(sample_id, PARENT)
+
+    def top_parent(self, sample_id):
+        """Returns the root of the tree of the sample, or None if it has no
+        root, e.g. because it is part of a cycle."""
+        return self._get(sample_id, ROOT)
+
+    def top_parents(self, sample_ids):
+        """Returns an array of the roots of sample_ids, NO_PARENT for the
+        ones without a root."""
+        sample_ids = np.asarray(sample_ids, dtype=np.int64)
+        known = (sample_ids >= 0) & (sample_ids < len(self.table))
+        return np.where(
+            known,
+            self.table[np.where(known, sample_ids, 0), ROOT],
+            NO_PARENT)
+
+    def ancestors(self, sample_id):
+        """Returns the ids of the ancestors of the sample, nearest first."""
+        chain = []
+        seen = {sample_id}
+        parent = self.parent(sample_id)
+        # A cycle never reaches a root, the walk stops once it comes around.
+        while parent is not None and parent not in seen:
+            chain.append(parent)
+            seen.add(parent)
+            parent = self.parent(parent)
+        return chain
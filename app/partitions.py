@@ -0,0 +1,188 @@
+"""Range partitions of the experiment_measurements tables.
+
+On MySQL migration f1b7c2d9e4a0 partitions experiment_measurements BY RANGE
+(sample_id) into partitions of PARTITION_SIZE sample ids, aligned like the
+chunks of app.batching, plus the catch-all partition pmax.  Partition p<n>
+holds the sample ids from n up to the start of the next one.
+
+* ensure_partitions splits pmax before a run so the new samples land in
+  partitions of their own rather than in pmax.
+* every chunk of a step lies in a single partition as long as chunk_size
+  divides PARTITION_SIZE.  Its statements bound sample_id, so MySQL prunes
+  the other partitions, and the upserts of app.etl name the partition they
+  write to (see partition_lookup), so only it is locked.
+* rebuild_partition loads a partition rebuilt from scratch, e.g. by
+  app.vectorized, into a staging table and swaps it in with ALTER TABLE ...
+  EXCHANGE PARTITION, which only exchanges the data dictionary entries.
+  Readers see either the old rows or the new ones, never an empty range.
+
+MySQL does not support foreign keys on partitioned tables, so the migration
+drops those of experiment_measurements.  sample_measurements is left as it
+is, its triggers and foreign key are needed by app.incremental.
+
+Other backends have no partitions.  partitions returns nothing for them and
+every function falls back to the plain table, so the pipeline runs
+unchanged on SQLite and on unpartitioned MySQL tables.
+"""
+from sqlalchemy import column, delete, insert, table, text
+
+from app.batching import CHUNK_SIZE, chunk_ranges
+from app.schema import get_engine
+
+# Number of sample ids per partition.  A multiple of CHUNK_SIZE, so chunks
+#  never span partitions.
+PARTITION_SIZE = 20 * CHUNK_SIZE
+
+CATCH_ALL = "pmax"
+
+# Partitions rebuilt at the same time each have a staging table of their own,
+#  named <table>_staging_<partition>.
+STAGING_SUFFIX = "_staging_"
+
+
+def partition_definitions(start, high, partition_size=PARTITION_SIZE):
+    """Returns the (name, less_than) of the partitions of partition_size
+    sample ids from start on that are needed to hold sample id high."""
+    definitions = []
+    while start <= high:
+        definitions.append((f"p{start}", start + partition_size))
+        start += partition_size
+    return definitions
+
+
+def partition_clauses(definitions):
+    return [
+        f"PARTITION {name} VALUES LESS THAN ({less_than})"
+        for name, less_than in definitions
+    ] + [f"PARTITION {CATCH_ALL} VALUES LESS THAN MAXVALUE"]
+
+
+def partitions(connection, table_name):
+    """Returns the (name, less_than) of the partitions of the table in order,
+    with None for the catch-all.  Returns an empty list if the table is not
+    partitioned."""
+    if connection.dialect.name != "mysql":
+        return []
+    return [
+        (name, None if less_than == "MAXVALUE" else int(less_than))
+        for name, less_than in connection.execute(text(
+            "SELECT PARTITION_NAME, PARTITION_DESCRIPTION"
+            " FROM information_schema.PARTITIONS"
+            " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name"
+            " AND PARTITION_NAME IS NOT NULL"
+            " ORDER BY PARTITION_ORDINAL_POSITION"
+        ), table_name=table_name)
+    ]
+
+
+def ensure_partitions(connection, table_name, high,
+                      partition_size=PARTITION_SIZE):
+    """Splits partitions off the catch-all of the table until sample id high
+    has a partition of its own.  Returns the names of the new partitions."""
+    existing = partitions(connection, table_name)
+    if not existing:
+        return []
+    bounds = [less_than for _, less_than in existing if less_than is not None]
+    definitions = partition_definitions(
+        max(bounds, default=1), high, partition_size)
+    if not definitions:
+        return []
+    # pmax is empty as long as this runs before the rows are written, so
+    #  reorganizing it does not move any rows.
+    preparer = connection.dialect.identifier_preparer
+    connection.execute(
+        f"ALTER TABLE {preparer.quote(table_name)}"
+        f" REORGANIZE PARTITION {CATCH_ALL} INTO"
+        f" ({', '.join(partition_clauses(definitions))})")
+    names = [name for name, _ in definitions]
+    # NOTE:  In production code this would be changed to a logger
+    print(f"Added partitions {', '.join(names)} to {table_name}")
+    return names
+
+
+def prepare_partitions(table_name, partition_size=PARTITION_SIZE):
+    """Gives the samples up to the largest sample id partitions of their own
+    before a run writes them."""
+    with get_engine().connect() as connection:
+        high = connection.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM samples").scalar()
+        return ensure_partitions(
+            connection, table_name, high, partition_size)
+
+
+def find_partition(existing, start, end):
+    """Returns the (name, lower, less_than) of the partition holding the
+    sample ids start to end, or None if they span several."""
+    lower = 1
+    for name, less_than in existing:
+        if less_than is None or end < less_than:
+            return (name, lower, less_than) if start >= lower else None
+        lower = less_than
+    return None
+
+
+def partition_lookup(connection, table_name):
+    """Returns a function mapping a chunk (start, end) to the name of the
+    partition of the table holding it, or to None if the table is not
+    partitioned or the chunk spans several partitions."""
+    existing = partitions(connection, table_name)
+
+    def lookup(start, end):
+        found = find_partition(existing, start, end)
+        return None if found is None else found[0]
+    return lookup
+
+
+def staging_table(source, name):
+    """Returns a lightweight table construct with the columns of source."""
+    return table(name, *[column(c.name, c.type) for c in source.c])
+
+
+def rebuild_partition(session, source, start, end, load,
+                      chunk_size=CHUNK_SIZE):
+    """Replaces the rows of the sample ids start to end of source by the
+    ones load(session, target, start, end) inserts into target, chunk_size
+    sample ids at a time.
+
+    When start to end is exactly a partition of source the rows are loaded
+    into a staging table which is exchanged with the partition.  Otherwise
+    the range is deleted and loaded in place."""
+    connection = session.connection()
+    found = find_partition(partitions(connection, source.name), start, end)
+    if found is None or found[1:] != (start, end + 1):
+        session.execute(delete(source).where(
+            source.c.sample_id.between(start, end)))
+        return sum(
+            load(session, source, max(low, start), min(high, end))
+            for low, high in chunk_ranges(start, end, chunk_size))
+
+    name = found[0]
+    preparer = connection.dialect.identifier_preparer
+    staging_name = source.name + STAGING_SUFFIX + name
+    source_table = preparer.quote(source.name)
+    staging = preparer.quote(staging_name)
+    session.execute(f"DROP TABLE IF EXISTS {staging}")
+    session.execute(f"CREATE TABLE {staging} LIKE {source_table}")
+    session.execute(f"ALTER TABLE {staging} REMOVE PARTITIONING")
+    target = staging_table(source, staging_name)
+    written = 0
+    for low, high in chunk_ranges(start, end, chunk_size):
+        written += load(session, target, max(low, start), min(high, end))
+        session.commit()
+    # The rows are validated against the bounds of the partition while the
+    #  table is locked, the old rows end up in the staging table.
+    session.execute(
+        f"ALTER TABLE {source_table} EXCHANGE PARTITION {name}"
+        f" WITH TABLE {staging}")
+    session.execute(f"DROP TABLE {staging}")
+    # NOTE:  In production code this would be changed to a logger
+    print(f"Exchanged partition {name} of {source.name}")
+    return written
+
+
+def load_into(session, target, mappings):
+    """Inserts mappings into target with one executemany.  Returns their
+    number."""
+    if mappings:
+        session.execute(insert(target), mappings)
+    return len(mappings)
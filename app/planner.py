@@ -0,0 +1,173 @@
+"""Planning of pipeline runs.
+
+The pipeline is triggered every few minutes, and most of the time nothing
+arrived since the last run.  plan_run decides up front which steps have any
+work, from the window of the run (see app.incremental) and a few cheap
+probes:
+
+* the bounds of the window are the maxima of the primary keys of samples and
+  sample_measurement_changes, read when the run is planned.  They never drop
+  below the watermark, also when the log was pruned or samples deleted.
+* when the ids of the change log did not move, a single probe of its run_id
+  index finds rows that committed late with a lower id.
+* new measurement_types are looked up in the measurement_types registry,
+  which holds one row per type.
+* whether the new samples have measurements is a single probe of the primary
+  key of sample_measurements.
+
+The rows of every step are estimated from these bounds instead of being
+counted, so planning never scans a table.  pipeline skips the steps without
+rows and returns without starting a run when none has any, so an idle run
+costs a handful of point queries.
+
+    python -m app.etl --dry-run
+
+prints the plan of the next run without running it, together with the
+EXPLAIN plan of the query reading the source rows of every step with work.
+"""
+from collections import namedtuple
+
+from sqlalchemy import exists, func, select
+
+from app.batching import key_range
+from app.etl_app_side import STREAMING
+from app.incremental import changed_sample_ids, claimed_changes, in_window
+from app.instrumentation import explain
+from app.schema import MeasurementType, Sample, SampleMeasurement
+from app.storage import DYNAMIC, SLOTS, get_model, measurement_columns
+from app.vectorized import VECTORIZED
+
+# probe is the query reading the source rows of the step, or None for steps
+#  that only issue DDL.
+PlannedStep = namedtuple("PlannedStep", ["name", "rows", "probe"])
+
+
+class Plan:
+    """The steps of a run with their estimated rows.  run is the EtlRun whose
+    window was planned, or None for a full run."""
+
+    def __init__(self, run, steps):
+        self.run = run
+        self.steps = steps
+
+    @property
+    def has_work(self):
+        return any(step.rows for step in self.steps)
+
+    def skips(self, name):
+        """Whether the step is planned without any rows.  Steps the plan does
+        not know about are never skipped."""
+        return any(
+            step.name == name and not step.rows for step in self.steps)
+
+    def describe(self):
+        if self.run is None:
+            return "full run"
+        return (
+            f"samples {self.run.sample_id_low + 1}"
+            f" to {self.run.sample_id_high},"
+            f" changes {self.run.change_id_low + 1}"
+            f" to {self.run.change_id_high}")
+
+
+def pending_measurement_types(session, model, mode=DYNAMIC):
+    """Returns the number of registered measurement_types without a column
+    in model, the table of the storage mode."""
+    if mode == SLOTS:
+        return session.query(func.count(MeasurementType.measurement_type)
+                             ).filter(MeasurementType.slot.is_(None)).scalar()
+    measurement_types = [
+        mt for (mt,) in session.query(MeasurementType.measurement_type)]
+    columns = measurement_columns(session, measurement_types, mode)
+    return sum(
+        1 for column in columns.values() if column not in model.__table__.c)
+
+
+def has_measurements(session, low, high):
+    """Whether any of the samples low < id <= high has measurements."""
+    return session.query(exists().where(
+        SampleMeasurement.sample_id.between(low + 1, high))).scalar()
+
+
+def plan_run(session, run=None, mode=DYNAMIC, transform=None):
+    """Returns the Plan of a run of the pipeline with the transform over the
+    window of run, or over all samples when run is None."""
+    if run is None:
+        sample_ids = None
+        low, high = 0, key_range(session, Sample.id)[1] or 0
+        changes = 0
+    else:
+        sample_ids = changed_sample_ids(run)
+        low, high = run.sample_id_low, run.sample_id_high
+        changes = run.change_id_high - run.change_id_low
+        if not changes and session.query(exists().where(
+                claimed_changes(run))).scalar():
+            changes = 1
+    # Ids are estimates, samples may have been deleted or logged twice.
+    new = high - low
+    # New samples are logged as well, every sample is counted once or more.
+    touched = max(new, changes)
+    if changes or (new and has_measurements(session, low, high)):
+        measured = touched
+    else:
+        measured = 0
+
+    ExperimentMeasurement = get_model(mode)
+    samples = select([Sample.__table__]).where(
+        in_window(Sample.id, sample_ids))
+    measurements = select([SampleMeasurement.__table__]).where(
+        in_window(SampleMeasurement.sample_id, sample_ids))
+    unresolved = select([ExperimentMeasurement.sample_id]).where(
+        ExperimentMeasurement.top_parent_id.is_(None))
+    written = select([ExperimentMeasurement.__table__]).where(
+        in_window(ExperimentMeasurement.sample_id, sample_ids))
+
+    steps = [
+        PlannedStep(
+            "add_measurement_columns",
+            pending_measurement_types(session, ExperimentMeasurement, mode),
+            None),
+        # Samples that committed late are only found through the log.
+        PlannedStep("extend_sample_lineage", touched, samples),
+    ]
+    if transform == VECTORIZED:
+        steps.append(PlannedStep("transform_vectorized", new, measurements))
+    else:
+        if transform == STREAMING:
+            steps.append(PlannedStep("load_streaming", touched, measurements))
+        else:
+            steps += [
+                PlannedStep("add_samples_and_experiments", touched, samples),
+                PlannedStep("add_values", measured, measurements),
+            ]
+        steps += [
+            PlannedStep("set_top_parents_of_root_nodes", touched, unresolved),
+            PlannedStep("set_top_parents_adjacent", touched, samples),
+        ]
+    steps.append(PlannedStep("update_rollups", measured, written))
+    return Plan(run, steps)
+
+
+def explain_probe(connection, probe):
+    """Returns the EXPLAIN plan of probe as a list of lines."""
+    statement = str(probe.compile(
+        dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    return [
+        row if isinstance(row, str) else " | ".join(map(str, row))
+        for row in explain(connection, statement, ())
+    ]
+
+
+def print_plan(connection, plan):
+    """Prints the steps of the plan with their estimated rows and the EXPLAIN
+    plans of the probes of the steps with work."""
+    # NOTE:  In production code this would be changed to a logger
+    print(f"Plan of the {plan.describe()}")
+    for step in plan.steps:
+        if not step.rows:
+            print(f"  {step.name}: skipped")
+            continue
+        print(f"  {step.name}: ~{step.rows} rows")
+        if step.probe is not None:
+            for line in explain_probe(connection, step.probe):
+                print(f"    {line}")
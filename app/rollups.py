@@ -0,0 +1,208 @@
+"""Rollup tables of experiment_measurements.
+
+experiment_rollups and lineage_rollups hold the count, sum, min and max of
+the values of every measurement_type per experiment_id and per
+top_parent_id, the mean being sum / count.  Dashboards read a row per group
+and type from them instead of aggregating the whole table.
+
+update_rollups keeps them up to date as the last step of a run, from only
+the samples the run touched:
+
+* the new samples of an incremental run are aggregated chunk by chunk into
+  partial aggregates per group, which are merged into the existing rows by
+  an upsert that adds up the counts and sums and keeps the smaller minimum
+  and larger maximum (see app.upsert).  The merge of a chunk is committed
+  together with its record in etl_chunks, so a resumed run never merges a
+  chunk twice.
+* a minimum or maximum cannot be taken back, so the groups of the old
+  samples that received new or updated measurements are recomputed from
+  scratch instead.  New samples in these groups are left to the
+  recomputation.
+* a full run rebuilds both tables.
+
+The values aggregated are those of experiment_measurements, the largest
+value of a type per sample, for the types that have a column in the table of
+the storage mode.  A sample that moves to another experiment is only picked
+up by a full run.
+"""
+from collections import namedtuple
+
+from sqlalchemy import and_, func, select
+
+from app.batching import CHUNK_SIZE, key_range, run_chunked
+from app.incremental import claimed_changes
+from app.schema import (
+    inject_session,
+    EtlRun,
+    ExperimentRollup,
+    LineageRollup,
+    SampleMeasurement,
+    SampleMeasurementChange,
+)
+from app.storage import DYNAMIC, existing_measurement_columns, get_model
+from app.upsert import MAX, MIN, SUM, Upsert
+
+# model is the rollup table, group the column of experiment_measurements it
+#  groups by, which is also the first column of its primary key.
+Rollup = namedtuple("Rollup", ["model", "group"])
+
+ROLLUPS = [
+    Rollup(ExperimentRollup, "experiment_id"),
+    Rollup(LineageRollup, "top_parent_id"),
+]
+
+AGGREGATE_COLUMNS = ["value_count", "value_sum", "value_min", "value_max"]
+
+MERGE = {
+    "value_count": SUM,
+    "value_sum": SUM,
+    "value_min": MIN,
+    "value_max": MAX,
+}
+
+
+def rolled_up_types(session, table, mode):
+    """Returns the measurement_types that have a column in table."""
+    return sorted(existing_measurement_columns(session, table, mode))
+
+
+def partial_aggregates(table, group, measurement_types, value_criteria,
+                       group_criteria):
+    """Aggregates the values of the samples matching value_criteria per
+    group and measurement_type, over the rows matching group_criteria.
+
+    The values are read from sample_measurements, which holds one row per
+    value instead of one column per type, taking the largest one per sample
+    like the pivot of app.etl.add_values."""
+    values = select([
+        SampleMeasurement.sample_id,
+        SampleMeasurement.measurement_type,
+        func.max(SampleMeasurement.value).label("value"),
+    ]).where(and_(
+        SampleMeasurement.measurement_type.in_(measurement_types),
+        SampleMeasurement.value.isnot(None),
+        *value_criteria
+    )).group_by(
+        SampleMeasurement.sample_id, SampleMeasurement.measurement_type
+    ).alias("sample_values")
+    group_column = table.c[group]
+    return select([
+        group_column,
+        values.c.measurement_type,
+        func.count(values.c.value),
+        func.sum(values.c.value),
+        func.min(values.c.value),
+        func.max(values.c.value),
+    ]).select_from(values.join(
+        table, table.c.sample_id == values.c.sample_id
+    )).where(and_(
+        group_column.isnot(None),
+        *group_criteria
+    )).group_by(group_column, values.c.measurement_type)
+
+
+def merge_aggregates(session, rollup, aggregates):
+    """Merges the partial aggregates into the rollup table.  Returns the
+    number of rows written."""
+    columns = [rollup.group, "measurement_type"] + AGGREGATE_COLUMNS
+    return session.execute(Upsert(
+        rollup.model.__table__,
+        columns,
+        aggregates,
+        index_elements=columns[:2],
+        update_columns=AGGREGATE_COLUMNS,
+        merge=MERGE,
+    )).rowcount
+
+
+def dirty_groups(table, group, changed_sample_ids):
+    """Returns a query of the groups of the changed samples."""
+    return select([table.c[group]]).where(and_(
+        table.c.sample_id.in_(changed_sample_ids),
+        table.c[group].isnot(None),
+    )).distinct()
+
+
+def recompute_groups(session, table, rollup, measurement_types, groups):
+    """Replaces the rows of the groups by aggregates of all their rows.
+    Returns the number of rows written."""
+    model_group = rollup.model.__table__.c[rollup.group]
+    session.execute(rollup.model.__table__.delete().where(
+        model_group.in_(groups)))
+    members = select([table.c.sample_id]).where(table.c[rollup.group].in_(
+        groups))
+    return merge_aggregates(session, rollup, partial_aggregates(
+        table, rollup.group, measurement_types,
+        [SampleMeasurement.sample_id.in_(members)],
+        [table.c[rollup.group].in_(groups)],
+    ))
+
+
+@inject_session
+def update_rollups(session, chunk_size=CHUNK_SIZE, run_id=None, workers=1,
+                   mode=DYNAMIC):
+    """Updates the rollup tables with the samples of the incremental run, or
+    rebuilds them when run_id is None.  The top parents must already be set.
+    Returns the number of rollup rows written."""
+    table = get_model(mode).__table__
+    measurement_types = rolled_up_types(session, table, mode)
+    if not measurement_types:
+        print("No measurement columns to roll up")
+        return 0
+    if run_id is None:
+        for rollup in ROLLUPS:
+            session.execute(rollup.model.__table__.delete())
+        new = []
+        changed = None
+    else:
+        run = session.query(EtlRun).get(run_id)
+        new = [
+            SampleMeasurement.sample_id > run.sample_id_low,
+            SampleMeasurement.sample_id <= run.sample_id_high,
+        ]
+        changed = select([SampleMeasurementChange.sample_id]).where(and_(
+            claimed_changes(run),
+            SampleMeasurementChange.sample_id <= run.sample_id_low,
+        ))
+
+    def merge_chunk(session, start, end):
+        written = 0
+        for rollup in ROLLUPS:
+            group_criteria = []
+            if changed is not None:
+                group_criteria.append(table.c[rollup.group].notin_(
+                    dirty_groups(table, rollup.group, changed)))
+            written += merge_aggregates(session, rollup, partial_aggregates(
+                table, rollup.group, measurement_types,
+                [SampleMeasurement.sample_id.between(start, end), *new],
+                group_criteria,
+            ))
+        return written
+
+    low, high = key_range(session, SampleMeasurement.sample_id, *new)
+    written = run_chunked(session, "update_rollups", merge_chunk,
+                          low, high, chunk_size, run_id, workers)
+    if changed is not None:
+        for rollup in ROLLUPS:
+            written += recompute_groups(
+                session, table, rollup, measurement_types,
+                dirty_groups(table, rollup.group, changed))
+    # NOTE:  In production code this would be changed to a logger
+    print(f"Wrote {written} rollup rows")
+    return written
+
+
+def summary(session, model, group_id):
+    """Returns the aggregates of every measurement_type of the group of the
+    rollup model, with their mean."""
+    group = model.__table__.primary_key.columns.values()[0]
+    return {
+        row.measurement_type: {
+            "count": row.value_count,
+            "sum": row.value_sum,
+            "min": row.value_min,
+            "max": row.value_max,
+            "mean": row.value_sum / row.value_count,
+        }
+        for row in session.query(model).filter(group == group_id)
+    }
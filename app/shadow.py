@@ -0,0 +1,169 @@
+"""Full rebuilds of the table of a storage mode in a shadow table.
+
+Reprocessing everything in place rewrites experiment_measurements under the
+queries of its readers, who wait for the locks of the steps and see rows
+that are only half populated.  rebuild builds a complete copy next to it
+instead and swaps it in at once:
+
+* the shadow table <table>_shadow is created with the columns of the live
+  table, but without its secondary indexes.
+* the vectorized transform (see app.vectorized) fills it with bulk inserts
+  only, top parents included, so nothing is updated row by row.
+* the indexes are built on the full shadow table, scanning it once.
+* the shadow table takes the place of the live one.  MySQL renames both
+  tables with one atomic RENAME TABLE.  SQLite and PostgreSQL drop the live
+  table, rename the shadow table and build the indexes in a single
+  transaction, as index names are unique per database there.
+
+Readers keep querying the live table until the swap and the rollups are
+rebuilt from the new rows right after it.  Runs of the pipeline must not
+write to the live table while it is rebuilt, their rows would be lost with
+it.  The rebuild is therefore recorded in etl_runs, and it does not start
+while a run is unfinished, nor does a run start before it has finished (see
+app.incremental).  A failed rebuild is resumed by rebuilding again.
+
+    python -m app.shadow
+"""
+from sqlalchemy import MetaData, Table, inspect
+
+from app.batching import CHUNK_SIZE
+from app.ddl import add_indexes, drop_indexes
+from app.etl import add_measurement_columns
+from app.incremental import begin_rebuild, finish_run
+from app.indexes import existing_indexes, table_indexes
+from app.partitions import partitions
+from app.rollups import update_rollups
+from app.schema import get_engine, Sample, session_scope
+from app.storage import DYNAMIC, check_mode, get_model
+from app.vectorized import transform_vectorized
+
+SHADOW_SUFFIX = "_shadow"
+
+RETIRED_SUFFIX = "_retired"
+
+
+def index_definitions(table_name):
+    return [(spec.name, spec.columns) for spec in table_indexes(table_name)]
+
+
+def create_shadow(connection, live, shadow_name):
+    """Creates the shadow table of the live table without its secondary
+    indexes, replacing a leftover of an earlier rebuild."""
+    quote = connection.dialect.identifier_preparer.quote
+    connection.execute(f"DROP TABLE IF EXISTS {quote(shadow_name)}")
+    if connection.dialect.name == "mysql":
+        # Keeps the partitions of the live table, but not its foreign keys.
+        connection.execute(
+            f"CREATE TABLE {quote(shadow_name)} LIKE {quote(live.name)}")
+        drop_indexes(connection, shadow_name, [
+            name for name, _ in index_definitions(live.name)
+            if name in existing_indexes(connection, shadow_name)
+        ])
+        return
+    metadata = MetaData()
+    # The foreign keys of the copied columns refer to samples.
+    Sample.__table__.tometadata(metadata)
+    Table(shadow_name, metadata, *[
+        column.copy() for column in live.c
+    ]).create(connection)
+
+
+def finish_shadow(connection, live, shadow_name):
+    """Builds the indexes and foreign keys of the live table on the filled
+    shadow table.  Other backends build the indexes during the swap
+    instead."""
+    if connection.dialect.name != "mysql":
+        return
+    add_indexes(connection, shadow_name, index_definitions(live.name))
+    if partitions(connection, live.name):
+        return
+    quote = connection.dialect.identifier_preparer.quote
+    for foreign_key in inspect(connection).get_foreign_keys(live.name):
+        columns = ", ".join(map(quote, foreign_key["constrained_columns"]))
+        referred = ", ".join(map(quote, foreign_key["referred_columns"]))
+        connection.execute(
+            f"ALTER TABLE {quote(shadow_name)} ADD FOREIGN KEY ({columns})"
+            f" REFERENCES {quote(foreign_key['referred_table'])}"
+            f" ({referred})")
+
+
+def swap_mysql(connection, live_name, shadow_name):
+    quote = connection.dialect.identifier_preparer.quote
+    retired = quote(live_name + RETIRED_SUFFIX)
+    connection.execute(f"DROP TABLE IF EXISTS {retired}")
+    connection.execute(
+        f"RENAME TABLE {quote(live_name)} TO {retired},"
+        f" {quote(shadow_name)} TO {quote(live_name)}")
+    connection.execute(f"DROP TABLE {retired}")
+
+
+def swap_in_transaction(connection, live_name, shadow_name):
+    """Replaces the live table by the shadow table and builds its indexes in
+    one transaction."""
+    quote = connection.dialect.identifier_preparer.quote
+    statements = [
+        f"DROP TABLE {quote(live_name)}",
+        f"ALTER TABLE {quote(shadow_name)} RENAME TO {quote(live_name)}",
+    ] + [
+        f"CREATE INDEX {quote(name)} ON {quote(live_name)}"
+        f" ({', '.join(map(quote, columns))})"
+        for name, columns in index_definitions(live_name)
+    ]
+    if connection.dialect.name != "sqlite":
+        with connection.begin():
+            for statement in statements:
+                connection.execute(statement)
+        return
+    # pysqlite commits before every DDL statement on its own, so the
+    #  transaction is driven on the DBAPI connection.
+    raw = connection.connection
+    isolation_level = raw.isolation_level
+    raw.isolation_level = None
+    try:
+        # Views of the live table are left alone by the rename.
+        raw.execute("PRAGMA legacy_alter_table = ON")
+        raw.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                raw.execute(statement)
+        except BaseException:
+            raw.execute("ROLLBACK")
+            raise
+        raw.execute("COMMIT")
+    finally:
+        raw.execute("PRAGMA legacy_alter_table = OFF")
+        raw.isolation_level = isolation_level
+
+
+def rebuild(mode=DYNAMIC, chunk_size=CHUNK_SIZE, workers=1):
+    """Rebuilds the table of the storage mode from scratch in a shadow table
+    and swaps it in.  Returns the number of rows written.  Raises a
+    RunConflict while a run of the pipeline is unfinished."""
+    check_mode(mode)
+    with session_scope() as session:
+        run_id = begin_rebuild(session).id
+    add_measurement_columns(mode=mode)
+    live = get_model(mode).__table__
+    shadow_name = live.name + SHADOW_SUFFIX
+    engine = get_engine()
+    with engine.connect() as connection:
+        create_shadow(connection, live, shadow_name)
+    written = transform_vectorized(
+        chunk_size=chunk_size, workers=workers, mode=mode,
+        target=shadow_name)
+    with engine.connect() as connection:
+        finish_shadow(connection, live, shadow_name)
+        if connection.dialect.name == "mysql":
+            swap_mysql(connection, live.name, shadow_name)
+        else:
+            swap_in_transaction(connection, live.name, shadow_name)
+    # NOTE:  In production code this would be changed to a logger
+    print(f"Swapped in {shadow_name} as {live.name}")
+    update_rollups(chunk_size=chunk_size, workers=workers, mode=mode)
+    with session_scope() as session:
+        finish_run(session, run_id)
+    return written
+
+
+if __name__ == "__main__":
+    rebuild()
@@ -0,0 +1,136 @@
+"""Storage modes of the flattened measurements.
+
+* "dynamic" is the original design.  experiment_measurements grows a
+  measurement_<type> column for every new measurement_type.  Rows get wider
+  and the DDL slower over time, until MySQL's column limit is hit.
+* "slots" keeps the fixed schema experiment_measurement_slots table.  The
+  measurement_types registry assigns every type one of its SLOT_COUNT slot_<n>
+  columns, so new types only cost an UPDATE of the registry.  The
+  experiment_measurements_view renames the slots back to measurement_<type>
+  so analysts query the same names in both modes.
+
+Both tables share the sample_id, experiment_id and top_parent_id columns, so
+all steps of the pipeline work on either one.  The mode only decides which
+table is written and how a measurement_type maps to a column.
+"""
+from sqlalchemy import Column, DECIMAL
+
+from app.ddl import add_columns
+from app.schema import (
+    MeasurementType,
+    ExperimentMeasurementSlots,
+    SLOT_COUNT,
+    get_ExperimentMeasurement,
+)
+
+DYNAMIC = "dynamic"
+SLOTS = "slots"
+
+VIEW_NAME = "experiment_measurements_view"
+
+
+def check_mode(mode):
+    if mode not in (DYNAMIC, SLOTS):
+        raise ValueError(f"unknown storage mode {mode!r}")
+
+
+def get_model(mode=DYNAMIC):
+    """Returns the mapped class of the table the mode writes to."""
+    check_mode(mode)
+    if mode == SLOTS:
+        return ExperimentMeasurementSlots
+    return get_ExperimentMeasurement()
+
+
+def measurement_columns(session, measurement_types, mode=DYNAMIC):
+    """Returns a mapping of each of measurement_types to the name of the
+    column holding its values."""
+    check_mode(mode)
+    if mode == DYNAMIC:
+        return {mt: f"measurement_{mt}" for mt in measurement_types}
+    slots = dict(session.query(
+        MeasurementType.measurement_type,
+        MeasurementType.slot,
+    ).filter(MeasurementType.measurement_type.in_(measurement_types)))
+    return {mt: f"slot_{slots[mt]}" for mt in measurement_types}
+
+
+def existing_measurement_columns(session, table, mode=DYNAMIC):
+    """Returns a mapping of the registered measurement_types that have a
+    column in table, the table of the storage mode, to the name of that
+    column.  Types registered after add_measurement_columns ran have no
+    column yet and are left to the next run."""
+    registered = session.query(MeasurementType.measurement_type)
+    if mode == SLOTS:
+        registered = registered.filter(MeasurementType.slot.isnot(None))
+    return {
+        mt: column
+        for mt, column in measurement_columns(
+            session, [mt for (mt,) in registered], mode).items()
+        if column in table.c
+    }
+
+
+def add_dynamic_columns(session, measurement_types):
+    """Creates the missing measurement_<type> columns of the dynamic
+    experiment_measurements table with a single ALTER TABLE."""
+    ExperimentMeasurement = get_ExperimentMeasurement()
+    cols = [f"measurement_{mt}" for mt in measurement_types]
+    existing_cols = set(ExperimentMeasurement.__table__.columns.keys())
+    new_cols = [col for col in cols if col not in existing_cols]
+    if new_cols:
+        print(f"creating new_cols: {', '.join(new_cols)}")
+        add_columns(session.connection(), "experiment_measurements", [
+            Column(new_col, DECIMAL(16, 6)) for new_col in new_cols
+        ])
+
+
+def assign_slots(session):
+    """Assigns a free slot to every registered measurement_type without one
+    and recreates the view when any were assigned."""
+    unassigned = session.query(MeasurementType).filter(
+        MeasurementType.slot.is_(None)
+    ).order_by(MeasurementType.measurement_type).all()
+    if not unassigned:
+        return
+    used = set(slot for (slot,) in session.query(MeasurementType.slot).filter(
+        MeasurementType.slot.isnot(None)))
+    free = (slot for slot in range(SLOT_COUNT) if slot not in used)
+    for measurement_type in unassigned:
+        slot = next(free, None)
+        if slot is None:
+            raise ValueError(
+                f"no free slot left for measurement_type"
+                f" {measurement_type.measurement_type!r}")
+        print(f"assigning slot_{slot} to {measurement_type.measurement_type}")
+        measurement_type.slot = slot
+    session.flush()
+    create_view(session)
+
+
+def create_view(session):
+    """(Re)creates the view exposing experiment_measurement_slots with a
+    measurement_<type> column per assigned slot."""
+    dialect = session.get_bind().dialect
+    quote = dialect.identifier_preparer.quote
+    assigned = session.query(
+        MeasurementType.measurement_type,
+        MeasurementType.slot,
+    ).filter(
+        MeasurementType.slot.isnot(None)
+    ).order_by(MeasurementType.measurement_type)
+    select_list = ", ".join(["sample_id", "experiment_id", "top_parent_id"] + [
+        f"slot_{slot} AS {quote(f'measurement_{mt}')}"
+        for mt, slot in assigned
+    ])
+    view_sql = (
+        f"VIEW {VIEW_NAME} AS SELECT {select_list}"
+        f" FROM {ExperimentMeasurementSlots.__tablename__}"
+    )
+    if dialect.name == "sqlite":
+        # SQLite has no CREATE OR REPLACE.  Its DDL is transactional, so
+        #  readers never see the view missing.
+        session.execute(f"DROP VIEW IF EXISTS {VIEW_NAME}")
+        session.execute(f"CREATE {view_sql}")
+    else:
+        session.execute(f"CREATE OR REPLACE {view_sql}")
@@ -0,0 +1,311 @@
+"""The steps of the pipeline as standalone tasks of a DAG.
+
+Every step of app.etl is described by a Task, which declares the tasks
+upstream of it, i.e. the DAG described in app.etl, and whether it is
+partitioned.  A partitioned task is fanned out at run time into one instance
+per partition of partition_size sample ids, aligned like the chunks of
+app.batching, so that its partitions can run on different workers.  Every
+instance comes with an estimated cost, the number of source rows in its
+partition, so the heaviest ones, usually those of add_values, can be
+scheduled first.  set_top_parents_adjacent is not partitioned on backends
+resolving top parents with the memory strategy of app.lineage, as every
+instance would read the whole samples table.
+
+run_task runs one instance standalone.  Everything it needs comes from its
+arguments: the engine url, the id of the incremental run, the partition,
+chunk_size and mode.  The steps only write what is missing or changed (see
+app.upsert) and an incremental run records its finished chunks, so a task
+that is retried simply repeats what is left.
+
+An Airflow DAG maps each Task to an operator calling run_task and fans the
+partitioned ones out with dynamic task mapping over plan_partitions.  Its
+first task calls app.partitions.prepare_partitions.  Airflow
+is not a dependency of this project.  LocalExecutor runs the same graph on a
+thread pool instead, which is how the tasks are run and tested locally:
+
+    python -m app.tasks
+"""
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextvars import copy_context
+
+from sqlalchemy import and_, func
+
+from app.batching import (
+    CHUNK_SIZE,
+    chunk_ranges,
+    key_range,
+    partition_bounds,
+)
+from app.closure import extend_sample_lineage
+from app.etl import (
+    add_measurement_columns,
+    add_samples_and_experiments,
+    add_values,
+    in_window,
+    set_top_parents_adjacent,
+    set_top_parents_of_root_nodes,
+    start_incremental_run,
+)
+from app.incremental import changed_sample_ids, finish_run
+from app.indexes import MODE_TABLES
+from app.lineage import MEMORY, choose_strategy
+from app.partitions import prepare_partitions
+from app.rollups import update_rollups
+from app.schema import (
+    configure_engine,
+    get_engine,
+    session_scope,
+    EtlRun,
+    Sample,
+    SampleMeasurement,
+)
+from app.storage import DYNAMIC, check_mode
+
+# Number of sample ids each instance of a partitioned task covers.  It must
+#  be a multiple of the chunk_size.
+PARTITION_SIZE = 4 * CHUNK_SIZE
+
+# Number of task instances LocalExecutor runs at the same time.  Each of them
+#  holds a pooled connection, see app.config.
+WORKERS = 4
+
+# step is called with the options named in arguments.  cost_column is the
+#  column of the source rows counted to estimate the cost of an instance.
+Task = namedtuple(
+    "Task", ["name", "step", "upstream", "partitioned", "arguments",
+             "cost_column"])
+
+TaskInstance = namedtuple("TaskInstance", ["task", "partition", "cost"])
+
+STEP_ARGUMENTS = ("chunk_size", "run_id", "mode")
+
+TASKS = [
+    Task("add_measurement_columns", add_measurement_columns, (), False,
+         ("mode",), None),
+    Task("extend_sample_lineage", extend_sample_lineage, (), False,
+         ("sample_ids", "chunk_size"), Sample.id),
+    Task("add_samples_and_experiments", add_samples_and_experiments, (),
+         True, ("sample_ids",) + STEP_ARGUMENTS, Sample.id),
+    Task("add_values", add_values,
+         ("add_measurement_columns", "add_samples_and_experiments"), True,
+         ("sample_ids",) + STEP_ARGUMENTS, SampleMeasurement.sample_id),
+    Task("set_top_parents_of_root_nodes", set_top_parents_of_root_nodes,
+         ("add_values",), True, STEP_ARGUMENTS, Sample.id),
+    Task("set_top_parents_adjacent", set_top_parents_adjacent,
+         ("set_top_parents_of_root_nodes",), True, STEP_ARGUMENTS, Sample.id),
+    Task("update_rollups", update_rollups, ("set_top_parents_adjacent",),
+         False, STEP_ARGUMENTS, SampleMeasurement.sample_id),
+]
+
+TASKS_BY_NAME = {task.name: task for task in TASKS}
+
+# Tasks whose every instance reads the whole samples table with the memory
+#  strategy of app.lineage.
+WHOLE_LINEAGE_TASKS = {"set_top_parents_adjacent"}
+
+
+def check_graph(tasks):
+    """Rejects graphs with unknown upstream tasks or cycles.  Returns the
+    tasks in an order that runs every task after its upstream tasks."""
+    remaining = list(tasks)
+    names = {task.name for task in remaining}
+    ordered, done = [], set()
+    while remaining:
+        ready = [task for task in remaining if done.issuperset(task.upstream)]
+        if not ready:
+            unknown = {
+                name for task in remaining for name in task.upstream
+            } - names
+            if unknown:
+                raise ValueError(f"unknown upstream tasks {sorted(unknown)}")
+            raise ValueError(
+                f"cycle among {sorted(task.name for task in remaining)}")
+        ordered.extend(ready)
+        done.update(task.name for task in ready)
+        remaining = [task for task in remaining if task.name not in done]
+    return ordered
+
+
+def check_partition_size(partition_size, chunk_size):
+    if partition_size % chunk_size:
+        raise ValueError(
+            f"partition_size {partition_size} is not a multiple of"
+            f" chunk_size {chunk_size}")
+
+
+def use_engine(url):
+    """Points the sessions at url unless they already are."""
+    if url is not None and str(get_engine().url) != url:
+        configure_engine(url)
+
+
+def run_window(session, run_id):
+    """Returns the query of the sample ids in the window of the run, or None
+    for a full run."""
+    if run_id is None:
+        return None
+    return changed_sample_ids(session.query(EtlRun).get(run_id))
+
+
+def estimate_cost(session, task, sample_ids, start=None, end=None):
+    """Counts the source rows of task between start and end."""
+    if task.cost_column is None:
+        return 0
+    criteria = [in_window(task.cost_column, sample_ids)]
+    if start is not None:
+        criteria.append(task.cost_column.between(start, end))
+    return session.query(func.count()).filter(and_(*criteria)).scalar()
+
+
+def is_partitioned(session, task):
+    """Whether task is fanned out into partitions on the connected backend."""
+    if task.name in WHOLE_LINEAGE_TASKS:
+        return choose_strategy(session.connection()) != MEMORY
+    return task.partitioned
+
+
+def plan_instances(session, task, sample_ids,
+                   partition_size=PARTITION_SIZE):
+    """Fans task out into its instances, one per partition of the sample ids
+    in the window for a partitioned task, heaviest first."""
+    if not is_partitioned(session, task):
+        return [TaskInstance(
+            task, None, estimate_cost(session, task, sample_ids))]
+    low, high = key_range(session, Sample.id, in_window(Sample.id, sample_ids))
+    if low is None:
+        return []
+    return sorted([
+        TaskInstance(
+            task, bounds, estimate_cost(session, task, sample_ids, *bounds))
+        for bounds in chunk_ranges(low, high, partition_size)
+    ], key=lambda instance: -instance.cost)
+
+
+def plan_partitions(name, url=None, run_id=None,
+                    partition_size=PARTITION_SIZE):
+    """Returns the partitions of the task as the keyword arguments of
+    run_task, for dynamic task mapping."""
+    use_engine(url)
+    with session_scope() as session:
+        return [
+            {"partition": instance.partition, "cost": instance.cost}
+            for instance in plan_instances(
+                session, TASKS_BY_NAME[name], run_window(session, run_id),
+                partition_size)
+        ]
+
+
+def run_task(name, url=None, run_id=None, partition=None,
+             chunk_size=CHUNK_SIZE, mode=DYNAMIC, cost=None):
+    """Runs one instance of the task, limited to partition when it is given.
+    cost is only passed along by plan_partitions."""
+    check_mode(mode)
+    use_engine(url)
+    task = TASKS_BY_NAME[name]
+    with session_scope() as session:
+        options = {
+            "sample_ids": run_window(session, run_id),
+            "chunk_size": chunk_size,
+            "run_id": run_id,
+            "mode": mode,
+        }
+    context = copy_context()
+    if partition is not None:
+        context.run(partition_bounds.set, tuple(partition))
+    return context.run(task.step, **{
+        argument: options[argument] for argument in task.arguments})
+
+
+class LocalExecutor:
+    """Runs the graph of tasks on a pool of worker threads.
+
+    A task is fanned out into its instances once all its upstream tasks
+    finished, so the partitions reflect the rows those wrote.  The instances
+    of all tasks that are ready share the pool, heaviest first.  The first
+    failure stops the run once the running instances finished."""
+
+    def __init__(self, tasks=TASKS, workers=WORKERS):
+        self.tasks = check_graph(tasks)
+        self.workers = workers
+
+    def run(self, url=None, incremental=True, chunk_size=CHUNK_SIZE,
+            partition_size=PARTITION_SIZE, mode=DYNAMIC):
+        check_mode(mode)
+        check_partition_size(partition_size, chunk_size)
+        use_engine(url)
+        prepare_partitions(MODE_TABLES[mode])
+        run_id = start_incremental_run()[0] if incremental else None
+        self.run_graph(
+            url, run_id, chunk_size=chunk_size,
+            partition_size=partition_size, mode=mode)
+        if incremental:
+            with session_scope() as session:
+                finish_run(session, run_id)
+        return run_id
+
+    def run_graph(self, url, run_id, partition_size=PARTITION_SIZE,
+                  **options):
+        done = set()
+        waiting = list(self.tasks)
+        # The number of unfinished instances of every started task.
+        running = {}
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while waiting or futures:
+                ready = [
+                    task for task in waiting
+                    if done.issuperset(task.upstream)]
+                waiting = [task for task in waiting if task not in ready]
+                instances = []
+                with session_scope() as session:
+                    sample_ids = run_window(session, run_id)
+                    for task in ready:
+                        planned = plan_instances(
+                            session, task, sample_ids, partition_size)
+                        running[task.name] = len(planned)
+                        instances.extend(planned)
+                for task in ready:
+                    if not running[task.name]:
+                        # NOTE:  In production code this would be changed
+                        #  to a logger
+                        print(f"{task.name}: nothing to do")
+                        done.add(task.name)
+                if not instances:
+                    if ready:
+                        continue
+                    if not futures:
+                        break
+                instances.sort(key=lambda instance: -instance.cost)
+                for instance in instances:
+                    futures[pool.submit(
+                        self.run_instance, instance, url, run_id, options
+                    )] = instance
+
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    instance = futures.pop(future)
+                    if future.exception() is not None:
+                        for pending in futures:
+                            pending.cancel()
+                        wait(futures)
+                        raise future.exception()
+                    running[instance.task.name] -= 1
+                    if not running[instance.task.name]:
+                        done.add(instance.task.name)
+        return done
+
+    def run_instance(self, instance, url, run_id, options):
+        began = time.perf_counter()
+        rows = run_task(
+            instance.task.name, url, run_id, instance.partition, **options)
+        # NOTE:  In production code this would be changed to a logger
+        print(f"{instance.task.name}: partition {instance.partition}"
+              f" (cost {instance.cost}) finished"
+              f" in {time.perf_counter() - began:.3f}s")
+        return rows
+
+
+if __name__ == "__main__":
+    LocalExecutor().run()
@@ -0,0 +1,142 @@
+"""A minimal INSERT ... SELECT upsert construct.
+
+SQLAlchemy only ships dialect specific upserts for some backends.  Upsert
+renders the native form for each backend the pipeline supports so a whole
+batch can be written with one statement:
+
+* MySQL: INSERT ... SELECT ... ON DUPLICATE KEY UPDATE
+* SQLite and PostgreSQL: INSERT ... SELECT ... ON CONFLICT DO UPDATE
+
+With only_changed existing rows are only written when one of the
+update_columns changes.  SQLite and PostgreSQL get a WHERE clause on the
+update for this.  MySQL already leaves a row alone when the update sets it to
+its current values, it then neither writes it nor logs it in the row based
+binlog.
+
+The rowcount of an upsert depends on the backend.  On SQLite and PostgreSQL
+it counts the rows inserted or updated, so with only_changed a rerun over
+the same data counts 0.  MySQLdb and PyMySQL connect with CLIENT_FOUND_ROWS
+under SQLAlchemy, so MySQL counts 1 per inserted row, 2 per updated row and
+1 per row that matched but was left unchanged.  There a rerun counts every
+row it matched even though it writes none of them.
+
+merge combines the existing value of an update column with the new one
+instead of overwriting it: SUM adds them, MIN and MAX keep the smaller or
+larger one.  This merges partial aggregates, see app.rollups.
+
+partition names the partition of a MySQL table all rows go to, so only it
+is locked (see app.partitions).  Other backends ignore it.
+"""
+from sqlalchemy import insert, true
+from sqlalchemy.exc import CompileError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+SUM = "sum"
+MIN = "min"
+MAX = "max"
+
+# The scalar functions picking the smaller or larger of two values.
+MERGE_FUNCTIONS = {
+    "mysql": {MIN: "LEAST", MAX: "GREATEST"},
+    "postgresql": {MIN: "LEAST", MAX: "GREATEST"},
+    "sqlite": {MIN: "MIN", MAX: "MAX"},
+}
+
+
+class Upsert(Executable, ClauseElement):
+    """Inserts the rows produced by select into the columns of table.  Rows
+    whose index_elements already exist have their update_columns
+    overwritten instead, or merged with the new values for the columns in
+    merge, a dict of column name to SUM, MIN or MAX.  partition limits a
+    MySQL upsert to a partition of table."""
+    _execution_options = Executable._execution_options.union(
+        {"autocommit": True})
+    # Compiling the embedded INSERT flags the compiler as an insert, which
+    #  then looks for a RETURNING clause on this element.
+    _returning = None
+
+    def __init__(self, table, columns, select, index_elements,
+                 update_columns, only_changed=False, merge=None,
+                 partition=None):
+        self.table = table
+        self.columns = columns
+        self.select = select
+        self.index_elements = index_elements
+        self.update_columns = update_columns
+        self.only_changed = only_changed
+        self.merge = merge or {}
+        self.partition = partition
+
+    def insert_from_select(self, select=None):
+        select = self.select if select is None else select
+        return insert(self.table).from_select(self.columns, select)
+
+    def assignment(self, compiler, name, existing, new):
+        """Renders the value an update assigns to the column."""
+        how = self.merge.get(name)
+        if how is None:
+            return new
+        if how == SUM:
+            return f"{existing} + {new}"
+        function = MERGE_FUNCTIONS[compiler.dialect.name][how]
+        return f"{function}({existing}, {new})"
+
+
+@compiles(Upsert)
+def compile_upsert(element, compiler, **kw):
+    raise CompileError(
+        f"Upsert is not supported by the {compiler.dialect.name} dialect")
+
+
+@compiles(Upsert, "mysql")
+def compile_upsert_mysql(element, compiler, **kw):
+    quote = compiler.preparer.quote
+    if element.update_columns:
+        assignments = ", ".join(
+            f"{quote(name)} = " + element.assignment(
+                compiler, name, quote(name), f"VALUES({quote(name)})")
+            for name in element.update_columns
+        )
+    else:
+        # MySQL has no DO NOTHING, a no-op assignment of the key stands in.
+        key = quote(element.index_elements[0])
+        assignments = f"{key} = {key}"
+    insert_sql = compiler.process(element.insert_from_select(), **kw)
+    if element.partition is not None:
+        into = f"INSERT INTO {quote(element.table.name)} "
+        insert_sql = insert_sql.replace(
+            into, f"{into}PARTITION ({quote(element.partition)}) ", 1)
+    return f"{insert_sql} ON DUPLICATE KEY UPDATE {assignments}"
+
+
+@compiles(Upsert, "sqlite")
+@compiles(Upsert, "postgresql")
+def compile_upsert_on_conflict(element, compiler, **kw):
+    quote = compiler.preparer.quote
+    index_elements = ", ".join(map(quote, element.index_elements))
+    if element.update_columns:
+        table = quote(element.table.name)
+        action = "DO UPDATE SET " + ", ".join(
+            f"{quote(name)} = " + element.assignment(
+                compiler, name, f"{table}.{quote(name)}",
+                f"excluded.{quote(name)}")
+            for name in element.update_columns
+        )
+        if element.only_changed:
+            distinct = (
+                "IS NOT" if compiler.dialect.name == "sqlite"
+                else "IS DISTINCT FROM")
+            action += " WHERE " + " OR ".join(
+                f"{table}.{name} {distinct} excluded.{name}"
+                for name in map(quote, element.update_columns)
+            )
+    else:
+        action = "DO NOTHING"
+    # SQLite requires the SELECT of an upsert to have a WHERE clause, else
+    #  ON CONFLICT is parsed as a join constraint.
+    insert_stmt = element.insert_from_select(element.select.where(true()))
+    return (
+        f"{compiler.process(insert_stmt, **kw)}"
+        f" ON CONFLICT ({index_elements}) {action}"
+    )
@@ -0,0 +1,216 @@
+"""Vectorized in-memory transform for reprocessing a full snapshot.
+
+Instead of pushing every step into SQL, this transform pulls the source tables
+into NumPy arrays and computes the whole experiment_measurements table in
+memory:
+
+* samples is streamed once into sorted id, parent and experiment arrays.
+  Top parents are resolved by pointer jumping over the parent index array:
+  every round replaces each pointer by the pointer of its target, so after k
+  rounds every sample points 2 ** k generations up.  log2(n) rounds of whole
+  array operations resolve trees of any depth.
+* sample_measurements is read one chunk of sample ids at a time and pivoted
+  by scattering the values into a (sample, measurement_type) array.
+* each chunk of experiment_measurements is replaced by a DELETE and a bulk
+  executemany INSERT, using app.batching so chunks commit one at a time and
+  can be fanned out to workers.  A partitioned table is rebuilt a partition
+  at a time instead, which is loaded aside and exchanged as a whole (see
+  app.partitions).
+
+Memory grows with the number of samples for the lineage arrays and with the
+chunk size for the pivot.  Samples caught in a parent cycle or below a missing
+parent have no root and keep a NULL top_parent_id, as with the cte strategy
+of app.lineage.
+"""
+import numpy as np
+from sqlalchemy import delete, or_, select
+
+from app.batching import CHUNK_SIZE, run_chunked
+from app.partitions import (
+    PARTITION_SIZE,
+    load_into,
+    partitions,
+    rebuild_partition,
+    staging_table,
+)
+from app.schema import inject_session, Sample, SampleMeasurement
+from app.storage import DYNAMIC, get_model, measurement_columns
+
+VECTORIZED = "vectorized"
+
+# Number of samples rows fetched from the cursor at a time.
+READ_BATCH_SIZE = 100000
+
+NO_PARENT = -1
+
+
+def read_samples(session, batch_size=READ_BATCH_SIZE, after=None,
+                 sample_ids=None):
+    """Streams the samples table, or its samples with an id above after or
+    in sample_ids, into arrays of ids, parent ids and experiment ids, sorted
+    by id.  Missing parents are NO_PARENT and missing experiments NaN."""
+    samples = Sample.__table__
+    query = select([
+        samples.c.id, samples.c.parent_id, samples.c.experiment_id
+    ]).order_by(samples.c.id)
+    criteria = []
+    if after is not None:
+        criteria.append(samples.c.id > after)
+    if sample_ids is not None:
+        criteria.append(samples.c.id.in_(sample_ids))
+    if criteria:
+        query = query.where(or_(*criteria))
+    result = session.connection().execution_options(
+        stream_results=True
+    ).execute(query)
+    batches = []
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        # None becomes NaN in a float array.  NumPy reads tuples much
+        #  faster than result rows.
+        batches.append(np.array(
+            [tuple(row) for row in rows], dtype=np.float64))
+    if not batches:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float64)
+    table = np.concatenate(batches)
+    parents = np.where(np.isnan(table[:, 1]), NO_PARENT, table[:, 1])
+    return (
+        table[:, 0].astype(np.int64),
+        parents.astype(np.int64),
+        table[:, 2],
+    )
+
+
+def find_tops_vectorized(ids, parents):
+    """Given sorted ids and their parent ids (NO_PARENT for roots) returns
+    the position in ids of the topmost ancestor of every sample: its root,
+    the sample whose parent is not in ids, or a sample of its cycle."""
+    n = len(ids)
+    positions = np.arange(n)
+    parent_positions = np.minimum(
+        np.searchsorted(ids, parents), max(n - 1, 0))
+    has_parent = (parents != NO_PARENT) & (ids[parent_positions] == parents)
+    pointers = np.where(has_parent, parent_positions, positions)
+    for _ in range(int(np.ceil(np.log2(n + 1))) + 1):
+        jumped = pointers[pointers]
+        if np.array_equal(jumped, pointers):
+            break
+        pointers = jumped
+    return pointers
+
+
+def find_roots_vectorized(ids, parents):
+    """Given sorted ids and their parent ids (NO_PARENT for roots) returns
+    the root id of every sample, or NO_PARENT if it is part of a cycle or
+    descends from a sample whose parent is missing, like the SQL resolvers
+    in app.lineage."""
+    tops = find_tops_vectorized(ids, parents)
+    # The top of a cycle or below a missing parent still has a parent.
+    return np.where(parents[tops] == NO_PARENT, ids[tops], NO_PARENT)
+
+
+def pivot(sample_ids, measurement_types, values):
+    """Pivots measurement rows into a (sample, measurement_type) array.
+    Returns the sorted distinct sample ids, the sorted distinct types and the
+    array, which holds None where a sample has no value of a type."""
+    row_ids, rows = np.unique(sample_ids, return_inverse=True)
+    types, columns = np.unique(measurement_types, return_inverse=True)
+    # An object array keeps the Decimals of the driver exact.
+    table = np.full((len(row_ids), len(types)), None, dtype=object)
+    table[rows, columns] = values
+    return row_ids, types, table
+
+
+@inject_session
+def transform_vectorized(session, chunk_size=CHUNK_SIZE, run_id=None,
+                         workers=1, mode=DYNAMIC, target=None):
+    """Rebuilds every row of the table of the storage mode from a full
+    snapshot of samples and sample_measurements.  The measurement columns
+    must exist already, see app.etl.add_measurement_columns.
+
+    target names an empty table with the same columns to fill instead, with
+    inserts only, see app.shadow."""
+    ExperimentMeasurement = get_model(mode)
+    em_table = ExperimentMeasurement.__table__
+    ids, parents, experiments = read_samples(session)
+    if not len(ids):
+        print("transform_vectorized: no samples")
+        return
+    roots = find_roots_vectorized(ids, parents)
+    print(f"Resolved top parents of {len(ids)} samples,"
+          f" {int((roots == NO_PARENT).sum())} have none")
+
+    def chunk_mappings(session, start, end):
+        low, high = np.searchsorted(ids, [start, end + 1])
+        measurements = session.execute(select([
+            SampleMeasurement.sample_id,
+            SampleMeasurement.measurement_type,
+            SampleMeasurement.value,
+        ]).where(SampleMeasurement.sample_id.between(start, end))).fetchall()
+        # Samples that committed after the snapshot are left to the next
+        #  run, their measurements have no row to go to.
+        snapshot = set(ids[low:high].tolist())
+        measurements = [
+            measurement for measurement in measurements
+            if measurement.sample_id in snapshot
+        ]
+        if measurements:
+            sample_ids, measurement_types, values = zip(*measurements)
+            row_ids, types, table = pivot(
+                np.array(sample_ids), np.array(measurement_types),
+                np.array(values, dtype=object))
+        else:
+            row_ids = np.empty(0, dtype=np.int64)
+            types = []
+            table = np.empty((0, 0), dtype=object)
+        column_names = measurement_columns(session, list(types), mode)
+        columns = [column_names[mt] for mt in types]
+
+        chunk_values = np.full((high - low, len(types)), None, dtype=object)
+        chunk_values[np.searchsorted(ids[low:high], row_ids)] = table
+        mappings = []
+        for offset, position in enumerate(range(low, high)):
+            experiment = experiments[position]
+            root = roots[position]
+            mapping = {
+                "sample_id": int(ids[position]),
+                "experiment_id": (
+                    None if np.isnan(experiment) else int(experiment)),
+                "top_parent_id": None if root == NO_PARENT else int(root),
+            }
+            mapping.update(zip(columns, chunk_values[offset]))
+            mappings.append(mapping)
+        return mappings
+
+    def load(session, target, start, end):
+        return load_into(session, target, chunk_mappings(session, start, end))
+
+    def load_chunk(session, start, end):
+        session.execute(delete(em_table).where(
+            em_table.c.sample_id.between(start, end)))
+        return load(session, em_table, start, end)
+
+    def load_partition(session, start, end):
+        return rebuild_partition(
+            session, em_table, start, end, load, chunk_size)
+
+    if target is not None:
+        target_table = staging_table(em_table, target)
+
+        def load_target(session, start, end):
+            return load(session, target_table, start, end)
+
+        return run_chunked(
+            session, "transform_vectorized", load_target,
+            int(ids[0]), int(ids[-1]), chunk_size, run_id, workers)
+    if partitions(session.connection(), em_table.name):
+        # Every partition is loaded aside and swapped in as a whole.
+        run_chunked(session, "transform_vectorized", load_partition,
+                    int(ids[0]), int(ids[-1]), PARTITION_SIZE, run_id,
+                    workers)
+        return
+    run_chunked(session, "transform_vectorized", load_chunk,
+                int(ids[0]), int(ids[-1]), chunk_size, run_id, workers)
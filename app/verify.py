@@ -0,0 +1,414 @@
+"""Verification of the flattened measurements against the source tables.
+
+Every row of the table of the storage mode is checked, without walking the
+sample trees one row at a time:
+
+* the samples table is streamed once and the expected top parent of every
+  sample is computed by walking the parents in python, with every walked
+  chain remembered so each sample is visited once.  A check of the window
+  of a run only streams its samples and their ancestors, which a recursive
+  CTE finds on the backends that have one.  The sample_id, experiment_id
+  and top_parent_id columns are streamed and compared to it with array
+  operations, which also finds missing and extra rows.  Samples
+  caught in a parent cycle or below a missing parent are expected to have a
+  NULL top_parent_id.
+* the measurement values are compared inside the database, one chunk of
+  sample ids at a time.  Each chunk pivots sample_measurements as add_values
+  does and joins it to the table, returning only the rows where a column is
+  distinct from its expected value.
+
+The top parents are computed independently of the resolvers of app.lineage
+and of app.vectorized, so the verifier does not share the bugs of the
+transform that wrote them.
+
+Samples can change while a run is loaded and verified.  A run of the
+pipeline passes the samples whose change log rows no run claimed yet as
+pending.  Their rows are not checked, the next run loads and checks the
+change.  Types registered by their measurements only get a column in the
+next run as well.
+
+verify returns a VerificationReport counting the mismatches of every kind
+and keeping the first max_mismatches of them.  pipeline(verify=True) runs it
+after every run and raises VerificationError when any are found.
+"""
+import json
+
+import numpy as np
+from sqlalchemy import and_, case, exists, func, or_, select, true
+from sqlalchemy.sql import ClauseElement
+
+from app.batching import CHUNK_SIZE, chunk_ranges, key_range
+from app.lineage import CTE, MAX_TREE_DEPTH, choose_strategy
+from app.schema import (
+    inject_session,
+    MeasurementType,
+    Sample,
+    SampleMeasurement,
+)
+from app.storage import DYNAMIC, SLOTS, get_model
+
+# Kinds of mismatches.
+MISSING_ROW = "missing_row"
+EXTRA_ROW = "extra_row"
+EXPERIMENT_ID = "experiment_id"
+TOP_PARENT_ID = "top_parent_id"
+MISSING_COLUMN = "missing_column"
+MEASUREMENT = "measurement"
+
+# Number of mismatches kept in a report.  All of them are counted.
+MAX_MISMATCHES = 100
+
+# Number of rows fetched from the cursor at a time.
+READ_BATCH_SIZE = 100000
+
+
+class VerificationReport:
+    """Mismatches found by verify."""
+
+    def __init__(self, max_mismatches=MAX_MISMATCHES):
+        self.max_mismatches = max_mismatches
+        self.rows = 0
+        self.counts = {}
+        self.mismatches = []
+
+    @property
+    def ok(self):
+        return not self.counts
+
+    def add(self, kind, sample_id=None, column=None, expected=None,
+            actual=None):
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        if len(self.mismatches) < self.max_mismatches:
+            self.mismatches.append({
+                "kind": kind,
+                "sample_id": sample_id,
+                "column": column,
+                "expected": expected,
+                "actual": actual,
+            })
+
+    def add_arrays(self, kind, sample_ids, expected=None, actual=None):
+        """Adds one mismatch per element of the arrays, in which NaN stands
+        for NULL.  The mismatches of a column are named after the column."""
+        if not len(sample_ids):
+            return
+        self.counts[kind] = self.counts.get(kind, 0) + len(sample_ids)
+        keep = max(self.max_mismatches - len(self.mismatches), 0)
+        for position, sample_id in enumerate(sample_ids[:keep].tolist()):
+            self.mismatches.append({
+                "kind": kind,
+                "sample_id": sample_id,
+                "column": None if expected is None else kind,
+                "expected": None if expected is None else nullable(
+                    expected[position]),
+                "actual": None if actual is None else nullable(
+                    actual[position]),
+            })
+
+    def as_dict(self):
+        return {
+            "ok": self.ok,
+            "rows": self.rows,
+            "counts": self.counts,
+            "mismatches": self.mismatches,
+        }
+
+
+class VerificationError(ValueError):
+    """Raised by pipeline when the verification of a run failed."""
+
+    def __init__(self, report):
+        super().__init__(
+            f"verification found mismatches: {json.dumps(report.counts)}")
+        self.report = report
+
+
+def nullable(value):
+    return None if np.isnan(value) else int(value)
+
+
+def window_ids(session, sample_ids):
+    """Returns the ids of sample_ids, which is either a list of ids or a
+    query of them as made by app.incremental.changed_sample_ids."""
+    if isinstance(sample_ids, ClauseElement):
+        sample_ids = [sample_id for (sample_id,) in session.execute(
+            sample_ids)]
+    return np.array(sorted(sample_ids), dtype=np.int64)
+
+
+def read_rows(session, table, criteria, batch_size=READ_BATCH_SIZE):
+    """Streams the sample_id, experiment_id and top_parent_id columns of the
+    rows of table matching criteria into a float array, where NULL is
+    NaN."""
+    result = session.connection().execution_options(
+        stream_results=True
+    ).execute(select([
+        table.c.sample_id, table.c.experiment_id, table.c.top_parent_id
+    ]).where(criteria).order_by(table.c.sample_id))
+    batches = []
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        batches.append(np.array(
+            [tuple(row) for row in rows], dtype=np.float64))
+    if not batches:
+        return np.empty((0, 3), dtype=np.float64)
+    return np.concatenate(batches)
+
+
+def differs(expected, actual):
+    """Compares float arrays where NaN equals NaN."""
+    both_null = np.isnan(expected) & np.isnan(actual)
+    return ~((expected == actual) | both_null)
+
+
+def expected_top_parents(parents):
+    """Given a mapping of sample id -> parent id (None for roots) returns a
+    mapping of sample id -> top parent, None for the samples in a cycle or
+    below a missing parent."""
+    top_parents = {}
+    for sample_id in parents:
+        chain = []
+        on_chain = set()
+        node = sample_id
+        while node not in top_parents:
+            if node not in parents or node in on_chain:
+                top_parent = None
+                break
+            chain.append(node)
+            on_chain.add(node)
+            if parents[node] is None:
+                top_parent = node
+                break
+            node = parents[node]
+        else:
+            top_parent = top_parents[node]
+        top_parents.update(dict.fromkeys(chain, top_parent))
+    return top_parents
+
+
+def ancestry(session, sample_ids):
+    """Returns the criteria selecting the samples of sample_ids and all their
+    ancestors, found by a recursive CTE walking up from sample_ids, or None
+    when the backend cannot run one."""
+    if choose_strategy(session.connection()) != CTE:
+        return None
+    dialect = session.get_bind().dialect
+    if dialect.name == "mysql" and not getattr(dialect, "_is_mariadb", False):
+        session.execute(
+            f"SET SESSION cte_max_recursion_depth = {MAX_TREE_DEPTH}")
+    samples = Sample.__table__
+    parent = samples.alias("parent")
+    walk = select([samples.c.id, samples.c.parent_id]).where(
+        samples.c.id.in_(sample_ids)).cte("walk", recursive=True)
+    # UNION rather than UNION ALL, so a walk around a cycle ends.
+    walk = walk.union(select([parent.c.id, parent.c.parent_id]).select_from(
+        parent.join(walk, parent.c.id == walk.c.parent_id)))
+    return samples.c.id.in_(select([walk.c.id]))
+
+
+def read_lineage(session, batch_size=READ_BATCH_SIZE, sample_ids=None):
+    """Returns the sorted ids of all samples, or of the samples of sample_ids
+    and their ancestors, with their experiments and expected top parents, as
+    float arrays where NULL is NaN."""
+    samples = Sample.__table__
+    query = select([
+        samples.c.id, samples.c.parent_id, samples.c.experiment_id
+    ]).order_by(samples.c.id)
+    if sample_ids is not None:
+        criteria = ancestry(session, sample_ids)
+        if criteria is not None:
+            query = query.where(criteria)
+    result = session.connection().execution_options(
+        stream_results=True
+    ).execute(query)
+    parents = {}
+    experiments = []
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        for sample_id, parent_id, experiment_id in rows:
+            parents[sample_id] = parent_id
+            experiments.append(experiment_id)
+    top_parents = expected_top_parents(parents)
+    # None becomes NaN in a float array.
+    return (
+        np.fromiter(parents, dtype=np.int64, count=len(parents)),
+        np.array(experiments, dtype=np.float64),
+        np.array(
+            [top_parents[sample_id] for sample_id in parents],
+            dtype=np.float64),
+    )
+
+
+def verify_rows(session, report, table, sample_ids=None, lineage=None,
+                pending=None):
+    """Checks which rows exist and their experiment_id and top_parent_id.
+
+    lineage is the result of read_lineage, which is read here when it is
+    None.  When it was read before, samples added since are left out of a
+    check of all samples.  The samples in pending are left out as well.
+    They are read last, so a sample that changed while it was checked is
+    among them."""
+    if lineage is None:
+        lineage = read_lineage(session, sample_ids=sample_ids)
+        newest = true()
+    else:
+        newest = table.c.sample_id <= (
+            int(lineage[0][-1]) if len(lineage[0]) else 0)
+    ids, experiments, roots = lineage
+
+    if sample_ids is None:
+        rows = read_rows(session, table, newest)
+        expected_ids = ids
+    else:
+        rows = read_rows(session, table, table.c.sample_id.in_(sample_ids))
+        expected_ids = ids[np.isin(ids, window_ids(session, sample_ids))]
+    report.rows += len(rows)
+    row_ids = rows[:, 0].astype(np.int64)
+
+    missing = np.setdiff1d(expected_ids, row_ids)
+    positions = np.minimum(
+        np.searchsorted(ids, row_ids), max(len(ids) - 1, 0))
+    if len(ids):
+        known = ids[positions] == row_ids
+    else:
+        known = np.zeros(len(row_ids), dtype=bool)
+    extra = row_ids[~known]
+    rows, positions = rows[known], positions[known]
+    wrong_columns = []
+    for kind, expected, actual in [
+        (EXPERIMENT_ID, experiments[positions], rows[:, 1]),
+        (TOP_PARENT_ID, roots[positions], rows[:, 2]),
+    ]:
+        wrong = differs(expected, actual)
+        wrong_columns.append((
+            kind, rows[wrong, 0].astype(np.int64), expected[wrong],
+            actual[wrong]))
+
+    if pending is not None:
+        skipped = window_ids(session, pending)
+        missing = missing[~np.isin(missing, skipped)]
+        extra = extra[~np.isin(extra, skipped)]
+        wrong_columns = [
+            (kind, wrong_ids[keep], expected[keep], actual[keep])
+            for kind, wrong_ids, expected, actual in wrong_columns
+            for keep in [~np.isin(wrong_ids, skipped)]
+        ]
+    report.add_arrays(MISSING_ROW, missing)
+    report.add_arrays(EXTRA_ROW, extra)
+    for kind, wrong_ids, expected, actual in wrong_columns:
+        report.add_arrays(kind, wrong_ids, expected, actual)
+
+
+def value_columns(session, report, table, mode, pending=None):
+    """Returns a mapping of every registered measurement_type to the column
+    holding its values, reporting the types without a column.  Types that
+    were registered by measurements of the samples in pending are left to
+    the next run instead."""
+    columns = {}
+    for measurement_type, slot in session.query(
+        MeasurementType.measurement_type,
+        MeasurementType.slot,
+    ).order_by(MeasurementType.measurement_type):
+        if mode == SLOTS:
+            column = None if slot is None else f"slot_{slot}"
+        else:
+            column = f"measurement_{measurement_type}"
+        if column is not None and column in table.c:
+            columns[measurement_type] = column
+        elif pending is None or not session.query(exists().where(and_(
+                SampleMeasurement.measurement_type == measurement_type,
+                SampleMeasurement.sample_id.in_(pending),
+        ))).scalar():
+            report.add(
+                MISSING_COLUMN, column=column, expected=measurement_type)
+    return columns
+
+
+def verify_values(session, report, table, mode, sample_ids=None,
+                  chunk_size=CHUNK_SIZE, pending=None):
+    """Checks every measurement column of every row against the pivot of
+    sample_measurements, leaving out the samples in pending.  They are
+    left out by the same statement that compares the values, so a value
+    that changed while it was checked is never reported."""
+    columns = value_columns(session, report, table, mode, pending)
+    if not columns:
+        return
+    window = true() if sample_ids is None else table.c.sample_id.in_(
+        sample_ids)
+    if pending is not None:
+        window = and_(window, ~table.c.sample_id.in_(pending))
+    low, high = key_range(session, table.c.sample_id, window)
+    if low is None:
+        return
+    measurement_types = list(columns)
+    for start, end in chunk_ranges(low, high, chunk_size):
+        expected = select([SampleMeasurement.sample_id] + [
+            func.max(case(
+                [(SampleMeasurement.measurement_type == mt,
+                  SampleMeasurement.value)]
+            )).label(columns[mt])
+            for mt in measurement_types
+        ]).where(
+            SampleMeasurement.sample_id.between(start, end)
+        ).group_by(SampleMeasurement.sample_id).alias("expected")
+        pairs = [
+            (expected.c[columns[mt]], table.c[columns[mt]])
+            for mt in measurement_types
+        ]
+        query = select(
+            [table.c.sample_id]
+            + [expected_column for expected_column, _ in pairs]
+            + [actual_column for _, actual_column in pairs]
+        ).select_from(table.outerjoin(
+            expected, expected.c.sample_id == table.c.sample_id
+        )).where(and_(
+            table.c.sample_id.between(start, end),
+            window,
+            or_(*[
+                actual_column.is_distinct_from(expected_column)
+                for expected_column, actual_column in pairs
+            ]),
+        )).apply_labels()
+        for row in session.execute(query):
+            values = list(row)
+            for position, mt in enumerate(measurement_types):
+                expected_value = values[1 + position]
+                actual_value = values[1 + len(pairs) + position]
+                if expected_value != actual_value:
+                    report.add(
+                        MEASUREMENT, values[0], columns[mt],
+                        expected_value, actual_value)
+
+
+def verify(session, sample_ids=None, mode=DYNAMIC, chunk_size=CHUNK_SIZE,
+           max_mismatches=MAX_MISMATCHES, lineage=None, pending=None):
+    """Verifies the rows of the samples in sample_ids, or of all samples when
+    it is None, of the table of the storage mode.  lineage can be read ahead
+    with read_lineage, e.g. while the rows are still being written.  pending
+    is a query of the ids of samples that changed after the run began, as
+    made by app.incremental.pending_sample_ids, whose rows are not checked.
+    Returns a VerificationReport."""
+    report = VerificationReport(max_mismatches)
+    table = get_model(mode).__table__
+    verify_rows(session, report, table, sample_ids, lineage, pending)
+    verify_values(
+        session, report, table, mode, sample_ids, chunk_size, pending)
+    return report
+
+
+@inject_session
+def verify_experiment_measurements(session, sample_ids=None, mode=DYNAMIC,
+                                   chunk_size=CHUNK_SIZE,
+                                   max_mismatches=MAX_MISMATCHES,
+                                   lineage=None, pending=None):
+    """Runs verify in a session of its own and prints the report."""
+    report = verify(
+        session, sample_ids, mode, chunk_size, max_mismatches, lineage,
+        pending)
+    # NOTE:  In production code this would be changed to a logger
+    print(json.dumps(report.as_dict(), default=str))
+    return report
@@ -0,0 +1,129 @@
+"""Benchmarks the pivot load of app.etl.add_values against the original
+approach of one correlated UPDATE per measurement_type.
+
+    python -m benchmarks.add_values --url sqlite:///bench.db
+
+Every case recreates the database (see benchmarks.suite), generates n root
+samples with a measurement for a random share of the measurement types and
+times both approaches on the same data.  The per-type baseline uses MySQL's
+multi-table UPDATE, and a correlated subquery on the other backends.
+"""
+import argparse
+import os
+import time
+
+from sqlalchemy import and_, select, update
+
+from app.config import DEFAULT_URL
+from app.database import reset_database
+from app.etl import add_measurement_columns, add_samples_and_experiments
+from app.etl import add_values
+from app.schema import (
+    inject_session,
+    session_scope,
+    SampleMeasurement,
+    get_ExperimentMeasurement,
+)
+
+from benchmarks.generate import generate
+
+SAMPLES = 10000
+TYPE_COUNTS = [5, 50, 100, 250, 500]
+# Probability that a sample has a value of a given measurement type.
+DENSITY = .1
+EXPERIMENTS = 20
+
+
+@inject_session
+def add_values_per_type(session):
+    """The original add_values, kept as the baseline of this benchmark."""
+    ExperimentMeasurement = get_ExperimentMeasurement()
+    new_measurements = session.query(
+        ExperimentMeasurement.sample_id
+    ).filter(ExperimentMeasurement.top_parent_id.is_(None))
+    measurement_types = session.query(
+        SampleMeasurement.measurement_type
+    ).filter(
+        SampleMeasurement.sample_id.in_(new_measurements)
+    ).distinct()
+    multi_table = session.get_bind().dialect.name == "mysql"
+    for (mt,) in measurement_types:
+        if multi_table:
+            measurement_values = select([
+                SampleMeasurement.sample_id,
+                SampleMeasurement.value
+            ]).where(
+                SampleMeasurement.measurement_type == mt
+            ).alias()
+            session.execute(update(
+                ExperimentMeasurement
+            ).where(
+                ExperimentMeasurement.sample_id
+                ==
+                measurement_values.columns.sample_id
+            ).values(**{
+                f"measurement_{mt}": measurement_values.columns.value}))
+        else:
+            session.execute(update(ExperimentMeasurement).where(
+                ExperimentMeasurement.sample_id.in_(select([
+                    SampleMeasurement.sample_id
+                ]).where(SampleMeasurement.measurement_type == mt))
+            ).values(**{f"measurement_{mt}": select([
+                SampleMeasurement.value
+            ]).where(and_(
+                SampleMeasurement.sample_id == ExperimentMeasurement.sample_id,
+                SampleMeasurement.measurement_type == mt,
+            )).as_scalar()}))
+        session.commit()
+
+
+def prepare(url, n, type_count):
+    """Recreates the database with n root samples and loads their rows
+    without values.  Returns the engine."""
+    engine = reset_database(url)
+    generate(n, depth=1, experiment_size=max(n // EXPERIMENTS, 1),
+             types=type_count, density=DENSITY)
+    add_measurement_columns()
+    add_samples_and_experiments()
+    return engine
+
+
+def clear_values():
+    ExperimentMeasurement = get_ExperimentMeasurement()
+    columns = [
+        c.name for c in ExperimentMeasurement.__table__.c
+        if c.name.startswith("measurement_")
+    ]
+    with session_scope() as session:
+        session.execute(update(ExperimentMeasurement).values(
+            **{name: None for name in columns}))
+
+
+def timed(step):
+    start = time.perf_counter()
+    step()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--url", default=os.environ.get("SQL_URL", DEFAULT_URL))
+    parser.add_argument("--samples", type=int, default=SAMPLES)
+    parser.add_argument(
+        "--types", nargs="+", type=int, default=TYPE_COUNTS)
+    args = parser.parse_args()
+
+    print("types  per_type_s  pivot_s  speedup")
+    for type_count in args.types:
+        engine = prepare(args.url, args.samples, type_count)
+        per_type = timed(add_values_per_type)
+        clear_values()
+        pivot = timed(add_values)
+        engine.dispose()
+        print(f"{type_count:5d}  {per_type:10.2f}  {pivot:7.2f}"
+              f"  {per_type / pivot:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Fast, reproducible generation of synthetic samples and measurements.
+
+Unlike tests.generate, which builds one dict per sample and re-queries the
+database to find the samples it created, this generator computes ids, parents
+and measurements with NumPy and writes them with batched executemany INSERTs,
+so it scales to tens of millions of samples.
+
+The shape of the data is controlled by:
+
+* samples: the number of samples.
+* depth and fan_out: samples form complete trees with depth generations in
+  which every sample has fan_out children.  fan_out=1 gives chains of depth
+  samples.
+* experiment_size: the number of consecutive samples sharing an experiment.
+* types: the number of distinct measurement_types.
+* density: the probability that a sample has a measurement of a given type.
+
+The same parameters and seed always give the same data.
+"""
+import numpy as np
+from sqlalchemy import func, insert
+
+from app.schema import inject_session, Sample, SampleMeasurement
+
+# Number of samples generated and inserted at a time.
+BATCH_SIZE = 100000
+
+
+def tree_size(depth, fan_out):
+    """Returns the number of samples of a complete tree."""
+    if fan_out == 1:
+        return depth
+    return (fan_out ** depth - 1) // (fan_out - 1)
+
+
+def sample_rows(first_id, start, stop, depth, fan_out, experiment_size):
+    """Returns the ids, parent ids and experiment ids of the samples numbered
+    start to stop.  Samples are numbered in breadth first order within their
+    tree, so the parent of the k-th sample of a tree is its
+    (k - 1) // fan_out-th sample."""
+    size = tree_size(depth, fan_out)
+    numbers = np.arange(start, stop)
+    position = numbers % size
+    root = numbers - position
+    parents = np.where(
+        position == 0, -1, first_id + root + (position - 1) // fan_out)
+    return (
+        first_id + numbers,
+        parents,
+        numbers // experiment_size + 1,
+    )
+
+
+def measurement_rows(rng, sample_ids, types, density):
+    """Returns the sample ids, type numbers and values of the measurements of
+    sample_ids.  Each sample has a measurement of each type with probability
+    density."""
+    has_value = rng.random((len(sample_ids), types)) < density
+    rows, type_numbers = np.nonzero(has_value)
+    values = np.round(rng.random(len(rows)) * 100, 6)
+    return sample_ids[rows], type_numbers, values
+
+
+@inject_session
+def generate(session, samples, depth=10, fan_out=2, experiment_size=1000,
+             types=10, density=.5, seed=0, batch_size=BATCH_SIZE):
+    """Appends samples new samples and their measurements to the database."""
+    rng = np.random.default_rng(seed)
+    first_id = (session.query(func.max(Sample.id)).scalar() or 0) + 1
+    sample_table = Sample.__table__
+    measurement_table = SampleMeasurement.__table__
+    for start in range(0, samples, batch_size):
+        stop = min(start + batch_size, samples)
+        ids, parents, experiments = sample_rows(
+            first_id, start, stop, depth, fan_out, experiment_size)
+        session.execute(insert(sample_table), [
+            {
+                "id": sample_id,
+                "parent_id": None if parent == -1 else parent,
+                "experiment_id": experiment,
+            }
+            for sample_id, parent, experiment in zip(
+                ids.tolist(), parents.tolist(), experiments.tolist())
+        ])
+        sample_ids, type_numbers, values = measurement_rows(
+            rng, ids, types, density)
+        if len(sample_ids):
+            session.execute(insert(measurement_table), [
+                {
+                    "sample_id": sample_id,
+                    "measurement_type": f"t{type_number}",
+                    "value": value,
+                }
+                for sample_id, type_number, value in zip(
+                    sample_ids.tolist(), type_numbers.tolist(),
+                    values.tolist())
+            ])
+        session.commit()
+        # NOTE:  In production code this would be changed to a logger
+        print(f"Generated {stop} of {samples} samples")
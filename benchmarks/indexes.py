@@ -0,0 +1,82 @@
+"""Benchmarks the pipeline without the indexes of app.indexes, with them and
+with the deferrable ones dropped during the load.
+
+    python -m benchmarks.indexes --url sqlite:///bench.db
+
+Every case recreates the database (see benchmarks.suite), generates the
+samples, sets up the indexes and times a first run of the pipeline, which
+loads every sample, and a second run after another 1% of samples arrived,
+which is dominated by the probes for unresolved rows.
+"""
+import argparse
+import os
+import time
+
+from sqlalchemy.exc import DBAPIError
+
+from app.config import DEFAULT_URL
+from app.database import reset_database
+from app.ddl import drop_indexes
+from app.etl import pipeline
+from app.indexes import INDEXES, existing_indexes
+from app.schema import get_engine
+
+from benchmarks.generate import generate
+
+SAMPLE_COUNTS = [10000, 100000, 1000000]
+TYPES = 20
+DENSITY = .3
+
+NONE = "none"
+INDEXED = "indexed"
+DEFERRED = "deferred"
+
+
+def drop_all_indexes(engine):
+    """Drops the indexes of app.indexes.  MySQL keeps the ones a foreign key
+    needs, which is the state before they were added."""
+    with engine.connect() as connection:
+        for spec in INDEXES:
+            if spec.name not in existing_indexes(connection, spec.table):
+                continue
+            try:
+                drop_indexes(connection, spec.table, [spec.name])
+            except DBAPIError as e:
+                print(f"Keeping {spec.name}: {e.orig}")
+
+
+def run_case(url, n, case):
+    engine = reset_database(url)
+    generate(n, types=TYPES, density=DENSITY)
+    if case == NONE:
+        drop_all_indexes(engine)
+
+    began = time.perf_counter()
+    pipeline(defer_indexes=case == DEFERRED)
+    load = time.perf_counter() - began
+
+    generate(max(n // 100, 1), types=TYPES, density=DENSITY, seed=1)
+    began = time.perf_counter()
+    pipeline()
+    incremental = time.perf_counter() - began
+    get_engine().dispose()
+    return load, incremental
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--url", default=os.environ.get("SQL_URL", DEFAULT_URL))
+    parser.add_argument(
+        "--samples", nargs="+", type=int, default=SAMPLE_COUNTS)
+    args = parser.parse_args()
+
+    print("samples    indexes   load_s  incremental_s")
+    for n in args.samples:
+        for case in [NONE, INDEXED, DEFERRED]:
+            load, incremental = run_case(args.url, n, case)
+            print(f"{n:9d}  {case:8s}  {load:7.2f}  {incremental:13.2f}")
+
+
+if __name__ == "__main__":
+    main()
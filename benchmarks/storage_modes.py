@@ -0,0 +1,70 @@
+"""Benchmarks the dynamic and the slots storage modes of the pipeline (see
+app.storage) against each other.
+
+    python -m benchmarks.storage_modes --url sqlite:///bench.db
+
+Every case recreates the database (see benchmarks.suite), generates n
+samples with a measurement for a random share of the measurement types, and
+times a full pipeline run
+followed by an aggregation over one measurement column, which is read from
+experiment_measurements in the dynamic mode and from the view in the slots
+mode.
+"""
+import argparse
+import os
+import time
+
+from app.config import DEFAULT_URL
+from app.database import reset_database
+from app.etl import pipeline
+from app.schema import session_scope
+from app.storage import DYNAMIC, SLOTS, VIEW_NAME
+
+from benchmarks.add_values import timed
+from benchmarks.generate import generate
+
+SAMPLES = 10000
+TYPE_COUNTS = [5, 50, 200]
+# Probability that a sample has a value of a given measurement type.
+DENSITY = .1
+QUERY_REPEATS = 10
+
+TABLES = {
+    DYNAMIC: "experiment_measurements",
+    SLOTS: VIEW_NAME,
+}
+
+
+def query(mode):
+    with session_scope() as session:
+        session.execute(
+            f"SELECT experiment_id, COUNT(*), AVG(measurement_t0)"
+            f" FROM {TABLES[mode]} GROUP BY experiment_id"
+        ).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--url", default=os.environ.get("SQL_URL", DEFAULT_URL))
+    parser.add_argument("--samples", type=int, default=SAMPLES)
+    parser.add_argument(
+        "--types", nargs="+", type=int, default=TYPE_COUNTS)
+    args = parser.parse_args()
+
+    print("types  mode     load_s  query_ms")
+    for type_count in args.types:
+        for mode in [DYNAMIC, SLOTS]:
+            engine = reset_database(args.url)
+            generate(args.samples, types=type_count, density=DENSITY)
+            load = timed(lambda: pipeline(incremental=False, mode=mode))
+            start = time.perf_counter()
+            for _ in range(QUERY_REPEATS):
+                query(mode)
+            query_ms = (time.perf_counter() - start) / QUERY_REPEATS * 1000
+            engine.dispose()
+            print(f"{type_count:5d}  {mode:7s}  {load:6.2f}  {query_ms:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Benchmark suite timing the pipeline over a grid of synthetic data sets.
+
+Every case of the grid recreates the database, generates its data with
+benchmarks.generate and runs a full pipeline.  The wall time of the whole
+pipeline and of every step, taken from the metrics report of the run (see
+app.instrumentation), is stored as JSON:
+
+    python -m benchmarks.suite --samples 100000 1000000 --types 10 100 \\
+        --output results.json
+
+Every grid option takes one or more values and the cases are their cartesian
+product.  Results are compared against a baseline saved by an earlier run,
+matching cases by backend and parameters:
+
+    python -m benchmarks.suite --output new.json --baseline results.json
+
+The suite exits with status 1 when a case or a step got slower than the
+baseline by more than the tolerance, ignoring differences below a noise floor
+of min_seconds.
+
+The database is taken from --url, which defaults to SQL_URL, and recreated
+for every case by app.database.reset_database, so run it inside the etl_app
+container against a scratch database.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from app.batching import CHUNK_SIZE
+from app.config import DEFAULT_URL
+from app.database import reset_database
+from app.etl import SQL, pipeline
+from app.storage import DYNAMIC, SLOTS
+from app.vectorized import VECTORIZED
+
+from benchmarks.generate import generate
+
+# Parameters of the data set and of the pipeline, with their default values.
+GRID = {
+    "samples": [10000, 100000],
+    "depth": [10],
+    "fan_out": [2],
+    "experiment_size": [1000],
+    "types": [10, 100],
+    "density": [.5],
+    "transform": [SQL],
+    "mode": [DYNAMIC],
+    "workers": [1],
+}
+GRID_TYPES = {
+    "samples": int,
+    "depth": int,
+    "fan_out": int,
+    "experiment_size": int,
+    "types": int,
+    "density": float,
+    "transform": str,
+    "mode": str,
+    "workers": int,
+}
+DATA_PARAMETERS = ["samples", "depth", "fan_out", "experiment_size",
+                   "types", "density"]
+
+TOLERANCE = .2
+MIN_SECONDS = .1
+
+
+def grid_cases(grid):
+    """Returns the cartesian product of grid as a list of parameter dicts."""
+    names = list(grid)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+
+
+def run_case(url, case, chunk_size):
+    """Generates the data set of case and times a full pipeline run."""
+    engine = reset_database(url)
+    began = time.perf_counter()
+    generate(seed=0, **{name: case[name] for name in DATA_PARAMETERS})
+    generate_seconds = time.perf_counter() - began
+
+    with tempfile.TemporaryDirectory() as directory:
+        report_path = os.path.join(directory, "report.json")
+        began = time.perf_counter()
+        pipeline(incremental=False, chunk_size=chunk_size,
+                 workers=case["workers"], mode=case["mode"],
+                 transform=case["transform"], report_path=report_path)
+        seconds = time.perf_counter() - began
+        with open(report_path) as f:
+            report = json.load(f)
+    engine.dispose()
+    return {
+        "backend": engine.dialect.name,
+        "params": case,
+        "generate_seconds": round(generate_seconds, 6),
+        "seconds": round(seconds, 6),
+        "steps": {
+            step["step"]: {
+                "seconds": step["seconds"],
+                "sql_seconds": step["sql_seconds"],
+                "statements": step["statements"],
+                "rows": step["rows"],
+            }
+            for step in report["steps"]
+        },
+    }
+
+
+def best_of(url, case, chunk_size, repeats):
+    """Runs case repeats times and keeps the fastest run."""
+    runs = [run_case(url, case, chunk_size) for _ in range(repeats)]
+    return min(runs, key=lambda run: run["seconds"])
+
+
+def case_key(result):
+    return result["backend"], json.dumps(result["params"], sort_keys=True)
+
+
+def compare(results, baseline, tolerance=TOLERANCE, min_seconds=MIN_SECONDS):
+    """Compares the cases of results to the matching cases of baseline.
+    Returns a list of (params, name, baseline seconds, seconds) of the
+    pipelines and steps that got slower by more than tolerance and
+    min_seconds.  Cases missing from the baseline are skipped."""
+    baseline_cases = {case_key(case): case for case in baseline["cases"]}
+    regressions = []
+    for case in results["cases"]:
+        before = baseline_cases.get(case_key(case))
+        if before is None:
+            continue
+        timings = [("pipeline", before["seconds"], case["seconds"])]
+        for step, metrics in case["steps"].items():
+            if step in before["steps"]:
+                timings.append((
+                    step, before["steps"][step]["seconds"],
+                    metrics["seconds"]))
+        for name, old, new in timings:
+            if new > old * (1 + tolerance) and new - old > min_seconds:
+                regressions.append((case["params"], name, old, new))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    for name, default in GRID.items():
+        parser.add_argument(
+            f"--{name.replace('_', '-')}", nargs="+", type=GRID_TYPES[name],
+            default=default)
+    parser.add_argument(
+        "--url", default=os.environ.get("SQL_URL", DEFAULT_URL))
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--min-seconds", type=float, default=MIN_SECONDS)
+    args = parser.parse_args(argv)
+    for transform in args.transform:
+        if transform not in (SQL, VECTORIZED):
+            parser.error(f"unknown transform {transform!r}")
+    for mode in args.mode:
+        if mode not in (DYNAMIC, SLOTS):
+            parser.error(f"unknown mode {mode!r}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    grid = {name: getattr(args, name) for name in GRID}
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "chunk_size": args.chunk_size,
+        "cases": [],
+    }
+    for case in grid_cases(grid):
+        result = best_of(args.url, case, args.chunk_size, args.repeats)
+        results["cases"].append(result)
+        # NOTE:  In production code this would be changed to a logger
+        print(json.dumps(result))
+        # The results are saved after every case, so a long grid that is
+        #  interrupted keeps the cases it finished.
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(
+        results, baseline, args.tolerance, args.min_seconds)
+    for params, name, old, new in regressions:
+        print(f"REGRESSION {name}: {old:.3f}s -> {new:.3f}s"
+              f" ({new / old - 1 if old else 0:+.0%}) {json.dumps(params)}")
+    if not regressions:
+        print(f"No regressions against {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""Benchmarks the SQL-side transform of the pipeline against the vectorized
+in-memory transform of app.vectorized.
+
+    python -m benchmarks.transforms --url sqlite:///bench.db
+
+Every case recreates the database (see benchmarks.suite), generates n
+samples with benchmarks.generate and times a full pipeline run with each
+transform.
+"""
+import argparse
+import os
+
+from app.config import DEFAULT_URL
+from app.database import reset_database
+from app.etl import SQL, pipeline
+from app.vectorized import VECTORIZED
+
+from benchmarks.add_values import timed
+from benchmarks.generate import generate
+
+SAMPLE_COUNTS = [10000, 100000, 1000000]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--url", default=os.environ.get("SQL_URL", DEFAULT_URL))
+    parser.add_argument(
+        "--samples", nargs="+", type=int, default=SAMPLE_COUNTS)
+    args = parser.parse_args()
+
+    print("samples     transform   seconds")
+    for n in args.samples:
+        for transform in [SQL, VECTORIZED]:
+            engine = reset_database(args.url)
+            generate(n)
+            seconds = timed(
+                lambda: pipeline(incremental=False, transform=transform))
+            engine.dispose()
+            print(f"{n:9d}  {transform:10s}  {seconds:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
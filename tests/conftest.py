@@ -1,7 +1,22 @@
 import subprocess
 from pytest import fixture
 
+from app.database import reset_database
+from app.schema import get_engine
+
+from benchmarks.generate import generate
+
 
 @fixture
 def fresh_database():
     subprocess.check_call(["./scripts/recreate_database.sh"])
+
+
+@fixture
+def database(tmp_path):
+    """A SQLite database with 300 generated samples that were not loaded
+    yet."""
+    reset_database(f"sqlite:///{tmp_path}/etl.db")
+    generate(300, depth=4, experiment_size=50, types=3)
+    yield
+    get_engine().dispose()
@@ -0,0 +1,51 @@
+import asyncio
+import os
+
+from app.async_runner import AsyncRunner, run_pipeline
+from app.batching import chunk_scheduler, run_chunked
+from app.verify import verify_experiment_measurements
+
+from benchmarks.generate import generate
+
+
+def test_map_schedules_chunks_on_the_loop():
+    seen = []
+
+    def body(session, start, end):
+        assert chunk_scheduler.get() is not None
+        seen.append((start, end))
+
+    class Session:
+        def commit(self):
+            pass
+
+    # run_chunked only commits the calling session before fanning out.
+    async def run():
+        runner = AsyncRunner(asyncio.get_running_loop(), concurrency=2)
+        try:
+            await runner.call(
+                run_chunked, Session(), "test", body, 1, 35, chunk_size=10,
+                workers=2)
+        finally:
+            runner.close()
+
+    asyncio.run(run())
+    assert sorted(seen) == [(1, 10), (11, 20), (21, 30), (31, 40)]
+
+
+def test_run_pipeline(database, tmp_path):
+    export_directory = str(tmp_path / "export")
+    asyncio.run(run_pipeline(
+        chunk_size=100, concurrency=2, verify=True,
+        export_directory=export_directory))
+    report = verify_experiment_measurements()
+    assert report.ok, report.as_dict()
+    assert report.rows == 300
+    partitions = os.listdir(export_directory)
+    assert partitions
+    assert not [name for name in partitions if name.startswith(".")]
+
+    # An incremental run only picks up the new samples.
+    generate(50, depth=4, experiment_size=50, types=3, seed=1)
+    asyncio.run(run_pipeline(chunk_size=100, concurrency=2, verify=True))
+    assert verify_experiment_measurements().rows == 350
@@ -0,0 +1,27 @@
+from sqlalchemy.exc import DBAPIError
+
+from app.batching import chunk_ranges, is_retryable
+
+
+def test_chunk_ranges_are_aligned():
+    assert list(chunk_ranges(7, 25, 10)) == [(1, 10), (11, 20), (21, 30)]
+
+
+def test_chunk_ranges_single_id():
+    assert list(chunk_ranges(10, 10, 10)) == [(1, 10)]
+    assert list(chunk_ranges(11, 11, 10)) == [(11, 20)]
+
+
+class FakeMySQLError(Exception):
+    def __init__(self, errno):
+        super().__init__(f"error {errno}")
+        self.errno = errno
+
+
+def test_is_retryable():
+    deadlock = DBAPIError("UPDATE", {}, FakeMySQLError(1213))
+    duplicate_key = DBAPIError("INSERT", {}, FakeMySQLError(1062))
+    locked = DBAPIError("UPDATE", {}, Exception("database is locked"))
+    assert is_retryable(deadlock)
+    assert is_retryable(locked)
+    assert not is_retryable(duplicate_key)
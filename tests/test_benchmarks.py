@@ -0,0 +1,67 @@
+import numpy as np
+
+from benchmarks.generate import measurement_rows, sample_rows, tree_size
+from benchmarks.suite import compare, grid_cases
+
+
+def test_tree_size():
+    assert tree_size(5, 1) == 5
+    assert tree_size(3, 2) == 7
+    assert tree_size(3, 3) == 13
+
+
+def test_sample_rows_complete_trees():
+    ids, parents, experiments = sample_rows(
+        first_id=11, start=0, stop=9, depth=3, fan_out=2, experiment_size=4)
+    assert list(ids) == list(range(11, 20))
+    # Two trees of 7 samples, the second one starting at id 18.
+    assert list(parents) == [-1, 11, 11, 12, 12, 13, 13, -1, 18]
+    assert list(experiments) == [1, 1, 1, 1, 2, 2, 2, 2, 3]
+
+
+def test_sample_rows_batches_match_whole():
+    whole = sample_rows(1, 0, 100, 4, 3, 10)
+    batches = [sample_rows(1, start, start + 25, 4, 3, 10)
+               for start in range(0, 100, 25)]
+    for position in range(3):
+        assert list(np.concatenate([b[position] for b in batches])) == list(
+            whole[position])
+
+
+def test_measurement_rows_density():
+    sample_ids = np.arange(1, 1001)
+    ids, types, values = measurement_rows(
+        np.random.default_rng(0), sample_ids, types=10, density=.3)
+    assert abs(len(ids) / 10000 - .3) < .05
+    assert set(types) <= set(range(10))
+    assert ((values >= 0) & (values <= 100)).all()
+    again = measurement_rows(
+        np.random.default_rng(0), sample_ids, types=10, density=.3)
+    assert list(again[2]) == list(values)
+
+
+def test_grid_cases():
+    assert grid_cases({"samples": [1, 2], "types": [3]}) == [
+        {"samples": 1, "types": 3}, {"samples": 2, "types": 3}]
+
+
+def case(seconds, step_seconds, samples=10):
+    return {
+        "backend": "sqlite",
+        "params": {"samples": samples},
+        "seconds": seconds,
+        "steps": {"add_values": {"seconds": step_seconds}},
+    }
+
+
+def test_compare():
+    baseline = {"cases": [case(10, 5), case(1, 1, samples=20)]}
+    results = {"cases": [case(10.5, 8), case(9, 9, samples=30)]}
+    assert compare(results, baseline, tolerance=.2, min_seconds=.1) == [
+        ({"samples": 10}, "add_values", 5, 8)]
+
+
+def test_compare_noise_floor():
+    baseline = {"cases": [case(.01, .01)]}
+    results = {"cases": [case(.05, .05)]}
+    assert compare(results, baseline, tolerance=.2, min_seconds=.1) == []
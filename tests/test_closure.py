@@ -0,0 +1,119 @@
+import pytest
+from sqlalchemy import create_engine
+
+from app.closure import (
+    ancestors,
+    descendants,
+    extend_sample_lineage,
+    subtree_ids,
+    top_parent,
+)
+from app.etl import set_top_parents_adjacent
+from app.lineage import CLOSURE, CTE, MEMORY
+from app.schema import (
+    DBase,
+    ExperimentMeasurementSlots,
+    Sample,
+    SampleLineage,
+    configure_engine,
+    get_engine,
+    session_scope,
+)
+from app.storage import SLOTS
+from app.vectorized import NO_PARENT, find_roots_vectorized, read_samples
+
+
+@pytest.fixture(params=[CTE, MEMORY])
+def database(request, tmp_path, monkeypatch):
+    # Backends without recursive CTEs extend the table in passes.
+    monkeypatch.setattr(
+        "app.closure.choose_strategy", lambda connection: request.param)
+    url = f"sqlite:///{tmp_path}/closure.db"
+    DBase.metadata.create_all(create_engine(url))
+    configure_engine(url)
+    with session_scope() as session:
+        session.add_all([
+            Sample(id=1),
+            Sample(id=2, parent_id=1),
+            Sample(id=3, parent_id=2),
+            Sample(id=4, parent_id=1),
+            Sample(id=5),
+            # A cycle, which has no root.
+            Sample(id=6, parent_id=7),
+            Sample(id=7, parent_id=6),
+        ])
+    yield
+    get_engine().dispose()
+
+
+def test_extend_sample_lineage(database):
+    # SQLite cannot tell how many rows an INSERT with a CTE wrote.
+    extend_sample_lineage(chunk_size=2)
+    with session_scope() as session:
+        assert session.query(SampleLineage).count() == 9
+        assert ancestors(session, 3) == [2, 1]
+        assert ancestors(session, 1) == []
+        assert top_parent(session, 3) == 1
+        assert top_parent(session, 5) == 5
+        assert top_parent(session, 6) is None
+        assert descendants(session, 1) == [2, 4, 3]
+        assert descendants(session, 1, max_depth=1) == [2, 4]
+        assert sorted(
+            _ for (_,) in session.execute(subtree_ids(2))) == [2, 3]
+
+        # A new subtree hanging off an existing sample, whose samples arrive
+        #  in the reverse order of their depth.
+        session.add(Sample(id=8, parent_id=3))
+        session.flush()
+        session.add(Sample(id=9))
+        session.flush()
+        session.execute("UPDATE samples SET parent_id = 9 WHERE id = 8")
+        session.execute("UPDATE samples SET parent_id = 3 WHERE id = 9")
+    extend_sample_lineage(sample_ids=[8, 9], chunk_size=2)
+    with session_scope() as session:
+        assert ancestors(session, 8) == [9, 3, 2, 1]
+        assert session.query(SampleLineage).count() == 18
+
+
+def test_resolve_with_closure(database):
+    extend_sample_lineage()
+    with session_scope() as session:
+        session.add_all([
+            ExperimentMeasurementSlots(sample_id=sample_id)
+            for sample_id in range(1, 8)
+        ])
+    assert set_top_parents_adjacent(
+        strategy=CLOSURE, chunk_size=3, mode=SLOTS) == 5
+    with session_scope() as session:
+        assert dict(session.query(
+            ExperimentMeasurementSlots.sample_id,
+            ExperimentMeasurementSlots.top_parent_id,
+        )) == {1: 1, 2: 1, 3: 1, 4: 1, 5: 5, 6: None, 7: None}
+
+
+@pytest.mark.parametrize("strategy", [CTE, MEMORY, CLOSURE])
+def test_missing_parent_leaves_top_parent_unset(database, strategy):
+    with session_scope() as session:
+        # The parent of 8 was never loaded.
+        session.add_all([
+            Sample(id=8, parent_id=99),
+            Sample(id=9, parent_id=8),
+        ])
+        session.add_all([
+            ExperimentMeasurementSlots(sample_id=sample_id)
+            for sample_id in range(1, 10)
+        ])
+    extend_sample_lineage()
+    set_top_parents_adjacent(strategy=strategy, chunk_size=3, mode=SLOTS)
+    with session_scope() as session:
+        top_parents = dict(session.query(
+            ExperimentMeasurementSlots.sample_id,
+            ExperimentMeasurementSlots.top_parent_id,
+        ))
+        ids, parents, _ = read_samples(session)
+    assert top_parents[8] is None and top_parents[9] is None
+    roots = find_roots_vectorized(ids, parents)
+    assert top_parents == {
+        int(sample_id): None if root == NO_PARENT else int(root)
+        for sample_id, root in zip(ids, roots)
+    }
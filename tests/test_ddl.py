@@ -0,0 +1,25 @@
+from sqlalchemy import Column, DECIMAL, create_engine, text
+from sqlalchemy.dialects import mysql
+
+from app.ddl import add_columns, mysql_algorithms
+
+
+def test_mysql_algorithms():
+    dialect = mysql.dialect()
+    dialect.server_version_info = (8, 0, 18)
+    assert mysql_algorithms(dialect) == ["INSTANT", "INPLACE", None]
+    dialect.server_version_info = (5, 7, 28)
+    assert mysql_algorithms(dialect) == ["INPLACE", None]
+
+
+def test_add_columns_sqlite():
+    engine = create_engine("sqlite://")
+    with engine.connect() as connection:
+        connection.execute(text("CREATE TABLE t (id INTEGER PRIMARY KEY)"))
+        add_columns(connection, "t", [
+            Column("measurement_ph", DECIMAL(16, 6)),
+            Column("measurement_vol", DECIMAL(16, 6)),
+        ])
+        result = connection.execute(text("SELECT * FROM t LIMIT 0"))
+        assert list(result.keys()) == [
+            "id", "measurement_ph", "measurement_vol"]
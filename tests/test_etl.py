@@ -0,0 +1,177 @@
+from functools import wraps
+
+import pytest
+from sqlalchemy import func
+
+from app.etl import (
+    add_measurement_columns,
+    add_samples_and_experiments,
+    add_values,
+    pipeline,
+)
+from app.incremental import begin_run
+from app.rollups import update_rollups
+from app.schema import (
+    EtlChunk,
+    EtlRun,
+    Sample,
+    SampleMeasurement,
+    SampleMeasurementChange,
+    get_ExperimentMeasurement,
+    session_scope,
+)
+from app.storage import DYNAMIC, get_model
+from app.verify import (
+    EXPERIMENT_ID,
+    VerificationError,
+    verify_experiment_measurements,
+)
+
+
+def test_model_is_reflected_again_only_after_new_columns(database):
+    add_measurement_columns()
+    ExperimentMeasurement = get_ExperimentMeasurement()
+    assert get_ExperimentMeasurement() is ExperimentMeasurement
+
+    with session_scope() as session:
+        session.add(SampleMeasurement(
+            sample_id=1, measurement_type="density", value=1))
+    add_measurement_columns()
+    rebuilt = get_ExperimentMeasurement()
+    assert rebuilt is not ExperimentMeasurement
+    assert "measurement_density" in rebuilt.__table__.c
+    assert get_ExperimentMeasurement() is rebuilt
+
+
+def test_rerun_writes_nothing(database):
+    pipeline(incremental=False, chunk_size=100)
+    assert add_samples_and_experiments(chunk_size=100) == 0
+    assert add_values(chunk_size=100) == 0
+
+
+def test_rerun_picks_up_changed_values(database):
+    pipeline(incremental=False, chunk_size=100)
+    with session_scope() as session:
+        session.execute(
+            "UPDATE sample_measurements SET value = value + 1"
+            " WHERE sample_id = 7")
+        session.execute("UPDATE samples SET experiment_id = 99 WHERE id = 8")
+    # Both samples already have their top parent.
+    assert add_samples_and_experiments(chunk_size=100) == 1
+    assert add_values(chunk_size=100) == 1
+    report = verify_experiment_measurements()
+    assert report.ok, report.as_dict()
+
+
+def test_incremental_run_picks_up_rows_committed_below_the_watermark(
+        database):
+    with session_scope() as session:
+        # Leaves a gap of ids below the watermark.
+        session.add(Sample(id=400, experiment=1))
+    pipeline(chunk_size=100)
+
+    with session_scope() as session:
+        session.add(Sample(id=500, experiment=1))
+        session.commit()
+        begin_run(session)
+        # Rows of transactions that were open when the run began commit
+        #  after it, with ids below its high marks.
+        session.add(Sample(id=350, experiment=1))
+        session.flush()
+        session.add(SampleMeasurement(
+            sample_id=350, measurement_type="t0", value=5))
+        session.add(SampleMeasurement(
+            sample_id=100, measurement_type="late", value=42))
+        session.flush()
+        session.execute(
+            "UPDATE sample_measurement_changes SET id = 1"
+            " WHERE run_id IS NULL AND sample_id = 100")
+    # Resumes and finishes the run, which must leave the late rows alone.
+    pipeline(chunk_size=100)
+    with session_scope() as session:
+        assert session.query(SampleMeasurementChange).filter(
+            SampleMeasurementChange.run_id.is_(None)).count() == 3
+
+    pipeline(chunk_size=100)
+    ExperimentMeasurement = get_model(DYNAMIC)
+    with session_scope() as session:
+        late_sample = session.query(ExperimentMeasurement).get(350)
+        assert late_sample.top_parent_id == 350
+        assert late_sample.measurement_t0 == 5
+        assert session.query(
+            ExperimentMeasurement).get(100).measurement_late == 42
+        assert session.query(SampleMeasurementChange).count() == 0
+    report = verify_experiment_measurements()
+    assert report.ok, report.as_dict()
+
+
+def test_add_values_leaves_types_without_column_to_next_run(database):
+    pipeline(chunk_size=100)
+    # Arrives after add_measurement_columns ran.
+    with session_scope() as session:
+        session.add(SampleMeasurement(
+            sample_id=5, measurement_type="fresh", value=3))
+    assert add_values(chunk_size=100) == 0
+
+    pipeline(chunk_size=100)
+    with session_scope() as session:
+        assert session.query(
+            get_model(DYNAMIC)).get(5).measurement_fresh == 3
+
+
+def test_incremental_run_only_resolves_its_window(database):
+    pipeline(chunk_size=100)
+    with session_scope() as session:
+        session.add(Sample(id=301, parent_id=150, experiment=1))
+    pipeline(chunk_size=100)
+    with session_scope() as session:
+        run_id = session.query(func.max(EtlRun.id)).scalar()
+        chunks = session.query(EtlChunk.chunk_start).filter(
+            EtlChunk.run_id == run_id,
+            EtlChunk.step == "set_top_parents_adjacent",
+        ).all()
+    assert chunks == [(301,)]
+    assert verify_experiment_measurements().ok
+
+
+def running_first(step, *statements):
+    """Wraps step so it executes statements before it runs."""
+    @wraps(step)
+    def run(*args, **kwargs):
+        with session_scope() as session:
+            for statement in statements:
+                session.execute(statement)
+        return step(*args, **kwargs)
+    return run
+
+
+def test_change_between_load_and_verify_then_resume(database, monkeypatch):
+    pipeline(chunk_size=100, verify=True)
+    with session_scope() as session:
+        session.execute(
+            "UPDATE sample_measurements SET value = value + 1"
+            " WHERE sample_id = 7")
+    # After the run loaded its rows, sample 8 gets a new value and sample 9
+    #  a new type, which are left to the next run, and the row of sample 7
+    #  is broken.
+    monkeypatch.setattr("app.etl.update_rollups", running_first(
+        update_rollups,
+        "UPDATE sample_measurements SET value = value + 1"
+        " WHERE sample_id = 8",
+        "INSERT INTO sample_measurements (sample_id, measurement_type, value)"
+        " VALUES (9, 'density', 1)",
+        "UPDATE experiment_measurements SET experiment_id = 99"
+        " WHERE sample_id = 7",
+    ))
+    with pytest.raises(VerificationError) as failure:
+        pipeline(chunk_size=100, verify=True)
+    assert failure.value.report.counts == {EXPERIMENT_ID: 1}
+    monkeypatch.undo()
+
+    # The resumed run writes the broken row again.
+    pipeline(chunk_size=100, verify=True)
+    with session_scope() as session:
+        assert session.query(EtlRun).filter(
+            EtlRun.status == EtlRun.RUNNING).count() == 0
+    pipeline(chunk_size=100, verify=True)
+    assert verify_experiment_measurements().ok
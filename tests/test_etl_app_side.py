@@ -0,0 +1,51 @@
+from decimal import Decimal
+
+from app.etl import (
+    add_measurement_columns,
+    pipeline,
+    set_top_parents_adjacent,
+    set_top_parents_of_root_nodes,
+)
+from app.etl_app_side import STREAMING, load_streaming, pivot_rows
+from app.lineage import MEMORY
+from app.verify import verify_experiment_measurements
+
+from benchmarks.generate import generate
+
+
+def test_pivot_rows():
+    rows = [
+        (1, 10, "ph", Decimal("7")),
+        (1, 10, "ph", Decimal("8")),
+        (1, 10, "vol", None),
+        (2, 10, None, None),
+        (3, 11, "vol", Decimal("2")),
+    ]
+    columns = {"ph": "measurement_ph", "vol": "measurement_vol"}
+    assert list(pivot_rows(rows, columns)) == [
+        {"sample_id": 1, "experiment_id": 10,
+         "measurement_ph": Decimal("8")},
+        {"sample_id": 2, "experiment_id": 10},
+        {"sample_id": 3, "experiment_id": 11,
+         "measurement_vol": Decimal("2")},
+    ]
+
+
+def test_load_streaming_in_small_batches(database):
+    add_measurement_columns()
+    assert load_streaming(chunk_size=100, fetch_size=5, flush_size=7) == 300
+    # A second load updates the rows it wrote before.
+    load_streaming(chunk_size=100, fetch_size=5, flush_size=7)
+    roots = set_top_parents_of_root_nodes()
+    # pysqlite cannot count the rows of the UPDATE of the cte strategy.
+    assert roots + set_top_parents_adjacent(strategy=MEMORY) == 300
+    report = verify_experiment_measurements()
+    assert report.ok, report.as_dict()
+    assert report.rows == 300
+
+
+def test_streaming_pipeline(database):
+    pipeline(transform=STREAMING, chunk_size=100, verify=True)
+    generate(30, depth=4, experiment_size=50, types=4, seed=1)
+    pipeline(transform=STREAMING, chunk_size=100, verify=True)
+    assert verify_experiment_measurements().rows == 330
@@ -0,0 +1,87 @@
+from decimal import Decimal
+
+import pytest
+from sqlalchemy import Column, DECIMAL, Integer
+
+from app.etl import pipeline
+from app.export import (
+    DEFAULT_PARTITION,
+    arrow_schema,
+    export_experiment_measurements,
+    publish,
+    record_batch,
+    staging_directory,
+)
+from app.schema import session_scope
+
+pa = pytest.importorskip("pyarrow")
+pytest.importorskip("pyarrow.parquet")
+
+
+def test_record_batch():
+    schema = arrow_schema(pa, [
+        Column("sample_id", Integer),
+        Column("measurement_ph", DECIMAL(16, 6)),
+    ])
+    assert schema.field("measurement_ph").type == pa.decimal128(16, 6)
+    # MySQL returns Decimals, SQLite floats.
+    for value in [Decimal("6.500000"), 6.5]:
+        batch = record_batch(pa, schema, [(1, value, 3), (2, None, 3)])
+        assert batch.column(0).to_pylist() == [1, 2]
+        assert batch.column(1).to_pylist() == [Decimal("6.500000"), None]
+
+
+def test_publish(tmp_path):
+    directory = tmp_path / "export"
+    old = directory / "experiment_id=1" / "part-full.parquet"
+    old.parent.mkdir(parents=True)
+    old.write_text("old")
+    staging = staging_directory(str(directory), "full")
+    for experiment_id in [1, 2]:
+        partition = tmp_path / staging / f"experiment_id={experiment_id}"
+        partition.mkdir(parents=True)
+        (partition / "part-full.parquet").write_text("new")
+    publish(staging, str(directory))
+    assert sorted(p.name for p in directory.iterdir()) == [
+        "experiment_id=1", "experiment_id=2"]
+    assert old.read_text() == "new"
+
+
+def test_publish_full(tmp_path):
+    directory = tmp_path / "export"
+    for experiment_id in [1, 2]:
+        partition = directory / f"experiment_id={experiment_id}"
+        partition.mkdir(parents=True)
+        (partition / "part-run-3.parquet").write_text("old")
+    staging = staging_directory(str(directory), "full")
+    partition = tmp_path / staging / "experiment_id=1"
+    partition.mkdir(parents=True)
+    (partition / "part-full.parquet").write_text("new")
+    publish(staging, str(directory), full=True)
+    assert [
+        path.relative_to(directory).as_posix()
+        for path in directory.glob("*/*")
+    ] == ["experiment_id=1/part-full.parquet"]
+
+
+def test_export_full(database, tmp_path):
+    pipeline(incremental=False, chunk_size=100)
+    with session_scope() as session:
+        session.execute(
+            "UPDATE experiment_measurements SET experiment_id = NULL"
+            " WHERE sample_id = 1")
+    directory = tmp_path / "export"
+    stale = directory / "experiment_id=1" / "part-run-1.parquet"
+    stale.parent.mkdir(parents=True)
+    stale.write_text("old")
+
+    assert export_experiment_measurements(directory=str(directory)) == 300
+    files = {
+        path.relative_to(directory).as_posix()
+        for path in directory.glob("*/*")
+    }
+    assert f"experiment_id={DEFAULT_PARTITION}/part-full.parquet" in files
+    assert not [name for name in files if "run-" in name]
+    table = pa.parquet.read_table(str(directory))
+    assert table.num_rows == 300
+    assert table.column("experiment_id").to_pylist().count(None) == 1
@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import create_engine
+
+from app.indexes import (
+    INDEXES,
+    deferred_indexes,
+    ensure_indexes,
+    existing_indexes,
+)
+from app.schema import Sample, SampleMeasurement
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/indexes.db")
+    for table in [Sample, SampleMeasurement]:
+        table.__table__.create(engine)
+    return engine
+
+
+def test_ensure_indexes(engine):
+    with engine.connect() as connection:
+        created = ensure_indexes(connection)
+        assert sorted(created) == sorted(
+            spec.name for spec in INDEXES
+            if spec.table in ("samples", "sample_measurements"))
+        assert "ix_samples_parent_id" in existing_indexes(
+            connection, "samples")
+        assert ensure_indexes(connection) == []
+
+
+def test_deferred_indexes(engine):
+    with engine.connect() as connection:
+        ensure_indexes(connection)
+    with pytest.raises(RuntimeError):
+        with deferred_indexes(engine, ["sample_measurements"]):
+            with engine.connect() as connection:
+                existing = existing_indexes(connection, "sample_measurements")
+            # Only the deferrable index is dropped.
+            assert "ix_sample_measurements_type_sample_value" not in existing
+            assert "ix_sample_measurements_sample_type_value" in existing
+            raise RuntimeError("load failed")
+    # The dropped index is rebuilt even though the load failed.
+    with engine.connect() as connection:
+        assert "ix_sample_measurements_type_sample_value" in existing_indexes(
+            connection, "sample_measurements")
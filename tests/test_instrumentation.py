@@ -0,0 +1,23 @@
+from sqlalchemy import create_engine
+
+from app.instrumentation import RunMetrics
+
+
+def test_run_metrics():
+    engine = create_engine("sqlite://")
+    metrics = RunMetrics(explain=True)
+    with metrics.installed(engine):
+        with metrics.step("load") as step:
+            with engine.begin() as connection:
+                connection.execute("CREATE TABLE t (id INTEGER PRIMARY KEY)")
+                connection.execute("INSERT INTO t (id) VALUES (1), (2)")
+                connection.execute("UPDATE t SET id = id + 10")
+        # Statements outside of a step are not attributed to any step.
+        engine.execute("SELECT * FROM t").fetchall()
+
+    report = metrics.report()
+    assert [step["step"] for step in report["steps"]] == ["load"]
+    assert step.statements == 3
+    assert step.rows == 4
+    assert step.commits == 1
+    assert "UPDATE t SET id = id + 10" in step.plans
@@ -0,0 +1,50 @@
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.lineage import find_roots, write_roots
+from app.schema import DBase, ExperimentMeasurementSlots
+
+
+def test_find_roots_deep_chain():
+    """A single chain deeper than any recursion limit resolves to its head."""
+    depth = 100000
+    parents = {n: n - 1 for n in range(2, depth + 1)}
+    parents[1] = None
+    roots = find_roots(parents)
+    assert set(roots.values()) == {1}
+    assert len(roots) == depth
+
+
+def test_find_roots_forest():
+    parents = {1: None, 2: 1, 3: 2, 4: None, 5: 4, 6: 3}
+    assert find_roots(parents) == {1: 1, 2: 1, 3: 1, 4: 4, 5: 4, 6: 1}
+
+
+def test_find_roots_missing_parent():
+    parents = {1: None, 2: 1, 3: 9, 4: 3}
+    assert find_roots(parents) == {1: 1, 2: 1, 3: None, 4: None}
+
+
+def test_find_roots_cycle():
+    parents = {1: 2, 2: 1, 3: 2, 4: None}
+    assert find_roots(parents) == {1: None, 2: None, 3: None, 4: 4}
+
+
+def test_write_roots_leaves_samples_without_root():
+    engine = create_engine("sqlite://")
+    DBase.metadata.create_all(engine)
+    session = Session(bind=engine)
+    session.add_all([
+        ExperimentMeasurementSlots(sample_id=sample_id)
+        for sample_id in (1, 2, 3)
+    ])
+    session.flush()
+    # Sample 3 arrived after the roots were read, sample 2 has no root.
+    roots = {1: 1, 2: None}
+    assert write_roots(session, ExperimentMeasurementSlots, roots) == 1
+    assert session.query(
+        ExperimentMeasurementSlots.sample_id,
+        ExperimentMeasurementSlots.top_parent_id,
+    ).order_by(ExperimentMeasurementSlots.sample_id).all() == [
+        (1, 1), (2, None), (3, None)]
+    session.close()
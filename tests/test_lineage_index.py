@@ -0,0 +1,74 @@
+import numpy as np
+
+from app.closure import ancestors
+from app.etl import pipeline
+from app.lineage_index import LineageIndex, update_lineage_index
+from app.schema import session_scope
+from app.storage import DYNAMIC, get_model
+from app.vectorized import NO_PARENT
+
+from benchmarks.generate import generate
+
+
+def assert_matches_database(index):
+    ExperimentMeasurement = get_model(DYNAMIC)
+    with session_scope() as session:
+        rows = session.query(
+            ExperimentMeasurement.sample_id,
+            ExperimentMeasurement.top_parent_id,
+        ).all()
+        for sample_id, top_parent_id in rows:
+            assert index.top_parent(sample_id) == top_parent_id
+        for sample_id in (1, 150, 1001):
+            assert index.ancestors(sample_id) == ancestors(
+                session, sample_id)
+    sample_ids, top_parent_ids = zip(*rows)
+    assert list(index.top_parents(sample_ids)) == list(top_parent_ids)
+
+
+def test_lineage_index(database, tmp_path):
+    path = str(tmp_path / "lineage.npy")
+    pipeline(incremental=False, chunk_size=100)
+    assert update_lineage_index(path) == 300
+    assert update_lineage_index(path) == 0
+    index = LineageIndex(path)
+    assert_matches_database(index)
+    assert index.top_parent(1001) is None
+    assert index.top_parent(10 ** 6) is None
+    assert index.top_parents([-1, 10 ** 6]).tolist() == [NO_PARENT] * 2
+
+    # New samples, some of them below old ones, are added incrementally.
+    generate(60, depth=4, experiment_size=50, types=3, seed=1)
+    with session_scope() as session:
+        session.execute(
+            "INSERT INTO samples (id, parent_id, experiment_id)"
+            " VALUES (1000, 150, 1), (1001, 1000, 1)")
+    pipeline(incremental=False, chunk_size=100)
+    assert update_lineage_index(path) == 62
+    index = LineageIndex(path)
+    assert_matches_database(index)
+    assert isinstance(index.table, np.memmap)
+
+
+def test_pipeline_updates_index(database, tmp_path):
+    path = str(tmp_path / "lineage.npy")
+    pipeline(incremental=False, chunk_size=100, lineage_index=path)
+    assert len(LineageIndex(path)) == 301
+
+
+def test_pipeline_indexes_late_samples(database, tmp_path):
+    path = str(tmp_path / "lineage.npy")
+    with session_scope() as session:
+        session.execute("DELETE FROM samples WHERE id = 299")
+    pipeline(chunk_size=100, lineage_index=path)
+    assert LineageIndex(path).parent(299) is None
+
+    # A sample that committed after a run with a higher id began.
+    with session_scope() as session:
+        session.execute(
+            "INSERT INTO samples (id, parent_id, experiment_id)"
+            " VALUES (299, 150, 1)")
+    pipeline(chunk_size=100, lineage_index=path)
+    index = LineageIndex(path)
+    assert index.parent(299) == 150
+    assert_matches_database(index)
@@ -0,0 +1,78 @@
+import importlib.util
+import os
+
+from sqlalchemy import select
+
+from app.etl import add_measurement_columns
+from app.partitions import (
+    PARTITION_SIZE,
+    find_partition,
+    partition_clauses,
+    partition_definitions,
+    partition_lookup,
+    prepare_partitions,
+    rebuild_partition,
+)
+from app.schema import get_engine, session_scope
+from app.storage import DYNAMIC, get_model
+from app.vectorized import transform_vectorized
+from app.verify import verify_experiment_measurements
+
+EXISTING = [("p1", 101), ("p101", 201), ("pmax", None)]
+
+MIGRATION = os.path.join(
+    os.path.dirname(__file__), os.pardir, "versions",
+    "f1b7c2d9e4a0_partitioned_experiment_measurements.py")
+
+
+def test_partition_definitions():
+    assert partition_definitions(201, 350, 100) == [
+        ("p201", 301), ("p301", 401)]
+    assert partition_definitions(401, 350, 100) == []
+    assert partition_clauses([("p1", 101)]) == [
+        "PARTITION p1 VALUES LESS THAN (101)",
+        "PARTITION pmax VALUES LESS THAN MAXVALUE",
+    ]
+
+
+def test_find_partition():
+    assert find_partition(EXISTING, 1, 100) == ("p1", 1, 101)
+    assert find_partition(EXISTING, 151, 200) == ("p101", 101, 201)
+    assert find_partition(EXISTING, 301, 400) == ("pmax", 201, None)
+    # A chunk spanning two partitions cannot name either.
+    assert find_partition(EXISTING, 51, 150) is None
+
+
+def test_sqlite_is_not_partitioned(database):
+    assert prepare_partitions("experiment_measurements") == []
+    with get_engine().connect() as connection:
+        assert partition_lookup(
+            connection, "experiment_measurements")(1, 100) is None
+
+
+def test_rebuild_without_partitions_loads_in_place(database):
+    add_measurement_columns()
+    transform_vectorized(chunk_size=100)
+    table = get_model(DYNAMIC).__table__
+    rows = []
+
+    def load(session, target, start, end):
+        rows.append((start, end))
+        return 0
+
+    with session_scope() as session:
+        rebuild_partition(session, table, 1, 100, load, chunk_size=50)
+        assert session.execute(select([table]).where(
+            table.c.sample_id <= 100)).fetchall() == []
+    assert rows == [(1, 50), (51, 100)]
+
+    # The vectorized transform rebuilds the range again.
+    transform_vectorized(chunk_size=100)
+    assert verify_experiment_measurements().ok
+
+
+def test_migration_partition_size():
+    spec = importlib.util.spec_from_file_location("migration", MIGRATION)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    assert migration.PARTITION_SIZE == PARTITION_SIZE
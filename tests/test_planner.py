@@ -0,0 +1,89 @@
+import pytest
+from sqlalchemy import event
+
+from app.etl import dry_run, pipeline
+from app.incremental import next_run
+from app.schema import EtlRun, get_engine, session_scope
+from app.verify import verify_experiment_measurements
+
+from benchmarks.generate import generate
+
+# Reading the watermark, the maxima of the window, the unclaimed changes and
+#  the registry.
+IDLE_STATEMENTS = 7
+
+
+@pytest.fixture
+def database(database):
+    pipeline(chunk_size=100)
+
+
+def run_count():
+    with session_scope() as session:
+        return session.query(EtlRun).count()
+
+
+def planned_rows(plan):
+    return {step.name: step.rows for step in plan.steps}
+
+
+def test_idle_run_only_probes(database):
+    statements = []
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    runs = run_count()
+    event.listen(get_engine(), "before_cursor_execute", record)
+    try:
+        pipeline(chunk_size=100)
+    finally:
+        event.remove(get_engine(), "before_cursor_execute", record)
+    assert len(statements) <= IDLE_STATEMENTS, statements
+    assert all(s.lstrip().upper().startswith("SELECT") for s in statements)
+    assert run_count() == runs
+
+
+def test_watermark_never_moves_backwards(database):
+    with session_scope() as session:
+        # The log is pruned, and the newest sample was deleted.
+        session.execute("DELETE FROM samples WHERE id = 300")
+        run = next_run(session)
+        assert run.change_id_low > 0
+        assert run.change_id_high == run.change_id_low
+        assert run.sample_id_high == run.sample_id_low == 300
+    assert not dry_run().has_work
+
+
+def test_late_measurements_skip_known_columns(database, capsys):
+    with session_scope() as session:
+        session.execute(
+            "UPDATE sample_measurements SET value = value + 1"
+            " WHERE sample_id = 7")
+    rows = planned_rows(dry_run())
+    assert rows["add_values"] > 0
+    assert rows["update_rollups"] > 0
+    assert rows["add_measurement_columns"] == 0
+
+    pipeline(chunk_size=100)
+    output = capsys.readouterr().out
+    assert "Skipping add_measurement_columns" in output
+    assert "Skipping add_values" not in output
+    assert verify_experiment_measurements().ok
+
+
+def test_dry_run_does_not_start_a_run(database, capsys):
+    generate(30, depth=4, experiment_size=50, types=3, seed=1)
+    runs = run_count()
+    plan = dry_run()
+    assert run_count() == runs
+    assert all(step.rows for step in plan.steps
+               if step.name != "add_measurement_columns")
+    output = capsys.readouterr().out
+    assert "extend_sample_lineage: ~" in output
+    # SQLite explains the probes with EXPLAIN QUERY PLAN.
+    assert "SEARCH" in output or "SCAN" in output
+
+    pipeline(chunk_size=100)
+    assert run_count() == runs + 1
+    assert verify_experiment_measurements().ok
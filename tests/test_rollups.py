@@ -0,0 +1,77 @@
+from sqlalchemy import func
+
+from app.etl import pipeline
+from app.rollups import summary, update_rollups
+from app.schema import (
+    session_scope,
+    ExperimentRollup,
+    LineageRollup,
+    MeasurementType,
+)
+from app.storage import DYNAMIC, get_model, measurement_columns
+
+from benchmarks.generate import generate
+
+
+def rollups(session, model):
+    return sorted(tuple(row) for row in session.query(
+        *model.__table__.c))
+
+
+def recomputed(session, group):
+    """Aggregates experiment_measurements from scratch."""
+    ExperimentMeasurement = get_model(DYNAMIC)
+    group_column = getattr(ExperimentMeasurement, group)
+    types = [mt for (mt,) in session.query(MeasurementType.measurement_type)]
+    rows = []
+    for mt, name in measurement_columns(session, types, DYNAMIC).items():
+        column = getattr(ExperimentMeasurement, name)
+        rows.extend(
+            (group_id, mt, count, total, low, high)
+            for group_id, count, total, low, high in session.query(
+                group_column, func.count(column), func.sum(column),
+                func.min(column), func.max(column),
+            ).filter(
+                column.isnot(None), group_column.isnot(None)
+            ).group_by(group_column)
+        )
+    return sorted(rows)
+
+
+def assert_rollups_match():
+    with session_scope() as session:
+        for model, group in [(ExperimentRollup, "experiment_id"),
+                             (LineageRollup, "top_parent_id")]:
+            assert rollups(session, model) == recomputed(session, group)
+
+
+def test_incremental_rollups(database):
+    pipeline(chunk_size=100)
+    assert_rollups_match()
+
+    generate(60, depth=4, experiment_size=50, types=3, seed=1)
+    with session_scope() as session:
+        # Late measurements for old samples lower their groups' minimum,
+        #  which cannot be merged.
+        session.execute(
+            "UPDATE sample_measurements SET value = value - 1000"
+            " WHERE sample_id IN (3, 150)")
+    pipeline(chunk_size=100)
+    assert_rollups_match()
+
+    # A full rebuild yields the same rows.
+    with session_scope() as session:
+        before = rollups(session, ExperimentRollup)
+    update_rollups(chunk_size=100)
+    with session_scope() as session:
+        assert rollups(session, ExperimentRollup) == before
+
+
+def test_summary(database):
+    pipeline(incremental=False, chunk_size=100)
+    with session_scope() as session:
+        experiment_id = session.query(
+            ExperimentRollup.experiment_id).limit(1).scalar()
+        for aggregates in summary(
+                session, ExperimentRollup, experiment_id).values():
+            assert aggregates["min"] <= aggregates["mean"] <= aggregates["max"]
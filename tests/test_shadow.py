@@ -0,0 +1,53 @@
+import pytest
+from sqlalchemy import inspect
+
+from app.etl import pipeline
+from app.incremental import RunConflict, begin_rebuild, begin_run, next_run
+from app.indexes import MODE_TABLES, existing_indexes, table_indexes
+from app.schema import EtlRun, get_engine, session_scope
+from app.shadow import rebuild
+from app.storage import DYNAMIC, SLOTS, VIEW_NAME
+from app.verify import verify_experiment_measurements
+
+
+@pytest.mark.parametrize("mode", [DYNAMIC, SLOTS])
+def test_rebuild(database, mode):
+    pipeline(incremental=False, chunk_size=100, mode=mode)
+    with session_scope() as session:
+        session.execute(
+            "UPDATE sample_measurements SET value = value + 1"
+            " WHERE sample_id = 7")
+
+    assert rebuild(mode=mode, chunk_size=100) == 300
+    report = verify_experiment_measurements(mode=mode)
+    assert report.ok, report.as_dict()
+    table = MODE_TABLES[mode]
+    with get_engine().connect() as connection:
+        assert table + "_shadow" not in inspect(connection).get_table_names()
+        assert existing_indexes(connection, table) == {
+            spec.name for spec in table_indexes(table)}
+        if mode == SLOTS:
+            assert connection.execute(
+                f"SELECT COUNT(*) FROM {VIEW_NAME}").scalar() == 300
+
+
+def test_rebuild_and_runs_exclude_each_other(database):
+    with session_scope() as session:
+        run_id = begin_run(session).id
+    with pytest.raises(RunConflict):
+        rebuild(chunk_size=100)
+    pipeline(chunk_size=100)
+
+    # A rebuild that failed keeps runs from starting until it is resumed.
+    with session_scope() as session:
+        rebuild_id = begin_rebuild(session).id
+    with pytest.raises(RunConflict), session_scope() as session:
+        begin_run(session)
+    assert rebuild(chunk_size=100) == 300
+    with session_scope() as session:
+        runs = session.query(EtlRun.id, EtlRun.status).order_by(EtlRun.id)
+        assert runs.all() == [
+            (run_id, EtlRun.FINISHED), (rebuild_id, EtlRun.FINISHED)]
+    # Everything was rebuilt, so the next run starts after it.
+    with session_scope() as session:
+        assert next_run(session).sample_id_low == 300
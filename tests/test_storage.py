@@ -0,0 +1,40 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.schema import MeasurementType, ExperimentMeasurementSlots
+from app.storage import (
+    SLOTS,
+    VIEW_NAME,
+    assign_slots,
+    measurement_columns,
+)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    for table in [MeasurementType, ExperimentMeasurementSlots]:
+        table.__table__.create(engine)
+    session = Session(bind=engine)
+    yield session
+    session.close()
+
+
+def test_assign_slots(session):
+    session.add_all([
+        MeasurementType(measurement_type="vol", slot=0),
+        MeasurementType(measurement_type="ph"),
+        MeasurementType(measurement_type="area"),
+    ])
+    session.flush()
+    assign_slots(session)
+    assert measurement_columns(session, ["area", "ph", "vol"], SLOTS) == {
+        "area": "slot_1", "ph": "slot_2", "vol": "slot_0"}
+
+    session.execute(
+        "INSERT INTO experiment_measurement_slots (sample_id, slot_2)"
+        " VALUES (1, 7)")
+    row = session.execute(f"SELECT * FROM {VIEW_NAME}").first()
+    assert row["measurement_ph"] == 7
+    assert row["measurement_vol"] is None
@@ -0,0 +1,92 @@
+import pytest
+
+from app import tasks
+from app.batching import partition_bounds, run_chunked
+from app.lineage import CTE, MEMORY
+from app.schema import session_scope
+from app.tasks import (
+    TASKS,
+    LocalExecutor,
+    Task,
+    check_graph,
+    plan_partitions,
+    run_task,
+)
+from app.verify import verify_experiment_measurements
+
+from benchmarks.generate import generate
+
+
+def test_check_graph_orders_upstream_first():
+    names = [task.name for task in check_graph(reversed(TASKS))]
+    for task in TASKS:
+        for upstream in task.upstream:
+            assert names.index(upstream) < names.index(task.name)
+
+
+def test_check_graph_rejects_cycles():
+    with pytest.raises(ValueError, match="cycle"):
+        check_graph([
+            Task("a", None, ("b",), False, (), None),
+            Task("b", None, ("a",), False, (), None),
+        ])
+    with pytest.raises(ValueError, match="unknown"):
+        check_graph([Task("a", None, ("b",), False, (), None)])
+
+
+def test_partition_bounds_limit_the_chunks():
+    seen = []
+
+    def body(session, start, end):
+        seen.append((start, end))
+
+    class Session:
+        def commit(self):
+            pass
+
+    token = partition_bounds.set((21, 40))
+    try:
+        run_chunked(Session(), "test", body, 1, 95, chunk_size=10)
+    finally:
+        partition_bounds.reset(token)
+    assert seen == [(21, 30), (31, 40)]
+
+
+def test_plan_partitions(database):
+    partitions = plan_partitions("add_values", partition_size=100)
+    assert sorted(p["partition"] for p in partitions) == [
+        (1, 100), (101, 200), (201, 300)]
+    costs = [p["cost"] for p in partitions]
+    assert costs == sorted(costs, reverse=True)
+    assert len(plan_partitions("add_measurement_columns")) == 1
+
+
+@pytest.mark.parametrize("strategy, partitions", [
+    (CTE, [(1, 100), (101, 200), (201, 300)]),
+    # Every partition would read the whole samples table.
+    (MEMORY, [None]),
+])
+def test_plan_partitions_of_top_parents(database, monkeypatch, strategy,
+                                        partitions):
+    monkeypatch.setattr(tasks, "choose_strategy", lambda connection: strategy)
+    planned = plan_partitions("set_top_parents_adjacent", partition_size=100)
+    assert sorted(p["partition"] for p in planned) == partitions
+
+
+def test_local_executor(database):
+    LocalExecutor(workers=3).run(chunk_size=50, partition_size=100)
+    report = verify_experiment_measurements()
+    assert report.ok, report.as_dict()
+    assert report.rows == 300
+
+    # The tasks are idempotent, rerunning one writes nothing.
+    assert run_task("add_values", partition=(1, 100), chunk_size=50) == 0
+
+    generate(50, depth=4, experiment_size=50, types=3, seed=1)
+    run_id = LocalExecutor(workers=3).run(chunk_size=50, partition_size=100)
+    assert verify_experiment_measurements().rows == 350
+    with session_scope() as session:
+        steps = set(step for (step,) in session.execute(
+            "SELECT DISTINCT step FROM etl_chunks WHERE run_id = :run_id",
+            {"run_id": run_id}))
+    assert "add_values" in steps
@@ -0,0 +1,117 @@
+import pytest
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    Table,
+    create_engine,
+    select,
+)
+from sqlalchemy.dialects import mysql, oracle, postgresql, sqlite
+from sqlalchemy.exc import CompileError
+
+from app.upsert import MAX, SUM, Upsert
+
+metadata = MetaData()
+target = Table(
+    "target", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("value", Integer),
+)
+source = Table(
+    "source", metadata,
+    Column("id", Integer),
+    Column("value", Integer),
+)
+
+
+def upsert(update_columns=("value",), only_changed=False, merge=None):
+    return Upsert(
+        target,
+        ["id", "value"],
+        select([source.c.id, source.c.value]),
+        index_elements=["id"],
+        update_columns=list(update_columns),
+        only_changed=only_changed,
+        merge=merge,
+    )
+
+
+def test_upsert_mysql():
+    sql = str(upsert().compile(dialect=mysql.dialect()))
+    assert sql.startswith("INSERT INTO target (id, value) SELECT")
+    assert sql.endswith("ON DUPLICATE KEY UPDATE value = VALUES(value)")
+
+
+def test_upsert_sqlite():
+    sql = str(upsert().compile(dialect=sqlite.dialect()))
+    assert "WHERE 1 = 1" in sql
+    assert sql.endswith(
+        "ON CONFLICT (id) DO UPDATE SET value = excluded.value")
+
+
+def test_upsert_only_changed():
+    sql = str(upsert(only_changed=True).compile(dialect=sqlite.dialect()))
+    assert sql.endswith(
+        "DO UPDATE SET value = excluded.value"
+        " WHERE target.value IS NOT excluded.value")
+    sql = str(upsert(only_changed=True).compile(
+        dialect=postgresql.dialect()))
+    assert sql.endswith("WHERE target.value IS DISTINCT FROM excluded.value")
+    # MySQL skips unchanged rows by itself.
+    sql = str(upsert(only_changed=True).compile(dialect=mysql.dialect()))
+    assert sql.endswith("ON DUPLICATE KEY UPDATE value = VALUES(value)")
+
+
+def test_upsert_only_changed_writes_nothing_on_rerun():
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        connection.execute(source.insert(), [
+            {"id": 1, "value": 1}, {"id": 2, "value": None}])
+        assert connection.execute(upsert(only_changed=True)).rowcount == 2
+        assert connection.execute(upsert(only_changed=True)).rowcount == 0
+        connection.execute(source.update().values(value=3))
+        assert connection.execute(upsert(only_changed=True)).rowcount == 2
+        assert sorted(connection.execute(select([target]))) == [
+            (1, 3), (2, 3)]
+
+
+def test_upsert_merge():
+    sql = str(upsert(merge={"value": SUM}).compile(dialect=mysql.dialect()))
+    assert sql.endswith(
+        "ON DUPLICATE KEY UPDATE value = value + VALUES(value)")
+    sql = str(upsert(merge={"value": MAX}).compile(
+        dialect=postgresql.dialect()))
+    assert sql.endswith(
+        "DO UPDATE SET value = GREATEST(target.value, excluded.value)")
+
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    with engine.connect() as connection:
+        connection.execute(source.insert(), [{"id": 1, "value": 2}])
+        connection.execute(upsert(merge={"value": SUM}))
+        connection.execute(upsert(merge={"value": SUM}))
+        assert list(connection.execute(select([target]))) == [(1, 4)]
+
+
+def test_upsert_partition():
+    sql = str(Upsert(
+        target, ["id"], select([source.c.id]), index_elements=["id"],
+        update_columns=[], partition="p1",
+    ).compile(dialect=mysql.dialect()))
+    assert sql.startswith("INSERT INTO target PARTITION (p1) (id) SELECT")
+    # Other backends have no partitions.
+    sql = str(upsert().compile(dialect=sqlite.dialect()))
+    assert "PARTITION" not in sql
+
+
+def test_upsert_do_nothing():
+    sql = str(upsert(update_columns=[]).compile(
+        dialect=postgresql.dialect()))
+    assert sql.endswith("ON CONFLICT (id) DO NOTHING")
+
+
+def test_upsert_unsupported_dialect():
+    with pytest.raises(CompileError):
+        str(upsert().compile(dialect=oracle.dialect()))
@@ -0,0 +1,94 @@
+from decimal import Decimal
+
+import numpy as np
+
+from app import vectorized
+from app.etl import add_measurement_columns
+from app.schema import session_scope
+from app.vectorized import (
+    NO_PARENT,
+    find_roots_vectorized,
+    pivot,
+    transform_vectorized,
+)
+from app.verify import verify_experiment_measurements
+
+
+def test_find_roots_vectorized_deep_chain():
+    depth = 100000
+    ids = np.arange(1, depth + 1)
+    parents = ids - 1
+    parents[0] = NO_PARENT
+    assert set(find_roots_vectorized(ids, parents)) == {1}
+
+
+def test_find_roots_vectorized_forest():
+    ids = np.array([1, 2, 3, 4, 5, 6])
+    parents = np.array([NO_PARENT, 1, 2, NO_PARENT, 4, 3])
+    assert list(find_roots_vectorized(ids, parents)) == [1, 1, 1, 4, 4, 1]
+
+
+def test_find_roots_vectorized_cycle():
+    ids = np.array([1, 2, 3, 4])
+    parents = np.array([2, 1, 3, NO_PARENT])
+    assert list(find_roots_vectorized(ids, parents)) == [
+        NO_PARENT, NO_PARENT, NO_PARENT, 4]
+
+
+def test_find_roots_vectorized_missing_parent():
+    ids = np.array([1, 2, 3, 4])
+    parents = np.array([NO_PARENT, 1, 9, 3])
+    assert list(find_roots_vectorized(ids, parents)) == [
+        1, 1, NO_PARENT, NO_PARENT]
+
+
+def test_pivot():
+    row_ids, types, table = pivot(
+        np.array([2, 1, 2]),
+        np.array(["vol", "ph", "ph"]),
+        np.array([Decimal("1.5"), Decimal("7"), Decimal("6")], dtype=object),
+    )
+    assert list(row_ids) == [1, 2]
+    assert list(types) == ["ph", "vol"]
+    assert table.tolist() == [
+        [Decimal("7"), None], [Decimal("6"), Decimal("1.5")]]
+
+
+def delete_samples(session, sample_ids):
+    for sample_id in sample_ids:
+        session.execute(
+            f"DELETE FROM sample_measurements WHERE sample_id = {sample_id}")
+        session.execute(f"DELETE FROM samples WHERE id = {sample_id}")
+
+
+def test_samples_arriving_during_the_transform(database, monkeypatch):
+    add_measurement_columns()
+    # One sample in a gap and one past the end of the snapshot.
+    late = (250, 300)
+    with session_scope() as session:
+        measurement_type = session.execute(
+            "SELECT measurement_type FROM sample_measurements"
+        ).scalar()
+        delete_samples(session, late)
+    read_snapshot = vectorized.read_samples
+
+    def read_samples(session, *args, **kwargs):
+        snapshot = read_snapshot(session, *args, **kwargs)
+        with session_scope() as other:
+            for sample_id in late:
+                other.execute(
+                    "INSERT INTO samples (id, experiment_id)"
+                    f" VALUES ({sample_id}, 1)")
+                other.execute(
+                    "INSERT INTO sample_measurements"
+                    " (sample_id, measurement_type, value)"
+                    f" VALUES ({sample_id}, '{measurement_type}', 1)")
+        return snapshot
+
+    monkeypatch.setattr(vectorized, "read_samples", read_samples)
+    transform_vectorized(chunk_size=100)
+
+    # The neighbours of the late samples kept their own values.
+    with session_scope() as session:
+        delete_samples(session, late)
+    assert verify_experiment_measurements().ok
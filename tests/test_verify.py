@@ -0,0 +1,148 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.schema import (
+    DBase,
+    ExperimentMeasurementSlots,
+    MeasurementType,
+    Sample,
+    SampleMeasurement,
+)
+from app.storage import SLOTS, assign_slots
+from app.verify import (
+    EXPERIMENT_ID,
+    EXTRA_ROW,
+    MEASUREMENT,
+    MISSING_COLUMN,
+    MISSING_ROW,
+    TOP_PARENT_ID,
+    VerificationReport,
+    expected_top_parents,
+    read_lineage,
+    verify,
+)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    DBase.metadata.create_all(engine)
+    session = Session(bind=engine)
+    session.add_all([
+        Sample(id=1, experiment=1),
+        Sample(id=2, parent_id=1, experiment=1),
+        Sample(id=3, parent_id=2, experiment=2),
+        Sample(id=4, experiment=2),
+        # A cycle, which has no top parent.
+        Sample(id=5, parent_id=6),
+        Sample(id=6, parent_id=5),
+    ])
+    session.flush()
+    session.add_all([
+        SampleMeasurement(sample_id=1, measurement_type="ph", value=7),
+        SampleMeasurement(sample_id=3, measurement_type="ph", value=6),
+        SampleMeasurement(sample_id=3, measurement_type="vol", value=2),
+    ])
+    session.flush()
+    # The types are registered by triggers, ph gets slot 0 and vol slot 1.
+    assign_slots(session)
+    session.add_all([
+        ExperimentMeasurementSlots(
+            sample_id=1, experiment_id=1, top_parent_id=1, slot_0=7),
+        ExperimentMeasurementSlots(
+            sample_id=2, experiment_id=1, top_parent_id=1),
+        ExperimentMeasurementSlots(
+            sample_id=3, experiment_id=2, top_parent_id=1, slot_0=6,
+            slot_1=2),
+        ExperimentMeasurementSlots(
+            sample_id=4, experiment_id=2, top_parent_id=4),
+        ExperimentMeasurementSlots(sample_id=5),
+        ExperimentMeasurementSlots(sample_id=6),
+    ])
+    session.flush()
+    yield session
+    session.close()
+
+
+def test_verify_correct(session):
+    report = verify(session, mode=SLOTS, chunk_size=2)
+    assert report.ok, report.as_dict()
+    assert report.rows == 6
+
+
+def test_verify_mismatches(session):
+    session.execute(
+        "UPDATE experiment_measurement_slots"
+        " SET top_parent_id = 2, experiment_id = 3 WHERE sample_id = 3")
+    session.execute(
+        "UPDATE experiment_measurement_slots SET slot_1 = 5"
+        " WHERE sample_id = 2")
+    session.execute(
+        "DELETE FROM experiment_measurement_slots WHERE sample_id = 4")
+    session.execute(
+        "UPDATE experiment_measurement_slots SET sample_id = 7"
+        " WHERE sample_id = 6")
+    session.add(MeasurementType(measurement_type="area"))
+
+    report = verify(session, mode=SLOTS, chunk_size=2)
+    assert report.counts == {
+        MISSING_ROW: 2,
+        EXTRA_ROW: 1,
+        EXPERIMENT_ID: 1,
+        TOP_PARENT_ID: 1,
+        MISSING_COLUMN: 1,
+        MEASUREMENT: 1,
+    }
+    mismatches = {
+        (m["kind"], m["sample_id"]): m for m in report.mismatches}
+    assert mismatches[TOP_PARENT_ID, 3]["expected"] == 1
+    assert mismatches[TOP_PARENT_ID, 3]["actual"] == 2
+    assert (MISSING_ROW, 4) in mismatches
+    assert (MISSING_ROW, 6) in mismatches
+    assert (EXTRA_ROW, 7) in mismatches
+    assert mismatches[MEASUREMENT, 2]["column"] == "slot_1"
+    assert mismatches[MEASUREMENT, 2]["expected"] is None
+
+
+def test_expected_top_parents():
+    parents = {1: None, 2: 1, 3: 2, 4: 9, 5: 4, 6: 7, 7: 6, 8: 7}
+    assert expected_top_parents(parents) == {
+        1: 1, 2: 1, 3: 1, 4: None, 5: None, 6: None, 7: None, 8: None}
+
+
+def test_verify_missing_parent(session):
+    # A transform that makes a sample below a missing parent its own root.
+    session.add(Sample(id=7, parent_id=9, experiment=1))
+    session.flush()
+    session.add(ExperimentMeasurementSlots(
+        sample_id=7, experiment_id=1, top_parent_id=7))
+    session.flush()
+    report = verify(session, mode=SLOTS)
+    assert report.counts == {TOP_PARENT_ID: 1}
+    assert report.mismatches[0]["expected"] is None
+    assert report.mismatches[0]["actual"] == 7
+
+
+def test_verify_window(session):
+    session.execute(
+        "UPDATE experiment_measurement_slots SET top_parent_id = 2"
+        " WHERE sample_id = 3")
+    assert verify(session, sample_ids=[1, 2], mode=SLOTS).ok
+    assert not verify(session, sample_ids=[3], mode=SLOTS).ok
+
+
+def test_read_lineage_of_window(session):
+    ids, experiments, top_parents = read_lineage(session, sample_ids=[3, 5])
+    # Only the window and its ancestors, the walk around the cycle ends.
+    assert ids.tolist() == [1, 2, 3, 5, 6]
+    assert experiments.tolist()[:3] == [1, 1, 2]
+    assert top_parents.tolist()[:3] == [1, 1, 1]
+
+
+def test_report_keeps_first_mismatches():
+    report = VerificationReport(max_mismatches=2)
+    for sample_id in range(5):
+        report.add(MISSING_ROW, sample_id)
+    assert report.counts == {MISSING_ROW: 5}
+    assert [m["sample_id"] for m in report.mismatches] == [0, 1]
@@ -0,0 +1,68 @@
+"""Added etl_runs and sample_measurement_changes tables
+
+Revision ID: 4f9f48a69c7a
+Revises: 31cb73361b6f
+Create Date: 2026-10-17 09:12:44.102311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "4f9f48a69c7a"
+down_revision = "31cb73361b6f"
+branch_labels = None
+depends_on = None
+
+
+TRIGGER_EVENTS = ["INSERT", "UPDATE"]
+
+
+def upgrade():
+    op.create_table(
+        "etl_runs",
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("status", sa.VARCHAR(16), nullable=False),
+        sa.Column(
+            "started_at",
+            sa.TIMESTAMP,
+            nullable=False,
+            server_default=sa.func.now()
+        ),
+        sa.Column("finished_at", sa.TIMESTAMP, nullable=True),
+        sa.Column("sample_id_low", sa.Integer, nullable=False),
+        sa.Column("sample_id_high", sa.Integer, nullable=False),
+        sa.Column("change_id_low", sa.BigInteger, nullable=False),
+        sa.Column("change_id_high", sa.BigInteger, nullable=False),
+    )
+    op.create_table(
+        "sample_measurement_changes",
+        # SQLite only autoincrements INTEGER primary keys.
+        sa.Column(
+            "id",
+            sa.BigInteger().with_variant(sa.Integer, "sqlite"),
+            primary_key=True
+        ),
+        sa.Column("sample_id", sa.Integer, nullable=False),
+        sqlite_autoincrement=True,
+    )
+    for event in TRIGGER_EVENTS:
+        op.execute(
+            f"CREATE TRIGGER sample_measurements_after_{event.lower()}"
+            f" AFTER {event} ON sample_measurements FOR EACH ROW"
+            f" BEGIN"
+            f" INSERT INTO sample_measurement_changes (sample_id)"
+            f" VALUES (NEW.sample_id);"
+            f" END"
+        )
+
+
+def downgrade():
+    for event in TRIGGER_EVENTS:
+        op.execute(
+            f"DROP TRIGGER IF EXISTS"
+            f" sample_measurements_after_{event.lower()}"
+        )
+    op.drop_table("sample_measurement_changes")
+    op.drop_table("etl_runs")
@@ -0,0 +1,46 @@
+"""Claim change log rows per run and log new samples
+
+Revision ID: 5d8e2a7c4b19
+Revises: f1b7c2d9e4a0
+Create Date: 2026-10-17 20:31:52.118406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "5d8e2a7c4b19"
+down_revision = "f1b7c2d9e4a0"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "sample_measurement_changes",
+        sa.Column("run_id", sa.Integer, nullable=True),
+    )
+    op.create_index(
+        "ix_sample_measurement_changes_run_id",
+        "sample_measurement_changes",
+        ["run_id"],
+    )
+    # Must match app.schema.SAMPLE_CHANGE_TRIGGER
+    op.execute(
+        "CREATE TRIGGER samples_after_insert"
+        " AFTER INSERT ON samples FOR EACH ROW"
+        " BEGIN"
+        " INSERT INTO sample_measurement_changes (sample_id)"
+        " VALUES (NEW.id);"
+        " END"
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS samples_after_insert")
+    op.drop_index(
+        "ix_sample_measurement_changes_run_id",
+        table_name="sample_measurement_changes",
+    )
+    op.drop_column("sample_measurement_changes", "run_id")
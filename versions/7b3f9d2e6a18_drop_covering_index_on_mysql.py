@@ -0,0 +1,34 @@
+"""Dropped the covering index of sample_measurements on MySQL
+
+InnoDB clusters sample_measurements on its primary key (sample_id,
+measurement_type), so the rows already hold value in the order of
+ix_sample_measurements_sample_type_value and the index only costs writes.
+
+Revision ID: 7b3f9d2e6a18
+Revises: 5d8e2a7c4b19
+Create Date: 2026-10-17 22:14:37.905126
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "7b3f9d2e6a18"
+down_revision = "5d8e2a7c4b19"
+branch_labels = None
+depends_on = None
+
+# Must match app.indexes.INDEXES
+NAME = "ix_sample_measurements_sample_type_value"
+TABLE = "sample_measurements"
+COLUMNS = ["sample_id", "measurement_type", "value"]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == "mysql":
+        op.drop_index(NAME, table_name=TABLE)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "mysql":
+        op.create_index(NAME, TABLE, COLUMNS)
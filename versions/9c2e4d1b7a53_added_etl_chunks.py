@@ -0,0 +1,37 @@
+"""Added etl_chunks table
+
+Revision ID: 9c2e4d1b7a53
+Revises: 4f9f48a69c7a
+Create Date: 2026-10-17 10:41:05.377120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9c2e4d1b7a53"
+down_revision = "4f9f48a69c7a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "etl_chunks",
+        sa.Column(
+            "run_id",
+            sa.Integer,
+            sa.ForeignKey("etl_runs.id"),
+            primary_key=True
+        ),
+        sa.Column("step", sa.VARCHAR(64), primary_key=True),
+        sa.Column("chunk_start", sa.Integer, primary_key=True),
+        sa.Column("chunk_end", sa.Integer, nullable=False),
+        sa.Column("rows_written", sa.Integer, nullable=True),
+        sa.Column("seconds", sa.DECIMAL(12, 3), nullable=False),
+    )
+
+
+def downgrade():
+    op.drop_table("etl_chunks")
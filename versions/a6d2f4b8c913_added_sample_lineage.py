@@ -0,0 +1,78 @@
+"""Added sample_lineage closure table
+
+Revision ID: a6d2f4b8c913
+Revises: e3a5c7f9b142
+Create Date: 2026-10-17 16:52:27.304718
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a6d2f4b8c913"
+down_revision = "e3a5c7f9b142"
+branch_labels = None
+depends_on = None
+
+
+# The passes of app.closure.extend_sample_lineage over all samples.
+INHERIT_ROWS = """
+INSERT INTO sample_lineage (ancestor_id, descendant_id, depth)
+SELECT parent.ancestor_id, samples.id, parent.depth + 1
+FROM samples
+JOIN sample_lineage AS parent ON parent.descendant_id = samples.parent_id
+WHERE NOT EXISTS (
+    SELECT 1 FROM sample_lineage AS own
+    WHERE own.ancestor_id = samples.id AND own.descendant_id = samples.id
+)
+"""
+ADD_OWN_ROWS = """
+INSERT INTO sample_lineage (ancestor_id, descendant_id, depth)
+SELECT samples.id, samples.id, 0
+FROM samples
+WHERE NOT EXISTS (
+    SELECT 1 FROM sample_lineage AS own
+    WHERE own.ancestor_id = samples.id AND own.descendant_id = samples.id
+) AND (
+    samples.parent_id IS NULL OR EXISTS (
+        SELECT 1 FROM sample_lineage AS parent
+        WHERE parent.ancestor_id = samples.parent_id
+        AND parent.descendant_id = samples.id
+    )
+)
+"""
+
+
+def upgrade():
+    op.create_table(
+        "sample_lineage",
+        sa.Column(
+            "ancestor_id",
+            sa.Integer,
+            sa.ForeignKey("samples.id"),
+            primary_key=True
+        ),
+        sa.Column(
+            "descendant_id",
+            sa.Integer,
+            sa.ForeignKey("samples.id"),
+            primary_key=True
+        ),
+        sa.Column("depth", sa.Integer, nullable=False),
+    )
+    # Must match app.indexes.INDEXES
+    op.create_index(
+        "ix_sample_lineage_descendant_depth", "sample_lineage",
+        ["descendant_id", "depth"])
+    # Incremental runs only add the rows of new samples, so the existing
+    #  samples are added here, one level of the trees per pass.
+    bind = op.get_bind()
+    while True:
+        bind.execute(sa.text(INHERIT_ROWS))
+        if not bind.execute(sa.text(ADD_OWN_ROWS)).rowcount:
+            break
+
+
+def downgrade():
+    op.drop_table("sample_lineage")
@@ -0,0 +1,52 @@
+"""Added measurement_types registry
+
+Revision ID: b7d3a8e0c215
+Revises: 9c2e4d1b7a53
+Create Date: 2026-10-17 11:27:38.904416
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b7d3a8e0c215"
+down_revision = "9c2e4d1b7a53"
+branch_labels = None
+depends_on = None
+
+
+TRIGGER_EVENTS = ["INSERT", "UPDATE"]
+INSERT_IGNORE = {"mysql": "INSERT IGNORE", "sqlite": "INSERT OR IGNORE"}
+
+
+def upgrade():
+    op.create_table(
+        "measurement_types",
+        sa.Column("measurement_type", sa.VARCHAR(10), primary_key=True),
+    )
+    insert_ignore = INSERT_IGNORE[op.get_bind().dialect.name]
+    for event in TRIGGER_EVENTS:
+        op.execute(
+            f"CREATE TRIGGER sample_measurements_register_type_after_"
+            f"{event.lower()}"
+            f" AFTER {event} ON sample_measurements FOR EACH ROW"
+            f" BEGIN"
+            f" {insert_ignore} INTO measurement_types (measurement_type)"
+            f" VALUES (NEW.measurement_type);"
+            f" END"
+        )
+    # Register the types of the measurements that are already there.
+    op.execute(
+        "INSERT INTO measurement_types (measurement_type)"
+        " SELECT DISTINCT measurement_type FROM sample_measurements"
+    )
+
+
+def downgrade():
+    for event in TRIGGER_EVENTS:
+        op.execute(
+            f"DROP TRIGGER IF EXISTS"
+            f" sample_measurements_register_type_after_{event.lower()}"
+        )
+    op.drop_table("measurement_types")
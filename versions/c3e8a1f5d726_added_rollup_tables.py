@@ -0,0 +1,78 @@
+"""Added experiment_rollups and lineage_rollups
+
+Revision ID: c3e8a1f5d726
+Revises: a6d2f4b8c913
+Create Date: 2026-10-17 18:04:51.518230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "c3e8a1f5d726"
+down_revision = "a6d2f4b8c913"
+branch_labels = None
+depends_on = None
+
+
+# Incremental runs only merge the samples after the watermark, so the rows of
+#  the samples up to it are aggregated here, see app.rollups.
+BACKFILL = """
+INSERT INTO {rollup} ({group}, measurement_type,
+    value_count, value_sum, value_min, value_max)
+SELECT em.{group}, sample_values.measurement_type,
+    COUNT(sample_values.value), SUM(sample_values.value),
+    MIN(sample_values.value), MAX(sample_values.value)
+FROM (
+    SELECT sample_id, measurement_type, MAX(value) AS value
+    FROM sample_measurements
+    WHERE value IS NOT NULL
+    GROUP BY sample_id, measurement_type
+) AS sample_values
+JOIN experiment_measurements AS em
+    ON em.sample_id = sample_values.sample_id
+WHERE em.{group} IS NOT NULL AND em.sample_id <= (
+    SELECT COALESCE(MAX(sample_id_high), 0) FROM etl_runs
+    WHERE status = 'finished'
+)
+GROUP BY em.{group}, sample_values.measurement_type
+"""
+
+
+def rollup_columns():
+    return [
+        sa.Column("measurement_type", sa.VARCHAR(10), primary_key=True),
+        sa.Column("value_count", sa.Integer, nullable=False),
+        sa.Column("value_sum", sa.DECIMAL(28, 6), nullable=False),
+        sa.Column("value_min", sa.DECIMAL(16, 6), nullable=False),
+        sa.Column("value_max", sa.DECIMAL(16, 6), nullable=False),
+    ]
+
+
+def upgrade():
+    op.create_table(
+        "experiment_rollups",
+        sa.Column("experiment_id", sa.Integer, primary_key=True),
+        *rollup_columns()
+    )
+    op.create_table(
+        "lineage_rollups",
+        sa.Column(
+            "top_parent_id",
+            sa.Integer,
+            sa.ForeignKey("samples.id"),
+            primary_key=True
+        ),
+        *rollup_columns()
+    )
+    bind = op.get_bind()
+    bind.execute(sa.text(BACKFILL.format(
+        rollup="experiment_rollups", group="experiment_id")))
+    bind.execute(sa.text(BACKFILL.format(
+        rollup="lineage_rollups", group="top_parent_id")))
+
+
+def downgrade():
+    op.drop_table("lineage_rollups")
+    op.drop_table("experiment_rollups")
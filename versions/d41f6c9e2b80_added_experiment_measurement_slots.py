@@ -0,0 +1,51 @@
+"""Added experiment_measurement_slots table and measurement type slots
+
+Revision ID: d41f6c9e2b80
+Revises: b7d3a8e0c215
+Create Date: 2026-10-17 12:03:51.662094
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "d41f6c9e2b80"
+down_revision = "b7d3a8e0c215"
+branch_labels = None
+depends_on = None
+
+
+# Must match app.schema.SLOT_COUNT
+SLOT_COUNT = 256
+
+
+def upgrade():
+    with op.batch_alter_table("measurement_types") as batch_op:
+        batch_op.add_column(sa.Column("slot", sa.Integer, nullable=True))
+        batch_op.create_unique_constraint(
+            "uq_measurement_types_slot", ["slot"])
+    op.create_table(
+        "experiment_measurement_slots",
+        sa.Column(
+            "sample_id",
+            sa.Integer,
+            sa.ForeignKey("samples.id"),
+            primary_key=True
+        ),
+        sa.Column("experiment_id", sa.Integer),
+        sa.Column("top_parent_id", sa.Integer, sa.ForeignKey("samples.id")),
+        *[
+            sa.Column(f"slot_{slot}", sa.DECIMAL(16, 6))
+            for slot in range(SLOT_COUNT)
+        ]
+    )
+
+
+def downgrade():
+    op.execute("DROP VIEW IF EXISTS experiment_measurements_view")
+    op.drop_table("experiment_measurement_slots")
+    with op.batch_alter_table("measurement_types") as batch_op:
+        batch_op.drop_constraint(
+            "uq_measurement_types_slot", type_="unique")
+        batch_op.drop_column("slot")
@@ -0,0 +1,65 @@
+"""Added indexes on the columns the pipeline filters and joins on
+
+Revision ID: e3a5c7f9b142
+Revises: d41f6c9e2b80
+Create Date: 2026-10-17 14:36:12.418529
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e3a5c7f9b142"
+down_revision = "d41f6c9e2b80"
+branch_labels = None
+depends_on = None
+
+
+# Must match app.indexes.INDEXES
+INDEXES = [
+    ("ix_samples_parent_id", "samples", ["parent_id"]),
+    ("ix_sample_measurements_sample_type_value", "sample_measurements",
+     ["sample_id", "measurement_type", "value"]),
+    ("ix_sample_measurements_type_sample_value", "sample_measurements",
+     ["measurement_type", "sample_id", "value"]),
+    ("ix_experiment_measurements_top_parent_id", "experiment_measurements",
+     ["top_parent_id"]),
+    ("ix_experiment_measurements_experiment_sample",
+     "experiment_measurements", ["experiment_id", "sample_id"]),
+    ("ix_experiment_measurement_slots_top_parent_id",
+     "experiment_measurement_slots", ["top_parent_id"]),
+    ("ix_experiment_measurement_slots_experiment_sample",
+     "experiment_measurement_slots", ["experiment_id", "sample_id"]),
+]
+
+
+def backs_foreign_key(inspector, table, name, column):
+    """Tells whether index name is the only index MySQL can use for a
+    foreign key on column.  MySQL refuses to drop such an index."""
+    foreign_keys = [
+        fk for fk in inspector.get_foreign_keys(table)
+        if fk["constrained_columns"][:1] == [column]
+    ]
+    others = [
+        index for index in inspector.get_indexes(table)
+        if index["name"] != name and index["column_names"][:1] == [column]
+    ]
+    primary_key = inspector.get_pk_constraint(table)["constrained_columns"]
+    return bool(foreign_keys) and not others and primary_key[:1] != [column]
+
+
+def upgrade():
+    for name, table, columns in INDEXES:
+        op.create_index(name, table, columns)
+
+
+def downgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    for name, table, columns in reversed(INDEXES):
+        if bind.dialect.name == "mysql" and backs_foreign_key(
+                inspector, table, name, columns[0]):
+            # Leave the foreign key the plain index it had before.
+            op.create_index(f"fk_{table}_{columns[0]}", table, [columns[0]])
+        op.drop_index(name, table_name=table)
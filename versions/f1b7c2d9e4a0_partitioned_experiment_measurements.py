@@ -0,0 +1,53 @@
+"""Partitioned experiment_measurements by sample_id range
+
+Revision ID: f1b7c2d9e4a0
+Revises: c3e8a1f5d726
+Create Date: 2026-10-17 18:47:09.264815
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "f1b7c2d9e4a0"
+down_revision = "c3e8a1f5d726"
+branch_labels = None
+depends_on = None
+
+
+# Must match app.partitions.PARTITION_SIZE
+PARTITION_SIZE = 1000000
+
+
+def upgrade():
+    bind = op.get_bind()
+    # Only MySQL partitions tables this way, see app.partitions.
+    if bind.dialect.name != "mysql":
+        return
+    # MySQL does not support foreign keys on partitioned tables.
+    for foreign_key in sa.inspect(bind).get_foreign_keys(
+            "experiment_measurements"):
+        op.drop_constraint(
+            foreign_key["name"], "experiment_measurements",
+            type_="foreignkey")
+    high = bind.execute("SELECT COALESCE(MAX(id), 0) FROM samples").scalar()
+    clauses = [
+        f"PARTITION p{start} VALUES LESS THAN ({start + PARTITION_SIZE})"
+        for start in range(1, high + 1, PARTITION_SIZE)
+    ] + ["PARTITION pmax VALUES LESS THAN MAXVALUE"]
+    op.execute(
+        "ALTER TABLE experiment_measurements PARTITION BY RANGE (sample_id)"
+        f" ({', '.join(clauses)})")
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != "mysql":
+        return
+    op.execute("ALTER TABLE experiment_measurements REMOVE PARTITIONING")
+    op.create_foreign_key(
+        None, "experiment_measurements", "samples",
+        ["top_parent_id"], ["id"])
+    op.create_foreign_key(
+        None, "experiment_measurements", "samples", ["sample_id"], ["id"])